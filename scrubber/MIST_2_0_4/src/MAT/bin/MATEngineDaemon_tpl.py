@@ -0,0 +1,67 @@
+#!MF_PYTHONBIN
+
+# Copyright (C) 2007 - 2009 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+import os, sys
+
+MAT_PKG_PYLIB = "MF_MAT_PKG_PYLIB"
+sys.path.insert(0, MAT_PKG_PYLIB)
+
+#
+# Toplevel
+#
+
+# As with MATEngine, the settings file has to be in the environment
+# before MAT is loaded.
+
+try:
+    i = 1 + sys.argv[1:].index("--settings_file")
+    if i < len(sys.argv) - 1:
+        os.environ["MAT_SETTINGS_FILE"] = sys.argv[i + 1]
+except ValueError:
+    pass
+
+import MAT
+
+from MAT.Operation import OptionParser
+
+parser = OptionParser(usage = """Usage: %prog [options]
+
+Loads the tasks once, and then reads MATEngine jobs, one JSON object per line,
+from standard input (or the socket, if --socket is provided), and writes
+a JSON object on a line of its own for each one. See MAT/EngineDaemon.py
+for the format of the jobs and responses.""")
+parser.add_option("--other_app_dir", dest = "other_app_dirs",
+                  action = "append",
+                  metavar = "dir",
+                  help = "additional directory to load a task from. Optional and repeatable.")
+parser.add_option("--settings_file", dest = "settings_file",
+                  metavar = "file",
+                  help = "a file of settings to use which overwrites existing settings. The file should be a Python config file in the style of the template in etc/MAT_settings.config.in. Optional.")
+parser.add_option("--socket", dest = "socket",
+                  metavar = "path",
+                  help = "listen on a Unix socket at this path, instead of reading standard input")
+MAT.ExecutionContext.addOptions(parser, stepStatistics = False)
+options, args = parser.parse_args()
+
+if args:
+    parser.print_help()
+    sys.exit(1)
+
+MAT.ExecutionContext.extractOptions(options)
+
+import MAT.EngineDaemon
+
+d = MAT.EngineDaemon.EngineDaemon(pluginDir = MAT.PluginMgr.LoadPlugins(*(options.other_app_dirs or [])))
+
+try:
+    if options.socket:
+        d.serveSocket(options.socket)
+    else:
+        d.serveStdio()
+except MAT.EngineDaemon.EngineDaemonError, e:
+    print >> sys.stderr, "Error:", str(e)
+    sys.exit(1)
+except KeyboardInterrupt:
+    pass
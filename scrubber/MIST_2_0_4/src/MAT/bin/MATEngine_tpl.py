@@ -141,10 +141,10 @@ def createGeneralOptions():
                      help = "The file to process. Either this or --input_dir must be specified. A single dash ('-') will cause the engine to read from standard input.")
     group.add_option("--input_dir", dest = "input_dir",
                      metavar = "dir",
-                     help = "The directory to process. Either this or --input_file must be specified.")
+                     help = "The directory to process. Either this or --input_file must be specified. This may also be a tar archive (optionally compressed with gzip or bzip2) or a zip archive, whose members are read without extracting them.")
     group.add_option("--input_file_re", dest = "input_file_re",
                      metavar = "re",
-                     help = "If --input_dir is specified, a regular expression to match the filenames in the directory against. The pattern must cover the entire filename (and only the filename, not the full path).")
+                     help = "If --input_dir is specified, a regular expression to match the filenames in the directory against. The pattern must cover the entire filename (and only the filename, not the full path). If --input_dir is an archive, the pattern is matched against the member names, which include any folders inside the archive.")
     group.add_option("--input_encoding", dest = "input_encoding",
                      metavar = "encoding",
                      help = "Input character encoding for files which require one. Default is ascii.")
@@ -154,6 +154,26 @@ def createGeneralOptions():
                      callback = _inputFileTypeCallback,
                      metavar = " | ".join(MAT.DocumentIO.allInputDocumentIO()),
                      help = "The file type of the input. One of " + ", ".join(MAT.DocumentIO.allInputDocumentIO()) + ". Required.")
+    group.add_option("--prefetch", dest = "prefetch",
+                     type = "int",
+                     metavar = "n",
+                     help = "If present and greater than 0, read and deserialize the input files with a pool of this many workers, ahead of processing. The files are still processed in order. Optional.")
+    group.add_option("--prefetch_mode", dest = "prefetch_mode",
+                     type = "choice",
+                     choices = ["process", "thread"],
+                     metavar = "process | thread",
+                     help = "If --prefetch is specified, whether the workers are processes or threads. Threads mostly help when reading the files is slow. Default is process, where available.")
+    group.add_option("--stream_chunk", dest = "stream_chunk",
+                     type = "int",
+                     metavar = "n",
+                     help = "If present and greater than 0, don't load all the input files at once; read them this many at a time, and write each output as soon as it's done. Steps which need the whole batch at once (e.g., nominate) save the documents to a temporary directory between their two passes. Optional.")
+    group.add_option("--workers", dest = "workers",
+                     type = "int",
+                     metavar = "n",
+                     help = "If present and greater than 1, run the steps which process each document independently (e.g., zone, align, clean) in a pool of this many worker processes. The results are the same, and in the same order, as without workers. Optional.")
+    group.add_option("--journal", dest = "journal",
+                     metavar = "file",
+                     help = "If present, record each document in this file as soon as its output is written, and skip the documents the file records as already done with the same steps, whose inputs and outputs haven't changed since. Rerun an interrupted command with the same --journal to resume it; use --stream_chunk too, so the outputs are written as the run goes. Requires --output_dir or --output_file, which can't be an archive or standard output. Optional.")
     parser.add_option_group(group)
     group = OptionGroup(parser, "Output options")
     group.add_option("--output_file", dest = "output_file",
@@ -161,7 +181,7 @@ def createGeneralOptions():
                      help = "Where to save the output. Optional. Must be paired with --input_file. A single dash ('-') will cause the engine to write to standard output.")
     group.add_option("--output_dir", dest = "output_dir",
                      metavar = "dir",
-                     help = "Where to save the output. Optional. Must be paired with --input_dir.")
+                     help = "Where to save the output. Optional. Must be paired with --input_dir. If the name ends in .tar, .tar.gz, .tgz, .tar.bz2, .tbz2 or .zip and it isn't an existing directory, the output is written to an archive instead.")
     group.add_option("--output_fsuff", dest = "output_fsuff",
                      metavar = "suffix",
                      help = "The suffix to add to each filename when --output_dir is specified. If absent, the name of each file will be identical to the name of the file in the input directory.")
@@ -290,7 +310,8 @@ MAT.ExecutionContext.extractOptions(options)
 RunArgs = AGGREGATOR.convertToKW(options)
 for arg in ["other_app_dir", "task", "settings_file", "workflow",
             "subprocess_debug", "subprocess_statistics", "preserve_tempfiles",
-            "tmpdir_root", "debug"]:
+            "tmpdir_root", "debug", "verbose_config",
+            "step_statistics", "step_statistics_per_document"]:
     try:
         del RunArgs[arg]
     except:
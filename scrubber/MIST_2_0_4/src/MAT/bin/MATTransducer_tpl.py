@@ -69,10 +69,10 @@ group.add_option("--input_file", dest = "input_file",
                  help = "The file to process. Either this or --input_dir must be specified. A single dash ('-') will cause the engine to read from standard input.")
 group.add_option("--input_dir", dest = "input_dir",
                  metavar = "dir",
-                 help = "The directory to process. Either this or --input_file must be specified.")
+                 help = "The directory to process. Either this or --input_file must be specified. This may also be a tar archive (optionally compressed with gzip or bzip2) or a zip archive, whose members are read without extracting them.")
 group.add_option("--input_file_re", dest = "input_file_re",
                  metavar = "re",
-                 help = "If --input_dir is specified, a regular expression to match the filenames in the directory against. The pattern must cover the entire filename (and only the filename, not the full path).")
+                 help = "If --input_dir is specified, a regular expression to match the filenames in the directory against. The pattern must cover the entire filename (and only the filename, not the full path). If --input_dir is an archive, the pattern is matched against the member names, which include any folders inside the archive.")
 group.add_option("--input_encoding", dest = "input_encoding",
                  metavar = "encoding",
                  help = "Input character encoding for files which require one. Default is ascii.")
@@ -101,7 +101,7 @@ group.add_option("--output_file", dest = "output_file",
                  help = "Where to save the output. Either this or --output_dir must be provided. Must be paired with --input_file. A single dash ('-') will cause the engine to write to standard output.")
 group.add_option("--output_dir", dest = "output_dir",
                  metavar = "dir",
-                 help = "Where to save the output. Either this or --output_file must be provided. Must be paired with --input_dir.")
+                 help = "Where to save the output. Either this or --output_file must be provided. Must be paired with --input_dir. If the name ends in .tar, .tar.gz, .tgz, .tar.bz2, .tbz2 or .zip and it isn't an existing directory, the output is written to an archive instead.")
 group.add_option("--output_fsuff", dest = "output_fsuff",
                  metavar = "suffix",
                  help = "The suffix to add to each filename when --output_dir is specified. If absent, the name of each file will be identical to the name of the file in the input directory.")
@@ -168,7 +168,8 @@ RunArgs = AGGREGATOR.convertToKW(options)
 
 for arg in ["task", 
             "subprocess_debug", "subprocess_statistics", "preserve_tempfiles",
-            "tmpdir_root", "debug", "document_mapping_xml", "document_mapping_xml_file"]:
+            "tmpdir_root", "debug", "verbose_config", "step_statistics",
+            "step_statistics_per_document", "document_mapping_xml", "document_mapping_xml_file"]:
     try:
         del RunArgs[arg]
     except:
@@ -279,5 +280,8 @@ except Exception, e:
     else:
         print >> sys.stderr, "Error: " + str(e)
         sys.exit(1)
+finally:
+    # An output archive isn't complete until it's closed.
+    dm.close()
 
 sys.exit(0)
@@ -102,7 +102,7 @@ parser.add_option("--spawn_tabbed_terminal",
                   dest = "spawn_tabbed_terminal",
                   action="store_true",
                   help = "If available, spawn the Web server in a tabbed terminal and exit. The tabbed terminal is " + (((not TABBED_TERMINAL_BIN) and "NOT ") or "") + "available in this installation.")
-MAT.ExecutionContext.addOptions(parser)
+MAT.ExecutionContext.addOptions(parser, stepStatistics = False)
 
 options, args = parser.parse_args()
 if args:
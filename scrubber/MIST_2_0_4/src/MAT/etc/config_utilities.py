@@ -23,7 +23,7 @@ MAT_PKG_HOME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 PYEXECS = ["MATAnnotationInfoToJSON", "MATEngine", "MATWeb", "MATManagePluginDirs", "MATScore",
            "MATExperimentEngine", "MATWorkspaceEngine", "MATModelBuilder",
            "MATWebClient", "MATRetokenize", "MATTransducer", "MATCreateComparisonDocument",
-           "MATUpdateTaskXML", "MATUpdateWorkspace1To2", "MATReport"]
+           "MATUpdateTaskXML", "MATUpdateWorkspace1To2", "MATReport", "MATEngineDaemon"]
 
 #
 # Public utilities
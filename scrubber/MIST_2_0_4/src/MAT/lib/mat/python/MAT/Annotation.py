@@ -38,6 +38,9 @@ class AttributeValueSequence:
 
     def __init__(self):
         self.ofDocAndAttribute = None
+        # The annotation whose attribute value this is, so
+        # changes can be reported to the document.
+        self.ofAnnotation = None
         
     # Reusing for a different attribute. ofDocAndAttribute should be None.
     def copy(self):
@@ -60,7 +63,7 @@ class AttributeValueSequence:
         if self.ofDocAndAttribute:
             doc, attr = self.ofDocAndAttribute
             if clear and attr._clearValue:
-                attr._clearValue(doc)
+                attr._clearValue(doc, self.ofAnnotation)
             if not attr._checkAndImportSingleValue(doc, v):
                 raise AnnotationError, ("candidate value %s of element of attribute '%s' must be a %s and meet the other requirements" % (str(v), attr.name, attr._typename_))
             
@@ -68,7 +71,7 @@ class AttributeValueSequence:
         if self.ofDocAndAttribute:
             doc, attr = self.ofDocAndAttribute
             if clear and attr._clearValue:
-                attr._clearValue(doc)
+                attr._clearValue(doc, self.ofAnnotation)
             for v in vl:
                 if not attr._checkAndImportSingleValue(doc, v):
                     raise AnnotationError, ("candidate value %s of element of attribute '%s' must be a %s and meet the other requirements" % (str(v), attr.name, attr._typename_))
@@ -77,7 +80,7 @@ class AttributeValueSequence:
         if self.ofDocAndAttribute:
             doc, attr = self.ofDocAndAttribute
             if attr._clearValue:
-                attr._clearValue(doc)
+                attr._clearValue(doc, self.ofAnnotation)
 
 class AttributeValueList(AttributeValueSequence, list):
 
@@ -876,9 +879,14 @@ class AnnotationAttributeType(AttributeType):
         # Not possible
         return None
 
-    def _clearAnnotationValue(self, doc):
-        # If there's already a current value.
-        doc.atypeRepository._clearIDReferences()
+    def _clearAnnotationValue(self, doc, annot = None):
+        # Called whenever the value changes. If we know which annotation
+        # the value belongs to, the document can fix up just the
+        # references from that annotation.
+        if annot is None:
+            doc.atypeRepository._clearIDReferences()
+        else:
+            doc.atypeRepository._annotationReferenceChanged(annot, self)
 
     # We check the labels, and convert the values, and unpack
     # the effective labels. We know the effective labels point
@@ -1097,7 +1105,23 @@ class DocumentAnnotationTypeRepository(dict):
         self.doc = doc
         self._idCount = 0
         self._idDict = {}
+        # _idLabelCounts records, for each annotation label, how many
+        # of the registered IDs belong to annotations of that label.
+        # The writers consult it so they don't have to scan every
+        # annotation to find out whether the type needs an ID column.
+        # It may overcount (e.g., annotations which were removed
+        # without removing their IDs), but it never undercounts.
+        self._idLabelCounts = {}
+        # The inverse ID dict maps an ID to the (annot, attrName, aggregation)
+        # triples which point to it. It's built the first time it's needed,
+        # and after that, it's maintained incrementally: attribute changes
+        # mark the pointing annotation as stale in _staleReferrers, and the
+        # entries for the stale annotations are fixed up the next time the
+        # dict is consulted. _forwardIdDict records, for each (annot, attrName),
+        # the IDs we've recorded, so we can take them back out.
         self._inverseIdDict = None
+        self._forwardIdDict = None
+        self._staleReferrers = {}
         self.globalTypeRepository = globalTypeRepository
         self.forceUnlocked = False
 
@@ -1178,22 +1202,45 @@ class DocumentAnnotationTypeRepository(dict):
             # Isn't an integer.
             pass
         self._idDict[aID] = annot
+        self._noteIDAdded(annot)
+
+    def _noteIDAdded(self, annot):
+        lab = annot.atype.lab
+        self._idLabelCounts[lab] = self._idLabelCounts.get(lab, 0) + 1
+
+    # Returns False only if no annotation of the label can have an ID.
+
+    def _labelMayHaveIDs(self, lab):
+        return self._idLabelCounts.get(lab, 0) > 0
 
     def _registerAnnotationReference(self, annot):
+        # Make sure the annotation pointed to has an ID. The inverse
+        # ID dict is updated when the pointing annotation reports the change.
         annot.getID()
-        # Don't record the inverse ID in inverseIDdict.
-        # Just make sure that we know it's stale.
-        self._inverseIdDict = None
+
+    def _annotationReferenceChanged(self, annot, attrObj):
+        # Needs to be done when an annotation-valued attribute is set,
+        # cleared or modified. If the inverse ID dict hasn't been built,
+        # there's nothing to update.
+        if self._inverseIdDict is not None:
+            try:
+                self._staleReferrers[annot].add(attrObj)
+            except KeyError:
+                self._staleReferrers[annot] = set([attrObj])
 
     def _clearIDReferences(self):
-        # Needs to be done when an annotation-valued attribute is None.
+        # Needs to be done when we can't tell which annotation's
+        # references have changed. The whole dict will be rebuilt.
         self._inverseIdDict = None
+        self._forwardIdDict = None
+        self._staleReferrers = {}
 
     def _generateID(self, annot):
         i = self._idCount
         self._idCount += 1
         aID = str(i)
         self._idDict[aID] = annot
+        self._noteIDAdded(annot)
         return aID
 
     def getAnnotationByID(self, aID):
@@ -1204,27 +1251,64 @@ class DocumentAnnotationTypeRepository(dict):
     # the annotation ID itself, we have to undo anything
     # it points to.
 
+    def _recordReferences(self, annot, attrObj, attr):
+        if isinstance(attr, AnnotationCore):
+            entry = (annot, attrObj.name, None)
+            ids = [attr.id]
+        elif isinstance(attr, AttributeValueSequence) and attr.ofDocAndAttribute and \
+             isinstance(attr.ofDocAndAttribute[1], AnnotationAttributeType):
+            entry = (annot, attrObj.name, attrObj.aggregation)
+            ids = [subval.id for subval in attr]
+        else:
+            return
+        d = self._inverseIdDict
+        for aID in ids:
+            try:
+                d[aID].add(entry)
+            except KeyError:
+                d[aID] = set([entry])
+        self._forwardIdDict[(annot, attrObj.name)] = (entry, ids)
+
+    def _forgetReferences(self, annot, attrObj):
+        try:
+            entry, ids = self._forwardIdDict.pop((annot, attrObj.name))
+        except KeyError:
+            return
+        d = self._inverseIdDict
+        for aID in ids:
+            try:
+                refs = d[aID]
+            except KeyError:
+                # The annotation pointed to may have been removed already,
+                # or it's pointed to by the same annotation twice.
+                continue
+            refs.discard(entry)
+            if not refs:
+                del d[aID]
+
     def _buildInverseIdDict(self):
         if self._inverseIdDict is None:
-            d = {}
-            self._inverseIdDict = d
-            for atype, annots in self.doc.atypeDict.items():
+            self._inverseIdDict = {}
+            self._forwardIdDict = {}
+            self._staleReferrers = {}
+            # Only look up the annotations for the types which
+            # can point, so we don't create any lazy annotations.
+            for atype in self.doc.atypeDict.keys():
                 if atype.hasAnnotationValuedAttributes:                    
-                    for annot in annots:
+                    for annot in self.doc.atypeDict[atype]:
                         for attrObj, attr in zip(annot.atype.attr_list, annot.attrs):
-                            if isinstance(attr, AnnotationCore):
-                                try:
-                                    d[attr.id].add((annot, attrObj.name, None))
-                                except KeyError:
-                                    d[attr.id] = set([(annot, attrObj.name, None)])
-                            elif isinstance(attr, AttributeValueSequence) and attr.ofDocAndAttribute and \
-                                 isinstance(attr.ofDocAndAttribute[1], AnnotationAttributeType):
-                                for subval in attr:
-                                    try:
-                                        d[subval.id].add((annot, attrObj.name, attrObj.aggregation))
-                                    except KeyError:
-                                        d[subval.id] = set([(annot, attrObj.name, attrObj.aggregation)])
-    
+                            self._recordReferences(annot, attrObj, attr)
+        elif self._staleReferrers:
+            # Only redo the references from the annotations which
+            # have changed.
+            for annot, attrObjs in self._staleReferrers.items():
+                for attrObj in attrObjs:
+                    self._forgetReferences(annot, attrObj)
+                    i = annot.atype.attr_table[attrObj.name]
+                    if i < len(annot.attrs):
+                        self._recordReferences(annot, attrObj, annot.attrs[i])
+            self._staleReferrers = {}
+
     def removeAnnotationIDs(self, aGroup, forceDetach = False):
         self._buildInverseIdDict()
         externalPointers = set()
@@ -1247,39 +1331,35 @@ class DocumentAnnotationTypeRepository(dict):
                         v.remove(annotPointedTo)
             else:
                 raise AnnotationError, "a group of annotations to be removed can't be pointed at by annotations outside the group"
+        # Any detaching we did has to be reflected before we
+        # start removing entries.
+        self._buildInverseIdDict()
         for a in aGroup:            
             if a.id is not None:
                 aID = a.id
                 try:
                     del self._idDict[aID]
+                    self._idLabelCounts[a.atype.lab] -= 1
                 except:
                     pass
                 try:
                     del self._inverseIdDict[aID]
                 except:
                     pass
-            for attrObj, attr in zip(a.atype.attr_list, a.attrs):
-                if isinstance(attr, AnnotationCore):
-                    # This update is worth doing "live", rather than just
-                    # removing the dict and forcing a rebuild.
-                    # A sequence of removes() will be more efficient then.
-                    try:
-                        self._inverseIdDict[attr.id].remove((a, attrObj.name, None))
-                    except KeyError:
-                        # Perhaps it's pointed to by the same annotation
-                        # twice. In that case, it may already have been removed.
-                        pass
-                elif isinstance(attr, AttributeValueSequence) and attr.ofDocAndAttribute and \
-                     isinstance(attr.ofDocAndAttribute[1], AnnotationAttributeType):
-                    for subval in attr:
-                        try:
-                            self._inverseIdDict[subval.id].remove((a, attrObj.name, attrObj.aggregation))
-                        except KeyError:
-                            pass
+            # This update is done "live", rather than just
+            # removing the dict and forcing a rebuild, so the cost
+            # is proportional to the size of the group.
+            if a.atype.hasAnnotationValuedAttributes:
+                for attrObj in a.atype.attr_list:
+                    if attrObj._clearValue:
+                        self._forgetReferences(a, attrObj)
                         
     def clear(self):
         self._idDict = {}
+        self._idLabelCounts = {}
         self._inverseIdDict = None
+        self._forwardIdDict = None
+        self._staleReferrers = {}
         self._idCount = 0
         
     def recordEffectiveLabel(self, val, attr, trueLabel, eName):
@@ -1298,7 +1378,15 @@ class DocumentAnnotationTypeRepository(dict):
 # the annotation, or the name. We keep a record
 # of both. Ditto with the attributes.
 
-class AnnotationCore:
+# Token annotations vastly outnumber everything else in a tokenized
+# document, so the annotation classes use __slots__ rather than a per-instance
+# __dict__. That means that you can't hang arbitrary attributes off an
+# annotation anymore; if you need to, subclass it.
+
+class AnnotationCore(object):
+
+    __slots__ = ("doc", "id", "atype", "attrs")
+
     def __init__(self, doc, lab, attrs = None):
         self.doc = doc
         self.id = None
@@ -1342,15 +1430,19 @@ class AnnotationCore:
     
     def _setAttrList(self, attrs):
         i = 0
-        if self.attrs:
-            self.doc.atypeRepository._clearIDReferences()
         while i < len(attrs):
             v = attrs[i]
             if v is not None:
                 if not self.atype.attr_list[i]._checkAndImportValue(self.doc, v):
                     raise AnnotationError, ("value of attribute '%s' must be a %s" % (self.atype.attr_list[i].name, self.atype.attr_list[i]._typename_))
+                if isinstance(v, AttributeValueSequence):
+                    v.ofAnnotation = self
             i += 1
         self.attrs = attrs
+        if self.atype.hasAnnotationValuedAttributes:
+            for attrObj in self.atype.attr_list:
+                if attrObj._clearValue:
+                    attrObj._clearValue(self.doc, self)
 
     def _computeAttributeType(self, v):
         if isinstance(v, AttributeValueSequence):
@@ -1419,13 +1511,22 @@ class AnnotationCore:
             if v is not None:
                 if not atp._checkAndImportValue(self.doc, v):
                     raise AnnotationError, ("candidate value %s of attribute '%s' must be a %s and meet the other requirements" % (str(v), atp.name, atp._typename_))
-            elif (len(self.attrs) > k) and (self.attrs[k] is not None) and atp._clearValue:
-                atp._clearValue(self.doc)
-        elif v is not None:
-            # attrIsNew, and the types are checked. But I need to do _importValue in this case.
+        else:
             atp = self.atype.attr_list[k]
-            atp._importValue(self.doc, v)
+            if v is not None:
+                # attrIsNew, and the types are checked. But I need to do _importValue in this case.
+                atp._importValue(self.doc, v)
         self.attrs[k] = v
+        # Let anything which caches information about the annotations
+        # of this type in the document know something's changed.
+        annots = self.doc.atypeDict._getRaw(self.atype)
+        if annots is not None:
+            annots._version += 1
+        if isinstance(v, AttributeValueSequence):
+            v.ofAnnotation = self
+        if atp._clearValue:
+            # Let the document know this annotation's references have changed.
+            atp._clearValue(self.doc, self)
     
     def __getitem__(self, k):
         if type(k) is IntType:
@@ -1510,6 +1611,8 @@ class AnnotationCore:
 
 class SpanlessAnnotation(AnnotationCore):
 
+    __slots__ = ()
+
     def copy(self, doc = None, atype = None, attrs = None, copyID = True, **kw):
         if (doc is not None) and (atype is None):
             raise AnnotationError, "Can't specify new doc for annotation without new atype"
@@ -1536,6 +1639,8 @@ class SpanlessAnnotation(AnnotationCore):
 
 class Annotation(AnnotationCore):
 
+    __slots__ = ("start", "end")
+
     def __init__(self, doc, start, end, lab, attrs = None):
         self.start = start
         self.end = end
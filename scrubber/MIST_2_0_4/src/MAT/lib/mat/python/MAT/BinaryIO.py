@@ -0,0 +1,302 @@
+# Copyright (C) 2009 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# Binary reader/writer.
+
+# MAT-JSON has to be reparsed from text every time a document is
+# opened, and for tokens, which are most of the annotations, that's
+# almost all of the work. In "mat-bin", the signal is stored as UTF-8,
+# and each annotation type has its start and end offsets stored as
+# columns of 32-bit ints, followed by its IDs (if it has any) and a
+# column for each attribute. The reader memory-maps the file and
+# only looks at the sections it needs; the offset columns of types with
+# no IDs and no attributes are copied straight into lazy annotations
+# (see AnnotationList in Document.py), so those annotations aren't
+# created until someone touches them.
+
+# The layout is:
+
+# "MATBIN", then the format version (2 bytes) and the header length
+#   (4 bytes), little-endian
+# the header, as JSON: {"metadata": ..., "length": <length of the sections>,
+#   "signal": <section>, "asets": [...]}
+#   where each aset is {"type": ..., "hasSpan": ..., "hasID": ..., "attrs": [...],
+#   "count": ..., "starts": <section>, "ends": <section>, "ids": <section>,
+#   "columns": [<section>, ...]}, and "attrs" is as in MAT-JSON
+# the sections.
+
+# A section is [offset, length], where the offset is relative to the
+# end of the header. The offset columns are little-endian 32-bit ints;
+# the IDs and the attribute columns are JSON lists, with the values
+# rendered exactly as MAT-JSON renders them. The reader checks the
+# sections against the length and the counts, so a truncated or
+# damaged file is a LoadError rather than a short document.
+
+import sys, os, struct, mmap
+from array import array
+
+from MAT.DocumentIO import declareDocumentIO, JSONDocumentIO, _SpanRows, \
+     getDocumentIO, _sourceCompression, _compressionFromSuffix, _openCompressed, \
+     _annotsHaveIDs, SaveError
+from MAT.Document import LoadError, MappedSignal
+from MAT import json
+
+_MAGIC = "MATBIN"
+_VERSION = 1
+_PREFIX = struct.Struct("<HI")
+_HEADER_START = len(_MAGIC) + _PREFIX.size
+
+def _packOffsets(offsets):
+    a = array('i', offsets)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tostring()
+
+def _unpackOffsets(s):
+    a = array('i')
+    a.fromstring(s)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+# An mmap which the reader should leave the signal in.
+
+class _MappedInput:
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __getitem__(self, key):
+        return self.buf[key]
+
+    def __len__(self):
+        return len(self.buf)
+
+# We inherit from the JSON IO so we can share the way it renders
+# attribute values, and the way it creates annotations from rows.
+
+class BinaryDocumentIO(JSONDocumentIO):
+
+    #
+    # Reading
+    #
+
+    # If mapSignal is True, the signal is a MappedSignal over
+    # the signal section of the file, and the mmap stays open
+    # as long as the signal is around.
+    
+    def readFromSource(self, source, sourceName = None, mapSignal = False, **kw):
+        if hasattr(source, "readline"):
+            return self.readFromByteSequence(source.read(), **kw)
+        elif source == "-":
+            return self.readFromByteSequence(sys.stdin.read(), **kw)
+        compression = _sourceCompression(source)
+        if compression is not None:
+            return self._readFromCompressedFile(source, compression, **kw)
+        fp = open(source, "rb")
+        try:
+            if os.fstat(fp.fileno()).st_size == 0:
+                raise LoadError, "input doesn't appear to be a MAT binary document"
+            m = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        if mapSignal:
+            return self.readFromByteSequence(_MappedInput(m), **kw)
+        try:
+            return self.readFromByteSequence(m, **kw)
+        finally:
+            m.close()
+
+    # A compressed file can't be mapped, of course.
+
+    def _readFromCompressedFile(self, path, compression, **kw):
+        fp = _openCompressed(path, compression, "r")
+        try:
+            try:
+                s = fp.read()
+            except IOError, e:
+                raise LoadError, ("Error decompressing " + path + ": " + str(e))
+        finally:
+            fp.close()
+        return self.readFromByteSequence(s, **kw)
+
+    # s may be a string, an mmap, or a _MappedInput.
+
+    def readFromByteSequence(self, s, encoding = None, **kw):
+        return self._readDocument(s, **kw)
+
+    def readFromUnicodeString(self, s, **kw):
+        raise LoadError, "MAT binary documents can't be read from Unicode strings"
+
+    def deserialize(self, s, annotDoc):
+        if s[:len(_MAGIC)] != _MAGIC:
+            raise LoadError, "input doesn't appear to be a MAT binary document"
+        if len(s) < _HEADER_START:
+            raise LoadError, "MAT binary document is corrupted"
+        version, headerLength = _PREFIX.unpack(s[len(_MAGIC):_HEADER_START])
+        if version > _VERSION:
+            raise LoadError, ("MAT binary document version is later than version %d" % _VERSION)
+        base = _HEADER_START + headerLength
+        try:
+            header = json.loads(s[_HEADER_START:base])
+        except ValueError:
+            raise LoadError, "MAT binary document header is corrupted"
+        try:
+            self._deserializeSections(s, base, header, annotDoc)
+        except (ValueError, TypeError, KeyError, IndexError, struct.error):
+            raise LoadError, "MAT binary document is corrupted"
+
+    def _deserializeSections(self, s, base, header, annotDoc):
+        total = header["length"]
+        if base + total > len(s):
+            raise LoadError, "MAT binary document is corrupted"
+
+        def bounds(loc):
+            start, length = loc
+            if start < 0 or length < 0 or start + length > total:
+                raise LoadError, "MAT binary document is corrupted"
+            return base + start, base + start + length
+
+        def section(loc):
+            start, end = bounds(loc)
+            return s[start:end]
+
+        def column(loc, count, isOffsets = False):
+            if isOffsets:
+                c = _unpackOffsets(section(loc))
+            else:
+                c = json.loads(section(loc))
+                if type(c) is not list:
+                    raise LoadError, "MAT binary document is corrupted"
+            if len(c) != count:
+                raise LoadError, "MAT binary document is corrupted"
+            return c
+
+        if isinstance(s, _MappedInput):
+            sigStart, sigEnd = bounds(header["signal"])
+            signal = MappedSignal(s.buf, sigStart, sigEnd)
+        else:
+            signal = section(header["signal"]).decode("utf-8")
+        self._deserializeHeader({"signal": signal, "metadata": header["metadata"]}, annotDoc)
+        annotMap = {}
+        aPairs = []
+        for aD in header["asets"]:
+            hasSpan = aD["hasSpan"]
+            hasID = aD["hasID"]
+            count = aD["count"]
+            adir = {"type": aD["type"], "hasSpan": hasSpan, "hasID": hasID, "attrs": aD["attrs"]}
+            columns = []
+            if hasSpan:
+                columns = [column(aD["starts"], count, True), column(aD["ends"], count, True)]
+            if hasSpan and (not hasID) and (not aD["attrs"]):
+                adir["annots"] = _SpanRows(columns[0], columns[1])
+            else:
+                if hasID:
+                    columns.append(column(aD["ids"], count))
+                for loc in aD["columns"]:
+                    columns.append(column(loc, count))
+                if columns:
+                    adir["annots"] = zip(*columns)
+                else:
+                    adir["annots"] = [()] * count
+            self._deserializeAnnotationSet(adir, annotDoc, annotMap, aPairs)
+        self._deserializeAnnotationValues(aPairs)
+
+    #
+    # Writing
+    #
+
+    def writeToTarget(self, annotDoc, target):
+        closeIt = False
+        if hasattr(target, "writelines"):
+            fp = target
+        elif target == "-":
+            fp = sys.stdout
+        elif _compressionFromSuffix(target) is not None:
+            fp = _openCompressed(target, _compressionFromSuffix(target), "w", self.compressionLevel)
+            closeIt = True
+        else:
+            fp = open(target, "wb")
+            closeIt = True
+        try:
+            if self.convertor:
+                annotDoc = self.convertor.perhapsConvert(annotDoc)
+            fp.write(self.writeToByteSequence(annotDoc))
+            fp.flush()
+        finally:
+            if closeIt:
+                fp.close()
+
+    def writeToUnicodeString(self, annotDoc):
+        raise SaveError, "MAT binary documents can't be written as Unicode strings"
+
+    def writeToByteSequence(self, annotDoc, encoding = None):
+        sections = []
+        # A list, so the closure can update it.
+        length = [0]
+        def addSection(s):
+            loc = [length[0], len(s)]
+            sections.append(s)
+            length[0] += len(s)
+            return loc
+
+        header = {"metadata": annotDoc.metadata,
+                  "signal": addSection(annotDoc.signal.encode("utf-8")),
+                  "asets": []}
+        for aType, annots in annotDoc.atypeDict._rawItems():
+            # See renderJSONObj().
+            lazySpans = None
+            if annots._lazy is not None:
+                if aType.hasDefaults:
+                    annots._materialize()
+                else:
+                    lazySpans = annots._getLazySpans()
+            hasSpan = aType.hasSpan
+            hasID = (lazySpans is None) and _annotsHaveIDs(annotDoc, aType, annots)
+            attrList = aType.attr_list
+            aD = {"type": aType.lab,
+                  "hasSpan": hasSpan,
+                  "hasID": hasID,
+                  "attrs": self._renderAttrDescriptions(attrList),
+                  "columns": []}
+            if lazySpans is not None:
+                aD["count"] = len(lazySpans[0])
+                aD["starts"] = addSection(_packOffsets(lazySpans[0]))
+                aD["ends"] = addSection(_packOffsets(lazySpans[1]))
+            else:
+                aD["count"] = len(annots)
+                if hasSpan:
+                    aD["starts"] = addSection(_packOffsets([a.start for a in annots]))
+                    aD["ends"] = addSection(_packOffsets([a.end for a in annots]))
+                if hasID:
+                    aD["ids"] = addSection(json.dumps([a.id for a in annots]))
+                i = 0
+                for meth in self._attrRenderers(attrList):
+                    col = []
+                    for a in annots:
+                        if i < len(a.attrs):
+                            col.append(meth(a.attrs[i]))
+                        else:
+                            col.append(None)
+                    aD["columns"].append(addSection(json.dumps(col)))
+                    i += 1
+            header["asets"].append(aD)
+        header["length"] = length[0]
+        header = json.dumps(header)
+        return _MAGIC + _PREFIX.pack(_VERSION, len(header)) + header + "".join(sections)
+
+declareDocumentIO("mat-bin", BinaryDocumentIO, True, True)
+
+#
+# Converters
+#
+
+# These do no task-specific conversion; they just change the format.
+
+def convertJSONToBinary(jsonSource, binTarget, task = None):
+    d = getDocumentIO("mat-json", task = task).readFromSource(jsonSource)
+    getDocumentIO("mat-bin", task = task).writeToTarget(d, binTarget)
+
+def convertBinaryToJSON(binSource, jsonTarget, task = None):
+    d = getDocumentIO("mat-bin", task = task).readFromSource(binSource)
+    getDocumentIO("mat-json", task = task).writeToTarget(d, jsonTarget)
@@ -1360,12 +1360,17 @@ def brokerAnnotations(incomingDocs, docProcessor,
             docMap = {}
             for d in origDocs:
                 signalIntervals = intervalExtractor(d)
-                subDocs = [d.copy(removeAnnotationTypes = removeOnInput, signalInterval = s) for s in signalIntervals]
+                subDocs = d.split(signalIntervals, removeAnnotationTypes = removeOnInput)
                 incomingDocs += subDocs
                 docMap[d] = (signalIntervals, subDocs)
         else:
-            # The doc that gets processed should be a copy.
-            incomingDocs = [d.copy(removeAnnotationTypes = removeOnInput) for d in incomingDocs]
+            # The doc that gets processed shouldn't be the original, but
+            # it doesn't need to be a copy, either; the processors write
+            # it out and read their results back into it, and a view
+            # detaches from the original when it's read into.
+            from MAT.Document import FilteredDocView
+            incomingDocs = [FilteredDocView(d, removeAnnotationTypes = removeOnInput)
+                            for d in incomingDocs]
             docMap = dict(zip(origDocs, incomingDocs))
     docProcessor(incomingDocs)
     # OK, they're done.
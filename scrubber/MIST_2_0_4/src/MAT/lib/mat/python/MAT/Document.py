@@ -1,7 +1,7 @@
 # Copyright (C) 2007 - 2009 The MITRE Corporation. See the toplevel
 # file LICENSE for license terms.
 
-import sys
+import sys, codecs
 
 import Command
 
@@ -23,6 +23,604 @@ class DumpError(Exception):
 class DocumentError(Exception):
     pass
 
+#
+# Annotation lists and the interval index
+#
+
+# Each value in atypeDict is an AnnotationList, which knows how to
+# keep a sorted index of its annotations up to date. The index is built
+# lazily the first time someone asks for ordered annotations or
+# for an interval query, and after that, appending annotations in start order
+# and removing annotations maintain it in place; anything else just
+# discards it. The one thing we can't see is someone changing the
+# start or end of an annotation which is already in the document. If you do
+# that, you MUST call _clearAnnotationIndex() on the document afterward.
+
+from bisect import bisect_left, bisect_right
+from operator import attrgetter
+from array import array
+
+_startKey = attrgetter("start")
+_endKey = attrgetter("end")
+
+# NumPy isn't required. But if it's available, we use it to look up
+# offsets in boundary arrays in bulk.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Returns a list of booleans, one for each offset, which is True if the
+# offset is one of the sortedBoundaries (an array('i')).
+
+def _findBoundaries(sortedBoundaries, offsets):
+    n = len(sortedBoundaries)
+    if n == 0:
+        return [False] * len(offsets)
+    if numpy is not None:
+        b = numpy.frombuffer(sortedBoundaries, dtype = numpy.intc)
+        o = numpy.array(offsets, dtype = numpy.intc)
+        idx = numpy.minimum(numpy.searchsorted(b, o), n - 1)
+        return (b[idx] == o).tolist()
+    res = []
+    for o in offsets:
+        i = bisect_left(sortedBoundaries, o)
+        res.append((i < n) and (sortedBoundaries[i] == o))
+    return res
+
+# Merges ordered segment spans into regions. Each time we find a segment which
+# is an extension of the previous region, ignore the new segment and extend
+# the region, unless it would take us past the current zone. Returns a list of
+# [start, end, zoneIndex]. zoneEnds is an ordered array of zone ends, or None.
+
+def _mergeSegmentSpans(segStarts, segEnds, zoneEnds):
+    regionList = []
+    currentRegion = None
+    currentZoneIndex = None
+    if zoneEnds:
+        currentZoneIndex = 0
+    for start, end in zip(segStarts, segEnds):
+        if currentRegion and (currentRegion[1] == start) and \
+           ((currentZoneIndex is None) or (zoneEnds[currentZoneIndex] <= end)):
+            currentRegion[1] = end
+        else:
+            # Try to move forward.
+            if currentZoneIndex is not None:
+                while start >= zoneEnds[currentZoneIndex]:
+                    currentZoneIndex += 1
+                    if currentZoneIndex == len(zoneEnds):
+                        currentZoneIndex = None
+                        break
+            currentRegion = [start, end, currentZoneIndex]
+            regionList.append(currentRegion)
+    return regionList
+
+class AnnotationIndex:
+
+    # The annotations are sorted by start, stably, so that annotations
+    # with the same start remain in the order they were added; this is
+    # the order getAnnotations(ordered = True) has always produced.
+    # The starts and ends are kept in parallel columns of machine
+    # integers, which are much smaller than lists of Python ints, and
+    # which the queries can scan without touching the annotations.
+    # maxLength is an upper bound on the length of any annotation in
+    # the index, which lets the overlap query bound its search to the left.
+
+    def __init__(self, annots):
+        self.annots = sorted(annots, key = _startKey)
+        self.starts = array('i', [a.start for a in self.annots])
+        self.ends = array('i', [a.end for a in self.annots])
+        self.maxLength = 0
+        for a in self.annots:
+            if a.end - a.start > self.maxLength:
+                self.maxLength = a.end - a.start
+
+    # Returns False if the annotation can't be added without re-sorting.
+
+    def _add(self, a):
+        if self.starts and (a.start < self.starts[-1]):
+            return False
+        self.annots.append(a)
+        self.starts.append(a.start)
+        self.ends.append(a.end)
+        if a.end - a.start > self.maxLength:
+            self.maxLength = a.end - a.start
+        return True
+
+    def _remove(self, a):
+        i = bisect_left(self.starts, a.start)
+        while (i < len(self.starts)) and (self.starts[i] == a.start):
+            if self.annots[i] is a:
+                del self.annots[i]
+                del self.starts[i]
+                del self.ends[i]
+                return True
+            i += 1
+        return False
+
+    # Removes all the annotations in aSet in a single pass. The annotations
+    # which remain are still in order; maxLength is still an upper bound.
+
+    def _removeGroup(self, aSet):
+        keep = [i for i in range(len(self.annots)) if self.annots[i] not in aSet]
+        starts = self.starts
+        ends = self.ends
+        self.annots = [self.annots[i] for i in keep]
+        self.starts = array('i', [starts[i] for i in keep])
+        self.ends = array('i', [ends[i] for i in keep])
+
+    # All annotations which share at least one character with [start, end).
+
+    def overlapping(self, start, end):
+        annots = self.annots
+        ends = self.ends
+        lo = bisect_right(self.starts, start - self.maxLength)
+        hi = bisect_left(self.starts, end)
+        return [annots[i] for i in range(lo, hi) if ends[i] > start]
+
+    # All annotations which fall entirely within [start, end].
+
+    def containedIn(self, start, end):
+        annots = self.annots
+        ends = self.ends
+        lo = bisect_left(self.starts, start)
+        hi = bisect_right(self.starts, end)
+        return [annots[i] for i in range(lo, hi) if ends[i] <= end]
+
+    # The first annotation which starts at or after the offset, or None.
+
+    def firstAtOrAfter(self, offset):
+        i = bisect_left(self.starts, offset)
+        if i < len(self.annots):
+            return self.annots[i]
+        return None
+
+# An AnnotationList can also be lazy: instead of annotation objects, it holds
+# a pair of start/end arrays for annotations which have no attributes and
+# no IDs, which is what tokens almost always look like. Nothing can point to
+# these annotations, so we can postpone creating them until someone actually
+# asks for them. The AnnotationListDict never hands out a lazy list; anything which
+# asks the dictionary for a list gets the real annotations. Code which knows how to
+# handle lazy lists (reading, writing, copying, importing, getAnnotationSpans)
+# uses _getRaw() and friends to look at the arrays directly.
+
+class AnnotationList(list):
+
+    def __init__(self, *args, **kw):
+        list.__init__(self, *args, **kw)
+        self._index = None
+        # Either None, or [doc, atype, starts, ends].
+        self._lazy = None
+        # Incremented whenever the list, or anything about the annotations
+        # in it, changes (as far as we can tell; see the comment above about
+        # starts and ends). Anything which caches information computed
+        # from the list can compare versions.
+        self._version = 0
+
+    def _getIndex(self):
+        if self._lazy is not None:
+            self._materialize()
+        if self._index is None:
+            self._index = AnnotationIndex(self)
+        return self._index
+
+    def _addLazySpans(self, doc, atype, starts, ends):
+        self._version += 1
+        if list.__len__(self) > 0:
+            # There are already real annotations here, so
+            # these have to be real too.
+            for s, e in zip(starts, ends):
+                self.append(Annotation(doc, s, e, atype))
+        elif self._lazy is None:
+            self._lazy = [doc, atype, array('i', starts), array('i', ends)]
+        else:
+            self._lazy[2].extend(array('i', starts))
+            self._lazy[3].extend(array('i', ends))
+
+    def _materialize(self):
+        if self._lazy is not None:
+            doc, atype, starts, ends = self._lazy
+            self._lazy = None
+            self._index = None
+            list.extend(self, [Annotation(doc, s, e, atype) for s, e in zip(starts, ends)])
+
+    # The number of annotations, real or not.
+
+    def _size(self):
+        if self._lazy is not None:
+            return len(self._lazy[2])
+        return list.__len__(self)
+
+    # Returns the start and end arrays of the lazy annotations,
+    # ordered by start (stably, like everything else).
+
+    def _getLazySpans(self):
+        doc, atype, starts, ends = self._lazy
+        i = 1
+        while i < len(starts):
+            if starts[i] < starts[i - 1]:
+                order = sorted(range(len(starts)), key = starts.__getitem__)
+                self._lazy[2] = starts = array('i', [starts[j] for j in order])
+                self._lazy[3] = ends = array('i', [ends[j] for j in order])
+                break
+            i += 1
+        return starts, ends
+
+    def _clearIndex(self):
+        self._index = None
+        self._version += 1
+
+    # Removes all the annotations in aSet (which should be a set, or
+    # something else with fast membership) with a single pass over the list,
+    # rather than a pass per annotation. Lazy annotations can't
+    # be in aSet, since no one has them.
+
+    def _removeGroup(self, aSet):
+        if self._lazy is not None:
+            return
+        kept = [a for a in self if a not in aSet]
+        if len(kept) < list.__len__(self):
+            self._version += 1
+            list.__setslice__(self, 0, list.__len__(self), kept)
+            if self._index is not None:
+                self._index._removeGroup(aSet)
+
+    # __setitem__, __setslice__, __delitem__, __delslice__
+    # append, extend, insert, pop, remove, __iadd__, sort, reverse.
+    # sort and reverse change the list order, not the index order,
+    # but we clear the index anyway, to be safe.
+
+    def __setitem__(self, key, value):
+        self._index = None
+        self._version += 1
+        return list.__setitem__(self, key, value)
+
+    def __setslice__(self, i, j, sequence):
+        self._index = None
+        self._version += 1
+        return list.__setslice__(self, i, j, sequence)
+
+    def __delitem__(self, key):
+        self._index = None
+        self._version += 1
+        return list.__delitem__(self, key)
+
+    def __delslice__(self, i, j):
+        self._index = None
+        self._version += 1
+        return list.__delslice__(self, i, j)
+
+    def append(self, a):
+        self._version += 1
+        if (self._index is not None) and (not self._index._add(a)):
+            self._index = None
+        return list.append(self, a)
+
+    def extend(self, annots):
+        self._version += 1
+        if self._index is not None:
+            annots = list(annots)
+            for a in annots:
+                if not self._index._add(a):
+                    self._index = None
+                    break
+        return list.extend(self, annots)
+
+    def __iadd__(self, annots):
+        self.extend(annots)
+        return self
+
+    def insert(self, i, a):
+        self._index = None
+        self._version += 1
+        return list.insert(self, i, a)
+
+    def pop(self, *args):
+        a = list.pop(self, *args)
+        self._version += 1
+        if (self._index is not None) and (not self._index._remove(a)):
+            self._index = None
+        return a
+
+    def remove(self, a):
+        list.remove(self, a)
+        self._version += 1
+        if (self._index is not None) and (not self._index._remove(a)):
+            self._index = None
+
+    def sort(self, *args, **kw):
+        self._index = None
+        self._version += 1
+        return list.sort(self, *args, **kw)
+
+    def reverse(self):
+        self._index = None
+        self._version += 1
+        return list.reverse(self)
+
+# And this makes sure that whatever's assigned into atypeDict
+# is an AnnotationList, and that whatever comes out of it isn't lazy.
+
+class AnnotationListDict(dict):
+
+    def __init__(self, doc = None):
+        dict.__init__(self)
+        self.doc = doc
+
+    def __setitem__(self, atype, annots):
+        if not isinstance(annots, AnnotationList):
+            annots = AnnotationList(annots)
+        # If we're throwing away a list of annotations which can point
+        # to other annotations (e.g., truncation), the document's inverse
+        # ID dictionary can't be updated incrementally.
+        if (self.doc is not None) and atype.hasAnnotationValuedAttributes and dict.has_key(self, atype):
+            self.doc.atypeRepository._clearIDReferences()
+        return dict.__setitem__(self, atype, annots)
+
+    def __getitem__(self, atype):
+        annots = dict.__getitem__(self, atype)
+        if annots._lazy is not None:
+            annots._materialize()
+        return annots
+
+    def get(self, atype, default = None):
+        try:
+            return self[atype]
+        except KeyError:
+            return default
+
+    def pop(self, atype, *args):
+        annots = dict.pop(self, atype, *args)
+        if isinstance(annots, AnnotationList):
+            annots._materialize()
+        return annots
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def itervalues(self):
+        for k in self.keys():
+            yield self[k]
+
+    def iteritems(self):
+        for k in self.keys():
+            yield k, self[k]
+
+    def update(self, *args, **kw):
+        for k, v in dict(*args, **kw).items():
+            self[k] = v
+
+    def setdefault(self, atype, annots = None):
+        if not self.has_key(atype):
+            self[atype] = annots or []
+        return self[atype]
+
+    # These don't materialize.
+
+    def _getRaw(self, atype, default = None):
+        return dict.get(self, atype, default)
+
+    def _rawItems(self):
+        return dict.items(self)
+
+#
+# Overlap policies for removeOverlaps()
+#
+
+# Each policy is called with two overlapping annotations, the one which
+# is currently being kept and a challenger which starts no earlier, and
+# returns a pair: whether the challenger wins, and the reason the winner won
+# ("shorter", "earlier", "confidence"), which goes in the report.
+
+# The annotation which starts first wins; if they start at the same
+# place, the shorter one wins. This is what removeOverlaps has always done.
+
+def _earliestWins(cur, challenger):
+    if challenger.start == cur.start:
+        return (challenger.end < cur.end), "shorter"
+    return False, "earlier"
+
+# The shorter annotation wins; if they're the same length,
+# the earlier one wins.
+
+def _shortestWins(cur, challenger):
+    cLen = challenger.end - challenger.start
+    curLen = cur.end - cur.start
+    if cLen == curLen:
+        return False, "earlier"
+    return (cLen < curLen), "shorter"
+
+# The annotation with the higher value of the confidence attribute
+# wins. Annotations without a (numeric) value lose to annotations
+# with one; if neither has one, or they're tied, the earliest wins.
+
+def _confidenceWins(confidenceAttr):
+    def getConfidence(a):
+        try:
+            return float(a.get(confidenceAttr))
+        except (TypeError, ValueError):
+            return None
+    def policy(cur, challenger):
+        curConf = getConfidence(cur)
+        cConf = getConfidence(challenger)
+        if curConf != cConf:
+            if cConf is None:
+                return False, "confidence"
+            elif (curConf is None) or (cConf > curConf):
+                return True, "confidence"
+            else:
+                return False, "confidence"
+        return _earliestWins(cur, challenger)
+    return policy
+
+OVERLAP_POLICIES = {"earliest": _earliestWins,
+                    "shortest": _shortestWins,
+                    "confidence": _confidenceWins("confidence")}
+
+# The cache key for a segment filter in AnnotatedDoc.processableRegions():
+# its code, its defaults and the contents of its closure, or False if
+# any of those isn't a plain value. We don't want to key on objects, both
+# because they can change under us and because the cache would keep
+# them alive.
+
+_PLAIN_TYPES = (type(None), bool, int, long, float, str, unicode)
+
+def _isPlainValue(v):
+    if type(v) is tuple:
+        for x in v:
+            if not _isPlainValue(x):
+                return False
+        return True
+    return type(v) in _PLAIN_TYPES
+
+def _segmentFilterKey(fn):
+    code = getattr(fn, "func_code", None)
+    if code is None:
+        return False
+    vals = fn.func_defaults or ()
+    if fn.func_closure:
+        try:
+            vals = vals + tuple([c.cell_contents for c in fn.func_closure])
+        except ValueError:
+            # An empty cell.
+            return False
+    if not _isPlainValue(vals):
+        return False
+    return (code, vals)
+
+#
+# Memory-mapped signals
+#
+
+# For very large documents (e.g., tens of megabytes of concatenated notes),
+# holding the signal as a Unicode string costs 2 or 4 bytes per character,
+# and it has to be decoded all at once. A MappedSignal is a read-only view of
+# a UTF-8 region of a buffer (usually an mmap), along with an index of the
+# byte offset of every _SIGNAL_BLOCK-th character, so slicing only decodes
+# the blocks it touches. Anything other than len(), indexing, slicing,
+# iteration and encoding to UTF-8 decodes the whole signal, every time (e.g.,
+# regular expression searches need unicode(signal)), so this is only worth
+# it for code which mostly slices, like copying, splitting and writing XML.
+# Documents get these signals only if you ask for them (see
+# DocumentFileIO.readFromSource()).
+
+_SIGNAL_BLOCK = 1024
+_SIGNAL_CHUNK = 1 << 20
+
+class MappedSignal(object):
+
+    def __init__(self, buf, start = 0, end = None):
+        self._buf = buf
+        self._start = start
+        if end is None:
+            end = len(buf)
+        self._end = end
+        self._buildIndex()
+
+    # _offsets[k] is the byte offset of character k * _SIGNAL_BLOCK,
+    # and the last element is the end of the region.
+    
+    def _buildIndex(self):
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        offsets = array('l', [self._start])
+        pending = u""
+        bytePos = self._start
+        nChars = 0
+        pos = self._start
+        while pos < self._end:
+            chunkEnd = min(pos + _SIGNAL_CHUNK, self._end)
+            pending += decoder.decode(self._buf[pos:chunkEnd], chunkEnd == self._end)
+            pos = chunkEnd
+            i = 0
+            while len(pending) - i >= _SIGNAL_BLOCK:
+                bytePos += len(pending[i:i + _SIGNAL_BLOCK].encode("utf-8"))
+                offsets.append(bytePos)
+                i += _SIGNAL_BLOCK
+            nChars += i
+            pending = pending[i:]
+        if offsets[-1] != self._end:
+            offsets.append(self._end)
+        self._offsets = offsets
+        self._len = nChars + len(pending)
+
+    def _slice(self, start, stop):
+        if start >= stop:
+            return u""
+        kStart = start // _SIGNAL_BLOCK
+        kEnd = ((stop - 1) // _SIGNAL_BLOCK) + 1
+        s = self._buf[self._offsets[kStart]:self._offsets[kEnd]].decode("utf-8")
+        base = kStart * _SIGNAL_BLOCK
+        return s[start - base:stop - base]
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._len)
+            if step != 1:
+                return unicode(self)[key]
+            return self._slice(start, stop)
+        if key < 0:
+            key += self._len
+        if (key < 0) or (key >= self._len):
+            raise IndexError, "string index out of range"
+        return self._slice(key, key + 1)
+
+    def __iter__(self):
+        for k in range(len(self._offsets) - 1):
+            for c in self._buf[self._offsets[k]:self._offsets[k + 1]].decode("utf-8"):
+                yield c
+
+    def __unicode__(self):
+        return self._buf[self._start:self._end].decode("utf-8")
+
+    def __str__(self):
+        return unicode(self).encode("ascii")
+
+    def __repr__(self):
+        return "<MappedSignal of %d characters>" % self._len
+
+    def encode(self, encoding = None, errors = "strict"):
+        if (encoding is not None) and (codecs.lookup(encoding).name == "utf-8"):
+            return self._buf[self._start:self._end]
+        return unicode(self).encode(encoding or sys.getdefaultencoding(), errors)
+
+    def __eq__(self, other):
+        if isinstance(other, MappedSignal):
+            return (self._len == other._len) and \
+                   (self._buf[self._start:self._end] == other._buf[other._start:other._end])
+        return unicode(self) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(unicode(self))
+
+    def __add__(self, other):
+        return unicode(self) + other
+
+    def __radd__(self, other):
+        return other + unicode(self)
+
+    def __contains__(self, s):
+        return s in unicode(self)
+
+    # Everything else (find(), split(), ...) goes to the Unicode string.
+    
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError, name
+        return getattr(unicode(self), name)
+
 # The metadata is only used when reading the document in
 # from a file. Otherwise, Python will never see the metadata.
 
@@ -38,18 +636,20 @@ class AnnotatedDoc:
         # records to work here - it can't be global because we have
         # potential threading issues with Web services.
         self.atypeRepository = DocumentAnnotationTypeRepository(self, globalTypeRepository = globalTypeRepository)
-        self.atypeDict = {}
+        self.atypeDict = AnnotationListDict(self)
         self.anameDict = self.atypeRepository
         self.signal = ""
         self.metadata = {}
+        # See processableRegions().
+        self._regionCache = {}
 
         if signal is not None:
-            if type(signal) is not type(u''):
+            if (type(signal) is not type(u'')) and (not isinstance(signal, MappedSignal)):
                 raise LoadError, "signal must be Unicode"
             self.signal = signal
 
     def truncate(self):
-        self.atypeDict = {}
+        self.atypeDict = AnnotationListDict(self)
         self.anameDict.clear()
 
     # We have to unlock the repository, AND the atypes
@@ -95,6 +695,23 @@ class AnnotatedDoc:
             self._addAnnotation(a)
         return a
 
+    # Spanned annotations with no attributes and no IDs (i.e., tokens) can be
+    # added as a pair of start and end offset sequences. They won't become
+    # real annotations until someone asks for them. See AnnotationList.
+
+    def createLazyAnnotations(self, atype, starts, ends):
+        if type(atype) in (str, unicode):
+            atype = self.findAnnotationType(atype)
+        if not atype.hasSpan:
+            raise DocumentError, "Can't create lazy spanless annotations"
+        if len(starts) != len(ends):
+            raise DocumentError, "Lazy annotation starts and ends must be the same length"
+        annots = self.atypeDict._getRaw(atype)
+        if annots is None:
+            annots = AnnotationList()
+            self.atypeDict[atype] = annots
+        annots._addLazySpans(self, atype, starts, ends)
+
     # now only to be used in special cases.
     
     def _addAnnotation(self, a):
@@ -119,12 +736,19 @@ class AnnotatedDoc:
     
     def removeAnnotationGroup(self, aGroup, forceDetach = False):
         self.atypeRepository.removeAnnotationIDs(aGroup, forceDetach = forceDetach)
+        # Removing the annotations one at a time costs a pass over
+        # the list for each annotation. So collect them by type,
+        # and filter each list once.
+        aSets = {}
         for a in aGroup:
-            if self.atypeDict.has_key(a.atype):
-                try:
-                    self.atypeDict[a.atype].remove(a)
-                except ValueError:
-                    pass
+            try:
+                aSets[a.atype].add(a)
+            except KeyError:
+                aSets[a.atype] = set([a])
+        for atype, aSet in aSets.items():
+            annots = self.atypeDict._getRaw(atype)
+            if annots is not None:
+                annots._removeGroup(aSet)
 
     # At one point, I had a pure copy, but it doesn't make
     # any sense in the context of the system. So we now have
@@ -151,17 +775,22 @@ class AnnotatedDoc:
                 atypeMap[a.atype] = [a]
         return self._importAnnotations(atypeMap)
 
+    # Lazy annotations are imported lazily, which means that they
+    # won't appear in the result map.
+    
     def importAnnotations(self, sourceDocument, atypes = None, offset = 0):
         if atypes is None:
-            atypeMap = sourceDocument.atypeDict
+            atypeMap = dict(sourceDocument.atypeDict._rawItems())
         else:
             atypeMap = {}
             for a in atypes:
                 try:
-                    atypeMap[sourceDocument.anameDict[a]] = sourceDocument.atypeDict[sourceDocument.anameDict[a]]
+                    annots = sourceDocument.atypeDict._getRaw(sourceDocument.anameDict[a])
                 except KeyError:
                     # There may not be any of them.
-                    pass
+                    continue
+                if annots is not None:
+                    atypeMap[sourceDocument.anameDict[a]] = annots
         return self._importAnnotations(atypeMap, offset = offset)
         
     # This list is UNORDERED.
@@ -214,15 +843,21 @@ class AnnotatedDoc:
                 except KeyError:
                     # There may not be any of them.
                     pass
+        # We will have already checked for spanless. If we're
+        # ordering, use the sorted annotations from the index; the
+        # sort below is stable and just merges the already-sorted runs.
+        if ordered:
+            annotList = [annots._getIndex().annots for annots in annotList]
         if len(annotList) == 1:
             allAnnots = annotList[0][:]
         elif annotList:
-            allAnnots = reduce(lambda x, y: x + y, annotList)
+            allAnnots = []
+            for annots in annotList:
+                allAnnots += annots
+            if ordered:
+                allAnnots.sort(key = _startKey)
         else:
             allAnnots = []
-        # We will have already checked for spanless.
-        if ordered:
-            allAnnots.sort(cmp, lambda x: x.start)
         if strict:
             lastEnd = None
             for a in allAnnots:
@@ -243,58 +878,191 @@ class AnnotatedDoc:
     def orderAnnotations(self, atypes = None, strict = False):
         return self.getAnnotations(atypes = atypes, strict = strict, ordered = True)
 
+    # These use the sorted index. Like orderAnnotations(), they only
+    # return spanned annotations, and the results are ordered by start.
+
+    def _getAnnotationIndexes(self, atypes):
+        if atypes is None:
+            atypes = self.anameDict.values()
+        else:
+            atypes = [self.anameDict[a] for a in atypes if self.anameDict.has_key(a)]
+        return [self.atypeDict[atype]._getIndex() for atype in atypes
+                if atype.hasSpan and self.atypeDict.has_key(atype)]
+
+    def _mergeIndexResults(self, results):
+        if len(results) == 1:
+            return results[0]
+        allAnnots = []
+        for r in results:
+            allAnnots += r
+        allAnnots.sort(key = _startKey)
+        return allAnnots
+
+    # All annotations which share at least one character with [start, end).
+
+    def getAnnotationsOverlapping(self, start, end, atypes = None):
+        return self._mergeIndexResults([idx.overlapping(start, end)
+                                        for idx in self._getAnnotationIndexes(atypes)])
+
+    # All annotations which fall entirely within [start, end].
+
+    def getAnnotationsContainedIn(self, start, end, atypes = None):
+        return self._mergeIndexResults([idx.containedIn(start, end)
+                                        for idx in self._getAnnotationIndexes(atypes)])
+
+    # The first annotation which starts at or after the offset, or None.
+    # If there are several types and several candidates with the same start,
+    # the earliest type in atypes wins. Typically, you'd use this
+    # to find the next token.
+
+    def getFirstAnnotationAtOrAfter(self, offset, atypes = None):
+        best = None
+        for idx in self._getAnnotationIndexes(atypes):
+            a = idx.firstAtOrAfter(offset)
+            if (a is not None) and ((best is None) or (a.start < best.start)):
+                best = a
+        return best
+
+    # If you change the start or end of annotations which are
+    # already in the document, you have to call this.
+
+    def _clearAnnotationIndex(self, atypes = None):
+        if atypes is None:
+            for annots in self.atypeDict.values():
+                annots._clearIndex()
+        else:
+            for a in atypes:
+                try:
+                    self.atypeDict[self.anameDict[a]]._clearIndex()
+                except KeyError:
+                    pass
+
     def hasAnnotations(self, atypes):
         for a in atypes:
             if self.anameDict.has_key(a):
-                if self.atypeDict.get(self.anameDict[a]):
+                annots = self.atypeDict._getRaw(self.anameDict[a])
+                if (annots is not None) and (annots._size() > 0):
                     return True
         return False
 
+    # The start and end offsets of the annotations of the given types,
+    # as two arrays, in the same order as orderAnnotations() would return the
+    # annotations. This doesn't create any lazy annotations, so it's the thing
+    # to use when all you need are token boundaries.
+
+    def getAnnotationSpans(self, atypes = None):
+        if atypes is None:
+            atypes = self.anameDict.values()
+        else:
+            atypes = [self.anameDict[a] for a in atypes if self.anameDict.has_key(a)]
+        runs = []
+        for atype in atypes:
+            if not atype.hasSpan:
+                continue
+            annots = self.atypeDict._getRaw(atype)
+            if annots is None:
+                continue
+            if annots._lazy is not None:
+                runs.append(annots._getLazySpans())
+            else:
+                idx = annots._getIndex()
+                runs.append((idx.starts, idx.ends))
+        if len(runs) == 1:
+            return array('i', runs[0][0]), array('i', runs[0][1])
+        starts = array('i')
+        ends = array('i')
+        for s, e in runs:
+            starts.extend(s)
+            ends.extend(e)
+        if len(runs) > 1:
+            order = sorted(range(len(starts)), key = starts.__getitem__)
+            starts = array('i', [starts[i] for i in order])
+            ends = array('i', [ends[i] for i in order])
+        return starts, ends
+
     # Copying the document should import the global type repository.
     def copy(self, removeAnnotationTypes = None, signalInterval = None):
-        # First, copy the signal.
         if signalInterval:
-            newStart, newEnd = signalInterval
-            newD = AnnotatedDoc(self.signal[newStart:newEnd])
-        else:
-            newStart = 0
-            newD = AnnotatedDoc(self.signal)
+            return self.split([signalInterval], removeAnnotationTypes = removeAnnotationTypes)[0]
+        # First, copy the signal.
+        newD = AnnotatedDoc(self.signal)
         # Next, copy the metadata. This has to be a RECURSIVE copy.
         newD.metadata = self._recursiveCopy(self.metadata)
         # Now, import the annotation types.
         newAtypes = newD.atypeRepository.importAnnotationTypes(self, removeAnnotationTypes = removeAnnotationTypes)
-        # Now, the annotations. If there's a signal interval,
-        # we need to exclude all annotations which are outside the
-        # interval. Ditto any annotations in removeAnnotationTypes.
+        # Now, the annotations. Exclude any annotations in removeAnnotationTypes.
         # And since we know we've copied the atypes, we can use the actual
         # lists of attributes.
-        # If we're filtering annotations, or grabbing a signal interval, we have to 
+        # If we're filtering annotations, we have to 
         # ensure that the annotations which are going to be copied
         # don't refer to annotations outside the set. Otherwise, we don't
         # need to check. So, collect all the old ones first.
-        # Also, if we're taking an interval, none of the annotations
-        # to be copied can be spanless.
         annotMap = {}
         justCreated = set(newAtypes)       
         for atype in newAtypes:
-            if signalInterval and (not atype.hasSpan):
-                raise DocumentError, "Can't copy with a filtered signal and spanless annotations"
             # These are the already filtered atypes.
             if self.anameDict.has_key(atype.lab) and \
                self.atypeDict.has_key(self.anameDict[atype.lab]):
                 oldAtype = self.anameDict[atype.lab]
-                # If there are any annotations to copy:
-                if signalInterval is None:
-                    annotMap[oldAtype] = self.atypeDict[oldAtype]
-                else:
-                    annotMap[oldAtype] = [a for a in self.atypeDict[self.anameDict[atype.lab]]
-                                          if (a.start >= newStart) and (a.end <= newEnd)]
+                annotMap[oldAtype] = self.atypeDict._getRaw(oldAtype)
         newD._importAnnotations(annotMap, justCreated = justCreated,
-                                failOnReferenceCheck = removeAnnotationTypes or signalInterval,
-                                copyIDs = True,
-                                offset = -newStart)
+                                failOnReferenceCheck = removeAnnotationTypes,
+                                copyIDs = True)
         return newD
 
+    # Copy the document into a sequence of documents, one for each
+    # (start, end) signal interval. Each new document contains only the
+    # annotations which fall entirely inside its interval, offset to its
+    # own signal. None of the annotations can be spanless, and none of the
+    # annotations which are copied can point to annotations which aren't.
+    # This uses the sorted index for each type, so each interval costs
+    # a couple of binary searches plus the annotations it actually contains,
+    # rather than a scan of the whole document.
+
+    def split(self, intervals, removeAnnotationTypes = None):
+        sources = None
+        newDocs = []
+        for newStart, newEnd in intervals:
+            newD = AnnotatedDoc(self.signal[newStart:newEnd])
+            # Next, copy the metadata. This has to be a RECURSIVE copy.
+            newD.metadata = self._recursiveCopy(self.metadata)
+            # Now, import the annotation types.
+            newAtypes = newD.atypeRepository.importAnnotationTypes(self, removeAnnotationTypes = removeAnnotationTypes)
+            if sources is None:
+                # The first time through, collect the sorted sources.
+                sources = {}
+                for atype in newAtypes:
+                    if not atype.hasSpan:
+                        raise DocumentError, "Can't copy with a filtered signal and spanless annotations"
+                    if self.anameDict.has_key(atype.lab):
+                        oldAtype = self.anameDict[atype.lab]
+                        annots = self.atypeDict._getRaw(oldAtype)
+                        if annots is None:
+                            continue
+                        elif annots._lazy is not None:
+                            sources[oldAtype] = (True,) + annots._getLazySpans()
+                        else:
+                            sources[oldAtype] = (False, annots._getIndex())
+            annotMap = {}
+            for oldAtype, source in sources.items():
+                if source[0]:
+                    # Filter the lazy annotations without creating them.
+                    starts, ends = source[1], source[2]
+                    lo = bisect_left(starts, newStart)
+                    hi = bisect_right(starts, newEnd)
+                    keep = [i for i in range(lo, hi) if ends[i] <= newEnd]
+                    annotMap[oldAtype] = lazyAnnots = AnnotationList()
+                    lazyAnnots._addLazySpans(self, oldAtype, [starts[i] for i in keep],
+                                             [ends[i] for i in keep])
+                else:
+                    annotMap[oldAtype] = source[1].containedIn(newStart, newEnd)
+            newD._importAnnotations(annotMap, justCreated = set(newAtypes),
+                                    failOnReferenceCheck = True,
+                                    copyIDs = True,
+                                    offset = -newStart)
+            newDocs.append(newD)
+        return newDocs
+
     # I'm going to have this return a mapping from the old annotations to
     # the new. I'm going to need this when I create the comparison documents.
     
@@ -337,6 +1105,19 @@ class AnnotatedDoc:
                 for t in sourceAtype.attr_list:
                     atype.importAttribute(t)
                 useSequenceMethod = False
+            if isinstance(sourceAnnots, AnnotationList) and (sourceAnnots._lazy is not None):
+                # These have no attributes and no IDs, and nothing can
+                # point to them, so if the target doesn't already have real
+                # annotations of this type, we can just copy the offsets.
+                targetAnnots = self.atypeDict._getRaw(atype)
+                if (targetAnnots is None) or (targetAnnots._lazy is not None) or (not targetAnnots):
+                    starts, ends = sourceAnnots._getLazySpans()
+                    if offset:
+                        starts = [st + offset for st in starts]
+                        ends = [e + offset for e in ends]
+                    self.createLazyAnnotations(atype, starts, ends)
+                    continue
+                sourceAnnots._materialize()
             # So now, we have the new atype.
             # copyID is True when we're copying documents, not when we're
             # importing annotations elsewhere. I'm PRETTY sure that the default
@@ -434,17 +1215,20 @@ class AnnotatedDoc:
 
     def removeAnnotations(self, atypes = None):
         if atypes is None:
-            self.atypeDict = {}
+            self.atypeDict = AnnotationListDict(self)
             self.anameDict.clear()
         else:
             aGroup = []
             for atype in atypes:
                 try:
                     atypeObj = self.anameDict[atype]
-                    annots = self.atypeDict[atypeObj]
-                    aGroup += annots
                 except KeyError:
-                    pass
+                    continue
+                # Lazy annotations can't have IDs, so there's no
+                # need to create them just to remove them.
+                annots = self.atypeDict._getRaw(atypeObj)
+                if annots is not None:
+                    aGroup += annots
             # Remove the annotation IDs as a bundle, to make
             # sure they're not externally referenced.
             self.atypeRepository.removeAnnotationIDs(aGroup)
@@ -478,10 +1262,33 @@ class AnnotatedDoc:
         # by a task which didn't have the token annotation listed, and then you add the
         # token annotation, bad things will happen.
         contentAnnots = self.orderAnnotations(task.getAnnotationTypesByCategory('content'))[:]
-        lexAnnots = self.orderAnnotations(task.getAnnotationTypesByCategory('token'))
+        # We only need the token boundaries, so don't create the tokens. The
+        # lexes below are indices into these arrays.
+        lexStarts, lexEnds = self.getAnnotationSpans(task.getAnnotationTypesByCategory('token'))
 
         lexAnnotIndex = 0
-        maxLex = len(lexAnnots)
+        maxLex = len(lexStarts)
+
+        # The tokens almost never overlap, in which case the ends are
+        # ordered too, and we can find the tokens we're looking for
+        # by bisection rather than walking through them.
+        endsSorted = True
+        for j in range(1, maxLex):
+            if lexEnds[j] < lexEnds[j - 1]:
+                endsSorted = False
+                break
+
+        # The index of the first token at or after lo which ends after offset
+        # (or at or after offset, if inclusive is True), or maxLex.
+        
+        def firstLexEndingAfter(offset, lo, inclusive = False):
+            if inclusive:
+                offset -= 1
+            if endsSorted:
+                return bisect_right(lexEnds, offset, lo)
+            while (lo < maxLex) and (lexEnds[lo] <= offset):
+                lo += 1
+            return lo
 
         # And to complicate matters, it's possible that the adjustment
         # might lead to overlapping annotations, if entities abut each
@@ -512,16 +1319,15 @@ class AnnotatedDoc:
         annotationsToDelete = []
 
         # Let's do this in a couple stages, since I want to use this code to
-        # diagnose as well as to repair. So first, we take all the lexes
-        # and we generate start and end tables.
+        # diagnose as well as to repair. So first, we look up all the
+        # annotation boundaries among the token boundaries at once.
 
-        tStartMap = {}
-        tEndMap = {}
-        j = 0
-        for t in lexAnnots:
-            tStartMap[t.start] = j
-            tEndMap[t.end] = j
-            j += 1
+        if endsSorted:
+            sortedLexEnds = lexEnds
+        else:
+            sortedLexEnds = array('i', sorted(lexEnds))
+        startAligned = _findBoundaries(lexStarts, [a.start for a in contentAnnots])
+        endAligned = _findBoundaries(sortedLexEnds, [a.end for a in contentAnnots])
 
         badAnnots = []
 
@@ -540,7 +1346,7 @@ class AnnotatedDoc:
         
         for cIndex in range(len(contentAnnots)):
             cAnnot = contentAnnots[cIndex]
-            if not (tStartMap.has_key(cAnnot.start) and tEndMap.has_key(cAnnot.end)):
+            if not (startAligned[cIndex] and endAligned[cIndex]):
                 if (not doPrompt) or \
                    presentPrompt("Annotation %s from %d to %d does not align with token boundaries. Repair? (y/n) " % (cAnnot.atype.lab, cAnnot.start, cAnnot.end)):
                     badAnnots.append(cAnnot)
@@ -576,13 +1382,15 @@ class AnnotatedDoc:
                     iEnd = cAnnot.end + 30
                     if iEnd > len(self.signal):
                         iEnd = len(self.signal)
-                    while iStart < iEnd:
-                        if tStartMap.has_key(iStart):
-                            lex = lexAnnots[tStartMap[iStart]]
-                            print ("%d - %d" % (lex.start, lex.end)),
-                            import sys
-                            sys.stdout.flush()
-                        iStart += 1
+                    lo = bisect_left(lexStarts, iStart)
+                    hi = bisect_left(lexStarts, iEnd)
+                    for lex in range(lo, hi):
+                        # If more than one token starts here, show the last one.
+                        if (lex + 1 < hi) and (lexStarts[lex + 1] == lexStarts[lex]):
+                            continue
+                        print ("%d - %d" % (lexStarts[lex], lexEnds[lex])),
+                        import sys
+                        sys.stdout.flush()
                     print
 
         # Now, we have all the ones we should repair.
@@ -599,19 +1407,19 @@ class AnnotatedDoc:
             # (1) digest all tokens which are completely before the annotation.
             # The annotations are in start index order, so that should work.
                         
-            while True:
-                if lexAnnotIndex >= maxLex:
-                    # Oops, we ran out of lexes before we reached
-                    # the annotation. Remove it.
-                    if doReport:
-                        print "Ran out of lexes before %s from %d to %d" % (cAnnot, cAnnot.start, cAnnot.end)
-                    annotationsToDelete.append(cAnnot)
-                    break
-                curLex = lexAnnots[lexAnnotIndex]
-                if curLex.end > cAnnot.start:
-                    # Encroaching.
-                    break
-                lexAnnotIndex += 1
+            j = firstLexEndingAfter(cAnnot.start, lexAnnotIndex)
+            if j < maxLex:
+                # Encroaching.
+                curLex = j
+            elif lexAnnotIndex < maxLex:
+                curLex = maxLex - 1
+            lexAnnotIndex = j
+            if lexAnnotIndex >= maxLex:
+                # Oops, we ran out of lexes before we reached
+                # the annotation. Remove it.
+                if doReport:
+                    print "Ran out of lexes before %s from %d to %d" % (cAnnot, cAnnot.start, cAnnot.end)
+                annotationsToDelete.append(cAnnot)
 
             # OK, now we've advanced lexAnnotIndex up to where we
             # need it.
@@ -622,14 +1430,14 @@ class AnnotatedDoc:
             # If the annotation precedes all tokens, we have to be careful
             # not to just shift it onto the existing token.
 
-            if curLex.start >= cAnnot.end:
+            if lexStarts[curLex] >= cAnnot.end:
                 # Delete the annotation.
                 if doReport:
                     print "First available lex (%d - %d) >= end of %s from %d to %d; deleting" % \
-                          (curLex.start, curLex.end, cAnnot.atype.lab, cAnnot.start, cAnnot.end)
+                          (lexStarts[curLex], lexEnds[curLex], cAnnot.atype.lab, cAnnot.start, cAnnot.end)
                 annotationsToDelete.append(cAnnot)
                 continue
-            elif curLex.start < cAnnot.start:
+            elif lexStarts[curLex] < cAnnot.start:
                 # Lex spans annotation start. Adjust left if it's not less than a newly created right
                 # edge, otherwise adjust right.
                 foundNewlyCreated = False
@@ -639,40 +1447,40 @@ class AnnotatedDoc:
                             print "Ran out of lexes before %s from %d to %d" % (cAnnot, cAnnot.start, cAnnot.end)
                         annotationsToDelete.append(cAnnot)
                     else:
-                        nextLex = lexAnnots[lexAnnotIndex + 1]
+                        nextLex = lexAnnotIndex + 1
                         if doReport:
                             print "First available lex (%d - %d) < start of %s from %d to %d; shrinking annot start to avoid previous use of left token" % \
-                                  (nextLex.start, nextLex.end, cAnnot.atype.lab, cAnnot.start, cAnnot.end)
-                        cAnnot.start = nextLex.start
+                                  (lexStarts[nextLex], lexEnds[nextLex], cAnnot.atype.lab, cAnnot.start, cAnnot.end)
+                        cAnnot.start = lexStarts[nextLex]
                 else:
                     if doReport:
                         print "First available lex (%d - %d) < start of %s from %d to %d; expanding annot start" % \
-                              (curLex.start, curLex.end, cAnnot.atype.lab, cAnnot.start, cAnnot.end)
-                    cAnnot.start = curLex.start
-            elif curLex.start > cAnnot.start:
+                              (lexStarts[curLex], lexEnds[curLex], cAnnot.atype.lab, cAnnot.start, cAnnot.end)
+                    cAnnot.start = lexStarts[curLex]
+            elif lexStarts[curLex] > cAnnot.start:
                 # Gap between tokens, or first token starts
                 # after first annotation. Adjust right.
                 if doReport:
                     print "First available lex (%d - %d) > start of %s from %d to %d; shrinking annot start" % \
-                          (curLex.start, curLex.end, cAnnot.atype.lab, cAnnot.start, cAnnot.end)
-                cAnnot.start = curLex.start
+                          (lexStarts[curLex], lexEnds[curLex], cAnnot.atype.lab, cAnnot.start, cAnnot.end)
+                cAnnot.start = lexStarts[curLex]
 
             # (3) Digest tokens entirely within the annotation.
             # Remember, it can be the same lex as the left boundary.
             # We transition to the local index now.
             
-            while True:
-                if localIndex >= maxLex:
-                    # Oops, we ran out of lexes before we
-                    # reached the end of the annotation.
-                    # Use the last lex.
-                    cAnnot.end = curLex.end
-                    break
-                curLex = lexAnnots[localIndex]
-                if curLex.end >= cAnnot.end:
-                    # Encroaching.
-                    break
-                localIndex += 1
+            j = firstLexEndingAfter(cAnnot.end, localIndex, inclusive = True)
+            if j < maxLex:
+                # Encroaching.
+                curLex = j
+            elif localIndex < maxLex:
+                curLex = maxLex - 1
+            localIndex = j
+            if localIndex >= maxLex:
+                # Oops, we ran out of lexes before we
+                # reached the end of the annotation.
+                # Use the last lex.
+                cAnnot.end = lexEnds[curLex]
 
             # (4) Check right edge. Adjust if necessary.
             # Worry about the case where the next annotation
@@ -680,7 +1488,7 @@ class AnnotatedDoc:
             # to do that is to advance the lexAnnotIndex because
             # we've "consumed" the token.
 
-            if curLex.start >= cAnnot.end:
+            if lexStarts[curLex] >= cAnnot.end:
                 # It's possible that the next tokens
                 # starts entirely after the current annotation.
                 # Then we need to shrink the current annotation
@@ -688,26 +1496,31 @@ class AnnotatedDoc:
                 if localIndex > 0:
                     if doReport:
                         print "Last available lex start (%d - %d) > end of %s from %d to %d; shrinking end" % \
-                              (curLex.start, curLex.end, cAnnot.atype.lab, cAnnot.start, cAnnot.end)
-                    cAnnot.end = lexAnnots[localIndex - 1].end
+                              (lexStarts[curLex], lexEnds[curLex], cAnnot.atype.lab, cAnnot.start, cAnnot.end)
+                    cAnnot.end = lexEnds[localIndex - 1]
                 else:
                     # This is the first token. How we got an annotation
                     # which ends after the first token is a mystery,
                     # but out it goes.
                     if doReport:
                         print "Last available lex start (%d - %d) > end of %s from %d to %d, but no preceding lex; deleting" % \
-                              (curLex.start, curLex.end, cAnnot.atype.lab, cAnnot.start, cAnnot.end)
+                              (lexStarts[curLex], lexEnds[curLex], cAnnot.atype.lab, cAnnot.start, cAnnot.end)
                     annotationsToDelete.append(cAnnot)
-            elif curLex.end > cAnnot.end:
+            elif lexEnds[curLex] > cAnnot.end:
                 # If there had been a token which ended
                 # exactly on the annotation boundary, we would
                 # have seen it. So we expand the annotation.
                 if doReport:
                     print "Last available lex end (%d - %d) > end of %s from %d to %d; expanding end" % \
-                          (curLex.start, curLex.end, cAnnot.atype.lab, cAnnot.start, cAnnot.end)
-                cAnnot.end = curLex.end
+                          (lexStarts[curLex], lexEnds[curLex], cAnnot.atype.lab, cAnnot.start, cAnnot.end)
+                cAnnot.end = lexEnds[curLex]
                 usedRightEdgeToks.add(curLex)
 
+        # We've moved the edges of some of the content annotations.
+
+        if badAnnots:
+            self._clearAnnotationIndex(task.getAnnotationTypesByCategory('content'))
+
         # we delete the annotation. Actually, we'd better make sure that the
         # annotations are detached first.
 
@@ -737,55 +1550,69 @@ class AnnotatedDoc:
             iEnd += 1
             c.start += iStart
             c.end += iEnd
-
-    def removeOverlaps(self, collisionList):
-        # Emergency stopgap. Occasionally, we get overlapping
-        # content tags, which we might not want. collisionList
-        # is a list of annotation names which can't have
-        # any overlaps among them.
-        indexDict = {}
+        self._clearAnnotationIndex(task.getAnnotationTypesByCategory('content'))
+
+    # Emergency stopgap. Occasionally, we get overlapping
+    # content tags, which we might not want. collisionList
+    # is a list of annotation names which can't have
+    # any overlaps among them. policy is one of the keys of
+    # OVERLAP_POLICIES, or a function which behaves like one of its values.
+    # "confidence" looks at the attribute named by confidenceAttr.
+    # We sweep through the annotations in order, comparing each one
+    # to the last one we've kept. Returns a list of (discarded, kept, reason)
+    # triples, rather than complaining about each one.
+
+    def removeOverlaps(self, collisionList, policy = "earliest", confidenceAttr = None):
+        if confidenceAttr is not None:
+            if policy != "confidence":
+                raise DocumentError, "confidenceAttr can only be used with the confidence overlap policy"
+            policyFn = _confidenceWins(confidenceAttr)
+        elif callable(policy):
+            policyFn = policy
+        else:
+            try:
+                policyFn = OVERLAP_POLICIES[policy]
+            except KeyError:
+                raise DocumentError, ("unknown overlap policy '%s'" % policy)
+        aTypes = []
         for aName in collisionList:
             try:
                 aType = self.anameDict[aName]
-                annots = self.atypeDict[aType]
             except KeyError:
                 continue
             # Ignore the overlaps for types which aren't spanned,
             # in the unlikely event that someone chooses them.
-            if not aType.hasSpan:
-                continue
-            # Zero it out.
-            self.atypeDict[aType] = []
-            for a in annots:
-                if indexDict.has_key(a.start):
-                    # Take the shortest.
-                    if a.end < indexDict[a.start].end:
-                        print >> sys.stderr, "Warning: discarding %s from %d to %d in favor of shorter overlapping annotation" % (indexDict[a.start].atype.lab, a.start, indexDict[a.start].end)
-                        indexDict[a.start] = a
+            if aType.hasSpan and self.atypeDict.has_key(aType):
+                aTypes.append(aType)
+        if not aTypes:
+            return []
+        kept = []
+        report = []
+        for a in self.orderAnnotations([aType.lab for aType in aTypes]):
+            if kept:
+                cur = kept[-1]
+                # Annotations which start at the same place always collide,
+                # even if they're zero-length.
+                if (a.start < cur.end) or (a.start == cur.start):
+                    challengerWins, reason = policyFn(cur, a)
+                    if challengerWins:
+                        report.append((cur, a, reason))
+                        kept[-1] = a
                     else:
-                        print >> sys.stderr, "Warning: discarding %s from %d to %d in favor of shorter overlapping annotation" % (a.atype.lab, a.start, a.end)
-                else:
-                    indexDict[a.start] = a
-        indexes = indexDict.keys()
-        indexes.sort()
-        end = 0
-        for i in indexes:
-            # There will only be one.
-            annot = indexDict[i]
-            if i < end:
-                # Now, we keep the annotation that's already started.
-                print >> sys.stderr, "Warning: discarding %s from %s to %d in favor of annotation which starts earlier" % (annot.atype.lab, annot.start, annot.end)
-                del indexDict[i]
-            else:
-                end = annot.end
-        # Now, we've removed all the overlapping ones.
-        # Reconstruct the annot sets.
-        indexes = indexDict.keys()
-        indexes.sort()
-        for i in indexes:
-            a = indexDict[i]
-            self.atypeDict[a.atype].append(a)
-        
+                        report.append((a, cur, reason))
+                    continue
+            kept.append(a)
+        if report:
+            # The discarded annotations might have IDs.
+            self.atypeRepository.removeAnnotationIDs([r[0] for r in report], forceDetach = True)
+        # Reconstruct the annot sets, in order.
+        newLists = dict([(aType, []) for aType in aTypes])
+        for a in kept:
+            newLists[a.atype].append(a)
+        for aType, annots in newLists.items():
+            self.atypeDict[aType] = annots
+        return report
+
     # I wanted this to be on the document, rather than the task,
     # because it's a document operation. But I want to call it
     # on bunches of documents.
@@ -794,62 +1621,165 @@ class AnnotatedDoc:
     # return the zone information, so Carafe can't exploit that zone
     # region type as a feature. But we return it anyway.
     
+    # The regions are cached on each document, keyed by the zone info
+    # and the segment filter, and they're recomputed when the SEGMENT or zone
+    # annotation lists change (see AnnotationList._version) or move. Segment
+    # filters are usually defined inline, so they're a new function
+    # each time. So a filter is keyed by its code, plus its defaults and the
+    # values it closes over (e.g., a flag from the caller), as long as they're
+    # plain values (see _segmentFilterKey()); two filters which match that way
+    # share a cache entry. We don't cache anything for other filters, since
+    # they might depend on anything. Callers get a fresh copy of the cached
+    # regions each time.
+
     @classmethod
     def processableRegions(cls, annotSets, task = None, segmentFilterFn = None):
         zType, rAttr, regions = None, None, None
         if task is not None:
             zType, rAttr, regions = task.getTrueZoneInfo()
+        if segmentFilterFn is None:
+            filterKey = None
+        else:
+            filterKey = _segmentFilterKey(segmentFilterFn)
+        if filterKey is False:
+            cacheKey = None
+        else:
+            cacheKey = (zType, rAttr, (regions is not None) and tuple(regions), filterKey)
+        return [d._getProcessableRegions(cacheKey, zType, rAttr, regions, segmentFilterFn)
+                for d in annotSets]
+
+    # What we check to see whether the cached regions are stale: the list
+    # and its version, which _clearAnnotationIndex() changes. Not everyone
+    # who moves an annotation calls it (the scorer tests, e.g., collapse
+    # zones in place), so if the version matches, we also compare the
+    # spans with the columns of the list's index, which building the
+    # regions left behind. That doesn't build anything in Python. If they
+    # don't match, we clear the index, so it's rebuilt with the new spans.
+
+    def _getRegionSourceState(self, lab):
+        if lab is None:
+            return None
+        atype = self.anameDict.get(lab)
+        if atype is None:
+            return None
+        annots = self.atypeDict._getRaw(atype)
+        if annots is None:
+            return None
+        return (annots, annots._version)
+
+    def _regionSourceStateMatches(self, state, cachedState):
+        if (state is None) or (cachedState is None):
+            return state is cachedState
+        if (state[0] is not cachedState[0]) or (state[1] != cachedState[1]):
+            return False
+        annots = state[0]
+        idx = annots._getIndex()
+        if (array('i', map(_startKey, idx.annots)) == idx.starts) and \
+           (array('i', map(_endKey, idx.annots)) == idx.ends):
+            return True
+        annots._clearIndex()
+        return False
 
-        regionLists = []
-        for d in annotSets:
-            segs = d.orderAnnotations(["SEGMENT"])
-            if zType is not None:
-                zones = d.orderAnnotations([zType])
-            else:
-                zones = None
-            # If there's no segment filter function, there's no point
-            # in looking at the segments - just use the zones. Not going to
-            # bother filtering on zones, because the segments wouldn't be
-            # there otherwise.
-            if segs and segmentFilterFn:
-                segs = [seg for seg in segs if segmentFilterFn(seg)]
-                regionList = []
-                # Loop through the segments. Each time we find one which is an
-                # extension of a previous machine-annotatable segment, ignore the
-                # new segment and extend the old.
-                currentDigestibleRegion = None
-                currentSeg = None
-                currentZoneIndex = None
-                if zones:
-                    currentZoneIndex = 0
-                for seg in segs:
-                    if currentDigestibleRegion and (currentDigestibleRegion[1] == seg.start) and \
-                       ((currentZoneIndex is None) or (zones[currentZoneIndex].end <= seg.end)):
-                        currentDigestibleRegion[1] = seg.end
-                    else:
-                        # Try to move forward.
-                        if currentZoneIndex is not None:
-                            while seg.start >= zones[currentZoneIndex].end:
-                                currentZoneIndex += 1
-                                if currentZoneIndex == len(zones):
-                                    currentZoneIndex = None
-                                    break                        
-                        currentDigestibleRegion = [seg.start, seg.end,
-                                                   ((currentZoneIndex is not None) and (rAttr is not None) and \
-                                                    [rAttr, zones[currentZoneIndex].get(rAttr)])
-                                                   or None]
-                        regionList.append(currentDigestibleRegion)
-                regionLists.append(regionList)
-                    
-            elif zones:
-                # Don't filter zones for segments above, but DO filter it here.
-                regionLists.append([[z.start, z.end, ((rAttr is not None) and [rAttr, z.get(rAttr)]) or None]
-                                    for z in zones if (rAttr is None) or (z.get(rAttr) in regions)])
-                
+    def _getProcessableRegions(self, cacheKey, zType, rAttr, regions, segmentFilterFn):
+        segState = self._getRegionSourceState("SEGMENT")
+        zoneState = self._getRegionSourceState(zType)
+        entry = None
+        if cacheKey is not None:
+            try:
+                entry = self._regionCache.get(cacheKey)
+            except TypeError:
+                # Unhashable zone info.
+                cacheKey = None
+        if (entry is None) or (not self._regionSourceStateMatches(segState, entry[0])) or \
+           (not self._regionSourceStateMatches(zoneState, entry[1])):
+            regionList = self._computeProcessableRegions(zType, rAttr, regions, segmentFilterFn)
+            # The check may have cleared an index, which changes the version.
+            entry = (self._getRegionSourceState("SEGMENT"), self._getRegionSourceState(zType), regionList)
+            if cacheKey is not None:
+                self._regionCache[cacheKey] = entry
+        return [[r[0], r[1], r[2] and r[2][:]] for r in entry[2]]
+
+    def _computeProcessableRegions(self, zType, rAttr, regions, segmentFilterFn):
+        segs = self.orderAnnotations(["SEGMENT"])
+        if zType is not None:
+            zones = self.orderAnnotations([zType])
+        else:
+            zones = None
+        # If there's no segment filter function, there's no point
+        # in looking at the segments - just use the zones. Not going to
+        # bother filtering on zones, because the segments wouldn't be
+        # there otherwise.
+        if segs and segmentFilterFn:
+            segs = [seg for seg in segs if segmentFilterFn(seg)]
+            if zones:
+                zoneEnds = array('i', [z.end for z in zones])
             else:
-                # No zoning at all has happened. Just use the whole document.
-                regionLists.append([[0, len(d.signal), None]])
-        return regionLists
+                zoneEnds = None
+            return [[start, end,
+                     ((zIndex is not None) and (rAttr is not None) and [rAttr, zones[zIndex].get(rAttr)])
+                     or None]
+                    for (start, end, zIndex) in
+                    _mergeSegmentSpans(array('i', [seg.start for seg in segs]),
+                                       array('i', [seg.end for seg in segs]),
+                                       zoneEnds)]
+        elif zones:
+            # Don't filter zones for segments above, but DO filter it here.
+            return [[z.start, z.end, ((rAttr is not None) and [rAttr, z.get(rAttr)]) or None]
+                    for z in zones if (rAttr is None) or (z.get(rAttr) in regions)]
+        else:
+            # No zoning at all has happened. Just use the whole document.
+            return [[0, len(self.signal), None]]
+
+#
+# A document which shows another document's annotations, minus the
+# types in removeAnnotationTypes, without copying them. It shares the
+# signal, the metadata, the type repository and the annotation lists
+# with the original, so it's only good for reading (e.g., writing it out)
+# until it's truncated; don't modify it before then. Truncating it (which
+# is what a reader does when it updates a seed document) detaches it from
+# the original, and it becomes an ordinary empty document, which the
+# original never sees. This is how MAT.Command.brokerAnnotations() hands
+# documents to the taggers and tokenizers: the processors write the
+# document out and read their results back into it.
+#
+
+class FilteredDocView(AnnotatedDoc):
+
+    def __init__(self, doc, removeAnnotationTypes = None):
+        AnnotatedDoc.__init__(self, doc.signal)
+        removed = set(removeAnnotationTypes or [])
+        # As in copy(), the annotations we keep can't point to the
+        # ones we don't.
+        if removed:
+            for atype, annots in doc.atypeDict._rawItems():
+                if (atype.lab not in removed) and atype.hasAnnotationValuedAttributes:
+                    for a in annots:
+                        for attr in a.attrs:
+                            if isinstance(attr, AnnotationCore):
+                                if attr.atype.lab in removed:
+                                    raise DocumentError, "Can't copy annotations if they point to annotations which aren't included"
+                            elif isinstance(attr, AttributeValueSequence) and attr.ofDocAndAttribute and \
+                                 isinstance(attr.ofDocAndAttribute[1], AnnotationAttributeType):
+                                for subval in attr:
+                                    if subval.atype.lab in removed:
+                                        raise DocumentError, "Can't copy annotations if they point to annotations which aren't included"
+        self._globalTypeRepository = doc.atypeRepository.globalTypeRepository
+        self.atypeRepository = self.anameDict = doc.atypeRepository
+        # Don't materialize anything.
+        for atype, annots in doc.atypeDict._rawItems():
+            if atype.lab not in removed:
+                dict.__setitem__(self.atypeDict, atype, annots)
+        self.metadata = doc.metadata
+        self._attached = True
+
+    def truncate(self):
+        if self._attached:
+            self._attached = False
+            self.atypeRepository = self.anameDict = \
+                DocumentAnnotationTypeRepository(self, globalTypeRepository = self._globalTypeRepository)
+            self.metadata = {}
+            self._regionCache = {}
+        AnnotatedDoc.truncate(self)
 
 #
 # This is a structure which provides a view into a document, by
@@ -882,22 +1812,40 @@ class SignalCacheEntry:
         self.label = label
         self.category = category        
 
+# The entries in a cache can be provided when it's created, as a
+# list of (eType, entryIndex) pairs which refer to the entries in the
+# DocSliceManager. In that case, we don't create the SignalCacheEntry
+# objects until someone asks for them.
+
 class SignalIndexCache:
 
-    def __init__(self, nth):
+    def __init__(self, nth, manager = None, entryIndexes = None):
         self.nth = nth
-        self.labelMap = {}
+        self._manager = manager
+        self._entryIndexes = entryIndexes
+        self._labelMap = None
+
+    def _getLabelMap(self):
+        if self._labelMap is None:
+            self._labelMap = {}
+            if self._entryIndexes:
+                entries = self._manager._entries
+                for eType, eIndex in self._entryIndexes:
+                    self.addEntry(eType, *entries[eIndex])
+            self._entryIndexes = None
+        return self._labelMap
 
     def addEntry(self, eType, doc, a, label, category):
+        labelMap = self._getLabelMap()
         e = SignalCacheEntry(self, eType, doc, a, label, category)
         try:
-            self.labelMap[(label, category)].append(e)
+            labelMap[(label, category)].append(e)
         except KeyError:
-            self.labelMap[(label, category)] = [e]
+            labelMap[(label, category)] = [e]
 
     def get(self, label = None, category = None):
         r = []
-        for (l, c), entries in self.labelMap.items():
+        for (l, c), entries in self._getLabelMap().items():
             if ((label is None) or (l == label)) and \
                ((category is None) or (c == category)):
                 r += entries
@@ -907,7 +1855,7 @@ class SignalIndexCache:
         # This is the actual entry that comes back from get().
         # So it will be the proper entry in the label map.
         try:
-            self.labelMap[(e.label, e.category)].remove(e)
+            self._getLabelMap()[(e.label, e.category)].remove(e)
         except ValueError:
             pass
         except KeyError:
@@ -917,18 +1865,26 @@ class SignalRegion(SignalIndexCache):
 
     STARTS, ENDS, MATCHES, WITHIN = 0, 1, 2, 3
 
-    def __init__(self, nth, start, end):
+    def __init__(self, nth, start, end, manager = None, entryIndexes = None):
         self.start = start
         self.end = end
-        SignalIndexCache.__init__(self, nth)
+        SignalIndexCache.__init__(self, nth, manager = manager, entryIndexes = entryIndexes)
 
 class SignalIndex(SignalIndexCache):
 
     STARTS, ENDS, CROSSES = 0, 1, 2
 
-    def __init__(self, nth, i):
+    def __init__(self, nth, i, manager = None, entryIndexes = None):
         self.index = i
-        SignalIndexCache.__init__(self, nth)
+        SignalIndexCache.__init__(self, nth, manager = manager, entryIndexes = entryIndexes)
+
+# The manager records each annotation (along with its doc, label and
+# category) as an entry, and keeps the entry starts and ends in parallel
+# arrays. When someone asks for the regions or indexes, we compute the sorted
+# unique breakpoints, and for each breakpoint, the offset lists of the entries
+# which start and end there; then we sweep through the breakpoints, and
+# generate the regions (or indexes) one at a time. So there's never more than
+# one region's worth of cache objects around, unless the caller keeps them.
 
 class DocSliceManager:
 
@@ -948,10 +1904,12 @@ class DocSliceManager:
         # ignore the task table in the document here completely.
         # Gotta start sometime...
         self.docs = []
-        # Intermediate cache.
-        self._indexCache = {}
-        # Final cache. Regions are in order.
-        self.regions = []
+        # The entries are (doc, annot, label, category).
+        self._entries = []
+        self._entryStarts = array('i')
+        self._entryEnds = array('i')
+        # The breakpoints, computed when we need them.
+        self._boundaries = None
         if docs is not None:
             for doc in docs:
                 self.addDocument(doc, (skipTable and skipTable.get(doc)), (keepTable and keepTable.get(doc)))
@@ -966,6 +1924,7 @@ class DocSliceManager:
         if doc in self.docs:
             raise DocSliceError, "document is already in slicer"
         self.docs.append(doc)
+        self._boundaries = None
 
         if skipList:
             skipList = set(skipList)
@@ -1002,112 +1961,97 @@ class DocSliceManager:
                              ((label, None) not in keepList) and \
                              ((None, category) not in keepList)):
                 continue
-            entry = (doc, a, label, category)
-            try:
-                self._indexCache[a.start][0].append(entry)
-            except KeyError:
-                h = [[entry], []]
-                self._indexCache[a.start] = h
-            try:
-                self._indexCache[a.end][1].append(entry)
-            except KeyError:
-                h = [[], [entry]]
-                self._indexCache[a.end] = h                
+            self._entries.append((doc, a, label, category))
+            self._entryStarts.append(a.start)
+            self._entryEnds.append(a.end)
 
+    # Returns the sorted breakpoints, and for each breakpoint, the
+    # indexes of the entries which start there and the ones which end there.
+    
+    def _getBoundaries(self):
+        if self._boundaries is None:
+            breakpoints = sorted(set(self._entryStarts) | set(self._entryEnds))
+            position = dict([(b, k) for (k, b) in enumerate(breakpoints)])
+            startsAt = [[] for b in breakpoints]
+            endsAt = [[] for b in breakpoints]
+            for eIndex in range(len(self._entries)):
+                startsAt[position[self._entryStarts[eIndex]]].append(eIndex)
+                endsAt[position[self._entryEnds[eIndex]]].append(eIndex)
+            self._boundaries = (array('i', breakpoints), startsAt, endsAt)
+        return self._boundaries
+
+    # Both of these are generators.
+    
     def getRegions(self):
-        allIndices = self._indexCache.keys()
-        allIndices.sort()
-        if not allIndices:
-            return []
+        breakpoints, startsAt, endsAt = self._getBoundaries()
         curEntries = set()
         # For each index, if it's not the final index,
         # start a region. The region ends all the annotations
         # that are ending, inherits all the annotations which
         # are underway, and starts all the annotations which
         # are starting.
-        lastIndex = allIndices[-1]
-        firstIndex = allIndices[0]
         justStarted = []
-        previousIndex = -1
-        regions = []
-        j = 0
-        for i in allIndices:
-            [startEntries, endEntries] = self._indexCache[i]
-            if i == lastIndex:
+        lastK = len(breakpoints) - 1
+        for k in range(len(breakpoints)):
+            startEntries = startsAt[k]
+            endEntries = endsAt[k]
+            if k == lastK:
                 if startEntries:
                     raise DocSliceError, "Can't start any annotations on the last index"
-            if i == firstIndex:
+            if k == 0:
                 if endEntries:
                     raise DocSliceError, "Can't end any annotations on the first index"
             else:
                 # At this point, I'm going to close the previous index.
-                r = SignalRegion(j, previousIndex, i)
-                j += 1
-                regions.append(r)
-                for endEntry in endEntries:
-                    if endEntry in justStarted:
-                        r.addEntry(SignalRegion.MATCHES, *endEntry)
+                startedSet = set(justStarted)
+                endSet = set(endEntries)
+                entryIndexes = []
+                for e in endEntries:
+                    if e in startedSet:
+                        entryIndexes.append((SignalRegion.MATCHES, e))
                     else:
-                        r.addEntry(SignalRegion.ENDS, *endEntry)
-                for startEntry in justStarted:
-                    if startEntry not in endEntries:
-                        r.addEntry(SignalRegion.STARTS, *startEntry)
-                for coveringEntry in curEntries:
-                    if (coveringEntry not in justStarted) and (coveringEntry not in endEntries):
-                        r.addEntry(SignalRegion.WITHIN, *coveringEntry)
+                        entryIndexes.append((SignalRegion.ENDS, e))
+                for e in justStarted:
+                    if e not in endSet:
+                        entryIndexes.append((SignalRegion.STARTS, e))
                 # The final trick is the ones which this region is within.
                 # Those are the ones which are still going,
                 # but weren't just started.
+                for e in sorted(curEntries):
+                    if (e not in startedSet) and (e not in endSet):
+                        entryIndexes.append((SignalRegion.WITHIN, e))
+                yield SignalRegion(k - 1, breakpoints[k - 1], breakpoints[k],
+                                   manager = self, entryIndexes = entryIndexes)
             # Cache these for the next interval.
             justStarted = startEntries
-            previousIndex = i
-            curEntries -= set(endEntries)
-            curEntries |= set(startEntries)
+            curEntries.difference_update(endEntries)
+            curEntries.update(startEntries)
         if curEntries:
             raise DocSliceError, "entries remain after all indices are processed"
-        return regions
             
     def getIndexes(self):
-        allIndices = self._indexCache.keys()
-        allIndices.sort()
-        if not allIndices:
-            return []
+        breakpoints, startsAt, endsAt = self._getBoundaries()
         curEntries = set()
-        # For each index, if it's not the final index,
-        # start a region. The region ends all the annotations
-        # that are ending, inherits all the annotations which
-        # are underway, and starts all the annotations which
-        # are starting.
-        lastIndex = allIndices[-1]
-        firstIndex = allIndices[0]
-        previousIndex = -1
-        indexes = []
-        j = 0
-        for i in allIndices:
-            [startEntries, endEntries] = self._indexCache[i]
-            if i == lastIndex:
+        lastK = len(breakpoints) - 1
+        for k in range(len(breakpoints)):
+            startEntries = startsAt[k]
+            endEntries = endsAt[k]
+            if k == lastK:
                 if startEntries:
                     raise DocSliceError, "Can't start any annotations on the last index"
-            if i == firstIndex:
+            if k == 0:
                 if endEntries:
                     raise DocSliceError, "Can't end any annotations on the first index"
             else:
-                # At this point, I'm going to close the previous index.
-                r = SignalIndex(j, i)
-                j += 1
-                indexes.append(r)
-                for endEntry in endEntries:
-                    r.addEntry(SignalIndex.ENDS, *endEntry)
-                for startEntry in startEntries:
-                    r.addEntry(SignalIndex.STARTS, *startEntry)
-                for coveringEntry in curEntries:
-                    if (coveringEntry not in endEntries):
-                        r.addEntry(SignalIndex.CROSSES, *coveringEntry)
-            curEntries -= set(endEntries)
-            curEntries |= set(startEntries)
+                endSet = set(endEntries)
+                entryIndexes = [(SignalIndex.ENDS, e) for e in endEntries] + \
+                               [(SignalIndex.STARTS, e) for e in startEntries] + \
+                               [(SignalIndex.CROSSES, e) for e in sorted(curEntries) if e not in endSet]
+                yield SignalIndex(k - 1, breakpoints[k], manager = self, entryIndexes = entryIndexes)
+            curEntries.difference_update(endEntries)
+            curEntries.update(startEntries)
         if curEntries:
             raise DocSliceError, "entries remain after all indices are processed"
-        return indexes
 
 #
 # AnnotationReporter
@@ -3,7 +3,7 @@
 
 # Readers and writers for documents.
 
-import sys, codecs, re
+import sys, os, codecs, re, array, mmap, gzip, bz2
 
 # I started out with cjson, but it turns out that cjson
 # doesn't decode "\/" correctly. So I've switched to
@@ -70,7 +70,7 @@ class SaveError(Exception):
 # Base class.
 #
 
-from MAT.Operation import OptionBearer, OptionTemplate
+from MAT.Operation import OptionBearer, OptionTemplate, OpArgument
 import MAT.ExecutionContext
 
 class DocumentIO(OptionBearer):
@@ -237,16 +237,143 @@ def registerConvertorInstructionSet(ioName, taskName, cls = None, file = None, x
     else:
         _FILEIO_CONVERTORS[(iocls, taskName)] = lambda: DocumentInstructionSetEngine(instructionSetXML = xml)
 
+#
+# Compression
+#
+
+# Documents in files can be compressed with gzip, bz2 or xz. When
+# we write, the suffix of the target decides; when we read, the suffix
+# of the source decides, and if it doesn't name a compression, we look
+# at the first few bytes. xz needs the lzma module, which isn't in
+# Python 2's standard library, so it's only available if the backport
+# is installed.
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+_COMPRESSION_SUFFIXES = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+# gzip's own default is 9, which is a lot slower than 6 for
+# very little gain on text.
+
+_COMPRESSION_DEFAULT_LEVELS = {"gzip": 6, "bz2": 9, "xz": 6}
+
+# How much we decompress at a time when reading.
+
+_DECOMPRESS_CHUNK = 1 << 20
+
+def _compressionFromSuffix(path):
+    return _COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+def _compressionFromMagic(path):
+    fp = open(path, "rb")
+    try:
+        s = fp.read(10)
+    finally:
+        fp.close()
+    if s[:2] == "\x1f\x8b":
+        return "gzip"
+    # "BZh", the block size, and then either the magic number of
+    # the first block or the magic number of the end of the stream.
+    elif (s[:3] == "BZh") and (s[3:4] in "123456789") and \
+         (s[4:10] in ("1AY&SY", "\x17rE8P\x90")):
+        return "bz2"
+    elif s[:6] == "\xfd7zXZ\x00":
+        return "xz"
+    else:
+        return None
+
+# Returns None if the source isn't compressed.
+
+def _sourceCompression(path):
+    return _compressionFromSuffix(path) or _compressionFromMagic(path)
+
+# Python 2's BZ2File has no flush(), which the writers call.
+
+class _BZ2Writer:
+
+    def __init__(self, path, level):
+        self.fp = open(path, "wb")
+        self.compressor = bz2.BZ2Compressor(level)
+
+    def write(self, s):
+        self.fp.write(self.compressor.compress(s))
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.write(self.compressor.flush())
+        self.fp.close()
+
+# Returns a file object for the bytes. If level is None, use the
+# default level for the compression.
+
+def _openCompressed(path, compression, mode, level = None):
+    if level is None:
+        level = _COMPRESSION_DEFAULT_LEVELS[compression]
+    if compression == "gzip":
+        if mode == "r":
+            return gzip.GzipFile(path, "rb")
+        else:
+            return gzip.GzipFile(path, "wb", level)
+    elif compression == "bz2":
+        if mode == "r":
+            return bz2.BZ2File(path, "r")
+        else:
+            return _BZ2Writer(path, level)
+    elif lzma is None:
+        if mode == "r":
+            raise LoadError, ("can't read xz-compressed file %s: no lzma module available" % path)
+        else:
+            raise SaveError, ("can't write xz-compressed file %s: no lzma module available" % path)
+    elif mode == "r":
+        return lzma.LZMAFile(path, "rb")
+    else:
+        return lzma.LZMAFile(path, "wb", preset = level)
+
+# Decompress and decode a chunk at a time, so that we never have
+# the whole decompressed byte string in memory along with the Unicode.
+
+def _readCompressedUnicode(fp, encoding):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = []
+    while True:
+        b = fp.read(_DECOMPRESS_CHUNK)
+        if not b:
+            break
+        chunks.append(decoder.decode(b))
+    chunks.append(decoder.decode("", True))
+    return u"".join(chunks)
+
+_COMPRESSION_OUTPUT_ARGS = OptionTemplate([OpArgument("compression_level", hasArg = True,
+                                                      help = "If the output file name ends in .gz, .bz2 or .xz, the file is compressed, and this is the compression level, from 1 (fastest) to 9 (smallest). Default is 6 for gzip and xz, 9 for bz2.")],
+                                          heading = "Options for compressed output")
+
 # And now, the convertible class itself.
 
 class DocumentFileIO(DocumentIO):
 
-    def __init__(self, encoding = None, task = None, convertor = None, **kw):
+    def __init__(self, encoding = None, task = None, convertor = None,
+                 compression_level = None, **kw):
         # The command line tool may provide an explicit None
         # as an argument, which is almost never a good thing
         if encoding is None:
             encoding = 'ascii'
         self.encoding = encoding
+        if compression_level is not None:
+            try:
+                compression_level = int(compression_level)
+            except ValueError:
+                raise SaveError, "compression_level must be an integer"
+            if not (1 <= compression_level <= 9):
+                raise SaveError, "compression_level must be between 1 and 9"
+        self.compressionLevel = compression_level
         self.truncateOnUpdate = True
         self.task = task
         self.convertor = convertor
@@ -262,8 +389,21 @@ class DocumentFileIO(DocumentIO):
 
     # We can read from a byte sequence, or from a Unicode string,
     # or from a file. 
+
+    # If mapSignal is True, and the source is a file whose signal can
+    # be memory-mapped (see _readFromMappedFile()), the document's signal
+    # will be a MAT.Document.MappedSignal instead of a Unicode string.
+    # Otherwise, it's ignored.
     
-    def readFromSource(self, source, sourceName = None, **kw):
+    def readFromSource(self, source, sourceName = None, mapSignal = False, **kw):
+        if (not hasattr(source, "readline")) and (source != "-"):
+            compression = _sourceCompression(source)
+            if compression is not None:
+                return self._readFromCompressedFile(source, compression, **kw)
+            if mapSignal:
+                annotDoc = self._readFromMappedFile(source, **kw)
+                if annotDoc is not None:
+                    return annotDoc
         closeIt = False
         if hasattr(source, "readline"):
             # Already a file pointer. If it's been
@@ -297,6 +437,28 @@ class DocumentFileIO(DocumentIO):
                 raise LoadError, "Error loading from source " + str(source) + ": " + eStr
         return annotDoc
 
+    # Children which can memory-map the signal in a file should
+    # return a document here. None means we can't, and the
+    # file will be read the ordinary way.
+
+    def _readFromMappedFile(self, path, **kw):
+        return None
+
+    # The decompression is streamed (see _readCompressedUnicode()).
+    
+    def _readFromCompressedFile(self, path, compression, **kw):
+        fp = _openCompressed(path, compression, "r")
+        try:
+            try:
+                s = _readCompressedUnicode(fp, self.encoding)
+            except UnicodeDecodeError, e:
+                raise LoadError, ("Error loading from source " + path + ": " + self._unicodeErrorString(e, self.encoding))
+            except IOError, e:
+                raise LoadError, ("Error decompressing " + path + ": " + str(e))
+        finally:
+            fp.close()
+        return self.readFromUnicodeString(s, **kw)
+
     # Internal function.
     
     def _unicodeErrorString(self, e, curEncoding):
@@ -322,6 +484,13 @@ class DocumentFileIO(DocumentIO):
                               update = False):
         if type(s) is not type(u''):
             raise LoadError, "input to Unicode deserialization is not Unicode"
+        return self._readDocument(s, seedDocument = seedDocument, taskSeed = taskSeed,
+                                  update = update)
+
+    # s is whatever deserialize() expects. For everything but the
+    # binary format, that's a Unicode string.
+    
+    def _readDocument(self, s, seedDocument = None, taskSeed = None, update = False):
         taskSeed = taskSeed or self.task
         if seedDocument and self.convertor and not (update and self.truncateOnUpdate):
             raise LoadError, "Can't have a convertor and a seed document if you're not truncating"
@@ -406,6 +575,10 @@ class DocumentFileIO(DocumentIO):
             fp = target
         elif target == "-":
             fp = sys.stdout
+        elif _compressionFromSuffix(target) is not None:
+            # No encoding; we'll write the byte sequence.
+            fp = _openCompressed(target, _compressionFromSuffix(target), "w", self.compressionLevel)
+            closeIt = True
         else:
             fp = codecs.open(target, "w", self.encoding)
             closeIt = True
@@ -414,17 +587,28 @@ class DocumentFileIO(DocumentIO):
                 annotDoc = self.convertor.perhapsConvert(annotDoc)
             if fp is sys.stdout:
                 # write to a byte stream, but it's got an encoding.
-                fp.write(self.writeToByteSequence(annotDoc, encoding = fp.encoding))
-            elif fp.encoding is not None:
-                fp.write(self.writeToUnicodeString(annotDoc))
+                self._writeToStream(annotDoc, fp.write, encoding = fp.encoding or self.encoding)
+            elif getattr(fp, "encoding", None) is not None:
+                self._writeToStream(annotDoc, fp.write)
             else:
-                fp.write(self.writeToByteSequence(annotDoc))
+                self._writeToStream(annotDoc, fp.write, encoding = self.encoding)
             fp.flush()
         except UnicodeEncodeError, e:
             raise SaveError, str(e)
         if closeIt:
             fp.close()
 
+    # Children which can produce their output a piece at a time can
+    # override this, so writeToTarget() never holds the whole output.
+    # If encoding is None, write() takes Unicode; otherwise, it takes
+    # bytes in that encoding.
+
+    def _writeToStream(self, annotDoc, write, encoding = None):
+        if encoding is None:
+            write(self.writeToUnicodeString(annotDoc))
+        else:
+            write(self.writeToByteSequence(annotDoc, encoding = encoding))
+
     def writeToByteSequence(self, annotDoc, encoding = None):
         return self.writeToUnicodeString(annotDoc).encode(encoding or self.encoding)
 
@@ -442,6 +626,66 @@ from MAT.Annotation import AnnotationCore, StringAttributeType, \
      AnnotationAttributeType
 from MAT.ReconciliationDocument import ReconciliationDoc
 
+# Support for the compiled JSON renderers. See
+# JSONDocumentIO._compiledAnnotRenderer().
+
+_JSON_RENDERER_CACHE = {}
+
+def _renderIdentity(v):
+    return v
+
+def _renderNone(v):
+    return None
+
+# Whether any of the annotations has an ID. The document's type
+# repository tracks how many IDs each label has, so in the
+# common case (no IDs at all) we don't have to look at the annotations.
+# Otherwise, we scan, because the count can overestimate. Don't use any()
+# here - the list comprehension evaluates everything.
+
+def _annotsHaveIDs(annotDoc, aType, annots):
+    if not annotDoc.atypeRepository._labelMayHaveIDs(aType.lab):
+        return False
+    for a in annots:
+        if a.id is not None:
+            return True
+    return False
+
+# The row is the span (if any), the ID (if any), and then the
+# attribute values. The attrs list may be shorter than the attribute
+# list; it's never longer. Only the columns whose renderer isn't the
+# identity need to be touched after the row is built.
+
+def _compileRowRenderer(hasID, hasSpan, meths):
+    converters = [(i, meth) for (i, meth) in enumerate(meths)
+                  if meth is not _renderIdentity]
+    if hasID and hasSpan:
+        offset = 3
+        rowFn = lambda a: [a.start, a.end, a.id] + a.attrs
+    elif hasID:
+        offset = 1
+        rowFn = lambda a: [a.id] + a.attrs
+    elif hasSpan:
+        offset = 2
+        rowFn = lambda a: [a.start, a.end] + a.attrs
+    else:
+        offset = 0
+        rowFn = lambda a: a.attrs[:]
+    if not converters:
+        return lambda annots: [rowFn(a) for a in annots]
+    converters = [(i + offset, meth) for (i, meth) in converters]
+    def renderer(annots):
+        rows = []
+        for a in annots:
+            row = rowFn(a)
+            rowLen = len(row)
+            for (i, meth) in converters:
+                if i < rowLen:
+                    row[i] = meth(row[i])
+            rows.append(row)
+        return rows
+    return renderer
+
 class JSONDocumentIO(DocumentFileIO):
 
     def __init__(self, encoding = None, legacyWriter = False, **kw):
@@ -453,12 +697,10 @@ class JSONDocumentIO(DocumentFileIO):
         # Never allow the encoding to be changed.
         return DocumentFileIO.readFromByteSequence(self, s, **kw)
 
+    outputArgs = _COMPRESSION_OUTPUT_ARGS
+
     def deserialize(self, s, annotDoc):
-        try:
-            d = json.loads(s)
-        except ValueError:
-            raise LoadError, "input doesn't appear to be JSON"
-        self._deserializeFromJSON(d, annotDoc)
+        _MATJSONStreamReader(self, s, annotDoc).read()
 
     # This is seldom used as a separate function, but the
     # WebClient needs it.
@@ -470,6 +712,20 @@ class JSONDocumentIO(DocumentFileIO):
     # This should happen on decode.
     
     def _deserializeFromJSON(self, d, annotDoc):
+        self._deserializeHeader(d, annotDoc)
+        if d.has_key("asets"):
+            annotMap = {}
+            aPairs = []
+            for adir in d["asets"]:
+                self._deserializeAnnotationSet(adir, annotDoc, annotMap, aPairs)
+            self._deserializeAnnotationValues(aPairs)
+
+    # The stream reader may have set the signal itself before it
+    # saw the metadata, so it tells us what the signal was beforehand.
+    
+    def _deserializeHeader(self, d, annotDoc, priorSignal = None):
+        if priorSignal is None:
+            priorSignal = annotDoc.signal
         # Check for the version. If it's greater than 1, barf.
         version = d.get("version", 1)
         if version > 2:
@@ -481,7 +737,7 @@ class JSONDocumentIO(DocumentFileIO):
         # even though the spec really says it should be.
         if d.has_key("metadata") and d["metadata"].get("reconciliation_doc"):
             if not isinstance(annotDoc, ReconciliationDoc):
-                if annotDoc.signal:
+                if priorSignal:
                     raise LoadError, "Can't turn a previously instantiated doc into a reconciliation document"
                 annotDoc.__class__ = ReconciliationDoc
         try:
@@ -493,117 +749,134 @@ class JSONDocumentIO(DocumentFileIO):
         except KeyError:
             pass
 
+    # adir["annots"] may be a _SpanRows instead of a list,
+    # if the reader found nothing but spans (see the stream reader
+    # below, and BinaryIO).
+    
+    def _deserializeAnnotationSet(self, adir, annotDoc, annotMap, aPairs):
+        
         # Deal with the float thing.
         def make_float(x):
             if (x is not None) and (type(x) is int):
                 return float(x)
             else:
                 return x
-            
-        if d.has_key("asets"):
-            annotMap = {}
-            aPairs = []
-            for adir in d["asets"]:
-                hasSpan = adir.get("hasSpan", True)
-                hasID = adir.get("hasID", False)
-                t = annotDoc.findAnnotationType(adir["type"], hasSpan = hasSpan)
-                
-                # TEMPORARY SHIM.
-                attrIndices = None
-                attrTypes = None
-                annotIndices = None
-                digesters = None
-                annotDigesters = None
-                maybeAnnotVals = False
-                if adir["attrs"]:
-                    attrIndices = []
-                    annotIndices = []
-                    digesters = []
-                    annotDigesters = []
-                    for attr in adir["attrs"]:
-                        if type(attr) in (str, unicode):
-                            tName = attr
-                            tType = tAggr = None
-                        else:
-                            tName = attr["name"]
-                            tType = attr.get("type")
-                            tAggr = attr.get("aggregation")
-                        # When we decode, we have to make sure that
-                        # the attributes are ordered appropriately. They may
-                        # have been defined otherwise for other documents.
-                        # And this will be a threading problem, of course...
-                        # This should no longer be a problem, since the
-                        # annotations are now local to a document.
-                        attrIndex = t.ensureAttribute(tName, aType = tType, aggregation = tAggr)
-                        attrIndices.append(attrIndex)
-                        # We need to deal with the float/int issue here.
-                        if tType == "annotation":
-                            # The IDs are all strings. We need to look
-                            # them up in the annotMap. Eventually.
-                            maybeAnnotVals = True
-                            annotIndices.append(attrIndex)
-                            if tAggr == "list":
-                                digesters.append(lambda x: ((x is not None) and AttributeValueList([annotMap[v] for v in x])) or None)
-                            elif tAggr == "set":
-                                digesters.append(lambda x: ((x is not None) and AttributeValueSet([annotMap[v] for v in x])) or None)
-                            else:
-                                digesters.append(lambda x: ((x is not None) and annotMap[x]) or None)
-                            annotDigesters.append(digesters[-1])
-                        elif tType == "float":
-                            if tAggr == "list":
-                                digesters.append(lambda x: ((x is not None) and AttributeValueList([make_float(v) for v in x])) or None)
-                            elif tAggr == "set":
-                                digesters.append(lambda x: ((x is not None) and AttributeValueSet([make_float(v) for v in x])) or None)
-                            else:
-                                digesters.append(make_float)
-                        elif tAggr == "set":
-                            digesters.append(lambda x: ((x is not None) and AttributeValueSet(x)) or None)
-                        elif tAggr == "list":
-                            digesters.append(lambda x: ((x is not None) and AttributeValueList(x)) or None)
-                        else:
-                            digesters.append(lambda x: x)
-                # Do postponement of creating attributes, just in case
-                # there are annotation-valued attributes. And this has
-                # to be done all the way to the end of the asets loop.
-                for a in adir["annots"]:
-                    aI = 0
-                    if hasSpan:
-                        newAnnot = annotDoc.createAnnotation(a[0], a[1], t, blockAdd = True)
-                        aI = 2
+
+        hasSpan = adir.get("hasSpan", True)
+        hasID = adir.get("hasID", False)
+        t = annotDoc.findAnnotationType(adir["type"], hasSpan = hasSpan)
+        annots = adir["annots"]
+
+        if hasSpan and (not hasID) and (not adir["attrs"]):
+            # No IDs and no attributes - almost certainly tokens. Don't
+            # create the annotations until someone asks for them.
+            if isinstance(annots, _SpanRows):
+                annotDoc.createLazyAnnotations(t, annots.starts, annots.ends)
+            else:
+                annotDoc.createLazyAnnotations(t, [a[0] for a in annots],
+                                               [a[1] for a in annots])
+            return
+
+        # TEMPORARY SHIM.
+        attrIndices = None
+        attrTypes = None
+        annotIndices = None
+        digesters = None
+        annotDigesters = None
+        maybeAnnotVals = False
+        if adir["attrs"]:
+            attrIndices = []
+            annotIndices = []
+            digesters = []
+            annotDigesters = []
+            for attr in adir["attrs"]:
+                if type(attr) in (str, unicode):
+                    tName = attr
+                    tType = tAggr = None
+                else:
+                    tName = attr["name"]
+                    tType = attr.get("type")
+                    tAggr = attr.get("aggregation")
+                # When we decode, we have to make sure that
+                # the attributes are ordered appropriately. They may
+                # have been defined otherwise for other documents.
+                # And this will be a threading problem, of course...
+                # This should no longer be a problem, since the
+                # annotations are now local to a document.
+                attrIndex = t.ensureAttribute(tName, aType = tType, aggregation = tAggr)
+                attrIndices.append(attrIndex)
+                # We need to deal with the float/int issue here.
+                if tType == "annotation":
+                    # The IDs are all strings. We need to look
+                    # them up in the annotMap. Eventually.
+                    maybeAnnotVals = True
+                    annotIndices.append(attrIndex)
+                    if tAggr == "list":
+                        digesters.append(lambda x: ((x is not None) and AttributeValueList([annotMap[v] for v in x])) or None)
+                    elif tAggr == "set":
+                        digesters.append(lambda x: ((x is not None) and AttributeValueSet([annotMap[v] for v in x])) or None)
+                    else:
+                        digesters.append(lambda x: ((x is not None) and annotMap[x]) or None)
+                    annotDigesters.append(digesters[-1])
+                elif tType == "float":
+                    if tAggr == "list":
+                        digesters.append(lambda x: ((x is not None) and AttributeValueList([make_float(v) for v in x])) or None)
+                    elif tAggr == "set":
+                        digesters.append(lambda x: ((x is not None) and AttributeValueSet([make_float(v) for v in x])) or None)
                     else:
-                        newAnnot = annotDoc.createSpanlessAnnotation(t, blockAdd = True)
-                    if hasID:
-                        if a[aI] is not None:
-                            newAnnot.setID(a[aI])
-                            annotMap[a[aI]] = newAnnot
-                        aI += 1
-                    # If you have some attributes, loop through
-                    # all the attr values, and add it at the appropriate
-                    # index. Postpone if there may be annotation-valued attributes.
-                    # Actually, postpone ONLY the annotation-valued attributes themselves;
-                    # otherwise, if you have an annotation with an effective label
-                    # AND annotation-valued attributes, if it's a value of
-                    # some other annotation-valued attribute which expects the
-                    # effective label to be set, you'll be hosed.
-                    if attrIndices is not None:
-                        annotVals = []
-                        i = 0
-                        for val in a[aI:]:
-                            thisIdx = attrIndices[i]
-                            if thisIdx in annotIndices:
-                                annotVals.append(val)
-                            else:
-                                newAnnot[attrIndices[i]] = digesters[i](val)
-                            i += 1
-                        if annotVals:
-                            aPairs.append((newAnnot, annotVals, annotIndices, annotDigesters))
-                    annotDoc._addAnnotation(newAnnot)
-            # And now, this is for the annot values.
-            for newAnnot, attrInput, attrIndices, digesters in aPairs:
+                        digesters.append(make_float)
+                elif tAggr == "set":
+                    digesters.append(lambda x: ((x is not None) and AttributeValueSet(x)) or None)
+                elif tAggr == "list":
+                    digesters.append(lambda x: ((x is not None) and AttributeValueList(x)) or None)
+                else:
+                    digesters.append(lambda x: x)
+        # Do postponement of creating attributes, just in case
+        # there are annotation-valued attributes. And this has
+        # to be done all the way to the end of the asets loop.
+        for a in annots:
+            aI = 0
+            if hasSpan:
+                newAnnot = annotDoc.createAnnotation(a[0], a[1], t, blockAdd = True)
+                aI = 2
+            else:
+                newAnnot = annotDoc.createSpanlessAnnotation(t, blockAdd = True)
+            if hasID:
+                if a[aI] is not None:
+                    newAnnot.setID(a[aI])
+                    annotMap[a[aI]] = newAnnot
+                aI += 1
+            # If you have some attributes, loop through
+            # all the attr values, and add it at the appropriate
+            # index. Postpone if there may be annotation-valued attributes.
+            # Actually, postpone ONLY the annotation-valued attributes themselves;
+            # otherwise, if you have an annotation with an effective label
+            # AND annotation-valued attributes, if it's a value of
+            # some other annotation-valued attribute which expects the
+            # effective label to be set, you'll be hosed.
+            if attrIndices is not None:
+                annotVals = []
                 i = 0
-                for val in attrInput:
-                    newAnnot[attrIndices[i]] = digesters[i](val)
+                for val in a[aI:]:
+                    thisIdx = attrIndices[i]
+                    if thisIdx in annotIndices:
+                        annotVals.append(val)
+                    else:
+                        newAnnot[attrIndices[i]] = digesters[i](val)
                     i += 1
+                if annotVals:
+                    aPairs.append((newAnnot, annotVals, annotIndices, annotDigesters))
+            annotDoc._addAnnotation(newAnnot)
+
+    # And now, this is for the annot values, which have to wait
+    # until all the annotation sets have been read.
+    
+    def _deserializeAnnotationValues(self, aPairs):
+        for newAnnot, attrInput, attrIndices, digesters in aPairs:
+            i = 0
+            for val in attrInput:
+                newAnnot[attrIndices[i]] = digesters[i](val)
+                i += 1
 
     # I need this because of the special role it plays in the Web services.
 
@@ -635,69 +908,99 @@ class JSONDocumentIO(DocumentFileIO):
         else:
             return [a.id for a in v]
     
+    def _renderAttrDescriptions(self, attrList):
+        return [{"name": t.name, "type": t._typename_, "aggregation": t.aggregation}
+                for t in attrList]
+
+    def _attrRenderers(self, attrList):
+        meths = []
+        for attr in attrList:
+            if isinstance(attr, AnnotationAttributeType):
+                if (attr.aggregation is None):
+                    meths.append(self._renderAnnotationSingleValue)
+                else:
+                    meths.append(self._renderAnnotationSequence)
+            elif attr.aggregation is not None:
+                meths.append(self._renderSequence)
+            else:
+                meths.append(_renderIdentity)
+        return meths
+
+    def _legacyAttrRenderers(self, attrList):
+        # Anything that's an aggregation or a non-string value should be None
+        meths = []
+        for attr in attrList:
+            if (attr.aggregation is None) and isinstance(attr, StringAttributeType):
+                meths.append(_renderIdentity)
+            else:
+                meths.append(_renderNone)
+        return meths
+
+    # Building the renderers for an annotation type used to happen
+    # for every type on every write. Now, we compile a renderer for
+    # each distinct type schema the first time we see it, and cache it.
+    # The schema is everything the rendering depends on: the writer class,
+    # whether it's the legacy writer, whether there are spans and IDs,
+    # and the name, type, aggregation and attribute class of each attribute.
+    # The renderer takes the annotation list and returns the rows.
+
+    def _compiledAnnotRenderer(self, aType, hasID):
+        attrList = aType.attr_list
+        key = (self.__class__, self.legacyWriter, hasID, aType.hasSpan,
+               tuple([(t.name, t._typename_, t.aggregation, t.__class__) for t in attrList]))
+        try:
+            return _JSON_RENDERER_CACHE[key]
+        except KeyError:
+            pass
+        if self.legacyWriter:
+            meths = self._legacyAttrRenderers(attrList)
+            descs = None
+        else:
+            meths = self._attrRenderers(attrList)
+            descs = self._renderAttrDescriptions(attrList)
+        entry = (_compileRowRenderer(hasID, aType.hasSpan, meths), descs)
+        _JSON_RENDERER_CACHE[key] = entry
+        return entry
+
     def renderJSONObj(self, annotDoc):
-        d = {"signal": annotDoc.signal,
+        d = {"signal": unicode(annotDoc.signal),
              "metadata": annotDoc.metadata,
              "asets": []}
         if not self.legacyWriter:
             d["version"] = 2
         asets = d["asets"]
-        for aType, annots in annotDoc.atypeDict.items():
+        for aType, annots in annotDoc.atypeDict._rawItems():
+            # Lazy annotations have no IDs and no attribute values, so
+            # we can write them directly from the offsets, unless there
+            # are attribute defaults to fill in.
+            lazySpans = None
+            if annots._lazy is not None:
+                if aType.hasDefaults:
+                    annots._materialize()
+                else:
+                    lazySpans = annots._getLazySpans()
             hasSpan = aType.hasSpan
-            # Don't use any() here - the list comprehension evaluates
-            # everything.
-            hasID = False
-            for a in annots:
-                if a.id is not None:
-                    hasID = True
-                    break
+            if self.legacyWriter and (not hasSpan):
+                continue
+            # The legacy writer never writes IDs.
+            hasID = (not self.legacyWriter) and (lazySpans is None) and \
+                    _annotsHaveIDs(annotDoc, aType, annots)
             aD = {"type": aType.lab}
+            # Assume the annotation is well-formed. All the WFC stuff
+            # has already been checked.
+            renderer, descs = self._compiledAnnotRenderer(aType, hasID)
             if self.legacyWriter:
-                if not hasSpan:
-                    continue
                 aD["attrs"] = [a.name for a in aType.attr_list]
-                # Anything that's an aggregation or a non-string value should be None
-                meths = []
-                for attr in aType.attr_list:
-                    if (attr.aggregation is None) and isinstance(attr, StringAttributeType):
-                        meths.append(lambda x: x)
-                    else:
-                        meths.append(lambda x: None)
-                aD["annots"] = [[annot.start, annot.end] +
-                                [meth(v) for (meth, v) in zip(meths, annot.attrs)]
-                                for annot in annots]
             else:
-                # Just store the type and aggregation. All the WFC stuff has already
-                # been checked.
-                attrList = aType.attr_list
+                # Just store the type and aggregation. The descriptions
+                # are copied, because the caller owns the result.
                 aD.update({"hasID": hasID,
                            "hasSpan": hasSpan,
-                           "attrs": [{"name": t.name, "type": t._typename_, "aggregation": t.aggregation}
-                                     for t in attrList]})
-                # Assume the annotation is well-formed.
-                meths = []
-                for attr in attrList:
-                    if isinstance(attr, AnnotationAttributeType):
-                        if (attr.aggregation is None):
-                            meths.append(self._renderAnnotationSingleValue)
-                        else:
-                            meths.append(self._renderAnnotationSequence)
-                    elif attr.aggregation is not None:
-                        meths.append(self._renderSequence)
-                    else:
-                        meths.append(lambda x: x)
-                if hasID and hasSpan:                
-                    aD["annots"] = [[annot.start, annot.end, annot.id] + 
-                                    [meth(v) for (meth, v) in zip(meths, annot.attrs)]
-                                    for annot in annots]
-                elif hasID:
-                    aD["annots"] = [[annot.id] + [meth(v) for (meth, v) in zip(meths, annot.attrs)]
-                                    for annot in annots]
-                elif hasSpan:
-                    aD["annots"] = [[annot.start, annot.end] + [meth(v) for (meth, v) in zip(meths, annot.attrs)]
-                                    for annot in annots]
-                else:
-                    aD["annots"] = [[meth(v) for (meth, v) in zip(meths, annot.attrs)] for annot in annots]
+                           "attrs": [desc.copy() for desc in descs]})
+            if lazySpans is not None:
+                aD["annots"] = [[s, e] for (s, e) in zip(lazySpans[0], lazySpans[1])]
+            else:
+                aD["annots"] = renderer(annots)
             asets.append(aD)
         return d
 
@@ -716,18 +1019,228 @@ class LegacyJSONDocumentIO(JSONDocumentIO):
 declareDocumentIO("mat-json", JSONDocumentIO, True, True)
 declareDocumentIO("mat-json-v1", LegacyJSONDocumentIO, False, True)
 
+#
+# Streaming MAT-JSON reader
+#
+
+# json.loads builds the entire document as nested lists before
+# we create a single annotation, so for a large document, we've got
+# the whole tree and the whole document in memory at once. This reader
+# walks the toplevel object itself, and hands each element of "asets"
+# to the JSONDocumentIO as soon as it's been read, so we never have more than
+# one annotation set's worth of rows around. Rows which are nothing but
+# spans (i.e., tokens) go straight into offset arrays, without creating a
+# list for each one. All the other values are decoded by the json module's
+# own scanner.
+
+# The writer puts the signal before the asets, but the version and
+# metadata after. If the signal isn't there yet when we get to the asets,
+# we can't compute attribute defaults, so we fall back to reading the
+# asets whole and digesting them at the end.
+
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+_JSON_DECODER = json.JSONDecoder()
+
+# Rows which are nothing but [start, end], as two arrays.
+
+class _SpanRows:
+
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield [start, end]
+
+# Returns a _SpanRows and the index after the array, or None if
+# the array at idx is anything other than [start, end] rows. We do it
+# a chunk of rows at a time, so there are never more than _JSON_SPAN_CHUNK
+# characters' worth of intermediate values around: make sure the chunk
+# has nothing but digits and brackets in it, and exactly two
+# values in each row, then strip the brackets and let the json scanner
+# read a flat list of ints, which is much cheaper than building a list
+# for each row.
+
+_JSON_SPAN_FIRST_ROW = re.compile(r'\[\s*\[\s*-?\d+\s*,\s*-?\d+\s*\]\s*[,\]]')
+_JSON_SPAN_ROWS_END = re.compile(r'\]\s*\]')
+_JSON_BAD_SPAN_ROW = re.compile(r'\[[^\[\],]*(?:\]|,[^\],]*,)')
+_JSON_SPAN_CHARS = "[]0123456789,- \t\n\r"
+_JSON_SPAN_CHUNK = 1 << 20
+
+def _readJSONSpanRows(s, idx):
+    if s[idx:idx+1] != "[":
+        return None
+    j = _JSON_WS.match(s, idx + 1).end()
+    if s[j:j+1] == "]":
+        return _SpanRows(array.array('i'), array.array('i')), j + 1
+    if _JSON_SPAN_FIRST_ROW.match(s, idx) is None:
+        return None
+    m = _JSON_SPAN_ROWS_END.search(s, idx)
+    if m is None:
+        # Truncated; let the decoder report it.
+        return None
+    offsets = array.array('i')
+    pos = idx + 1
+    try:
+        while pos <= m.start():
+            cut = s.find("]", min(pos + _JSON_SPAN_CHUNK, m.start())) + 1
+            chunk = s[pos:cut].encode("ascii")
+            if chunk.translate(None, _JSON_SPAN_CHARS) or _JSON_BAD_SPAN_ROW.search(chunk):
+                return None
+            flat = chunk.replace("[", "").replace("]", "").strip()
+            if pos > idx + 1:
+                # Every chunk but the first starts with the separator.
+                if not flat.startswith(","):
+                    return None
+                flat = flat[1:]
+            vals = json.loads("[" + flat + "]")
+            if len(vals) != 2 * chunk.count("["):
+                return None
+            offsets.extend(vals)
+            pos = cut
+    except (ValueError, UnicodeError, OverflowError):
+        return None
+    return _SpanRows(offsets[0::2], offsets[1::2]), m.end()
+
+class _MATJSONStreamReader:
+
+    def __init__(self, io, s, annotDoc):
+        self.io = io
+        self.s = s
+        self.annotDoc = annotDoc
+        # Needed for the reconciliation check, which has to wait
+        # for the metadata.
+        self.priorSignal = annotDoc.signal
+        self.header = {}
+        self.annotMap = {}
+        self.aPairs = []
+
+    def read(self):
+        idx = self._scanObject(0, self._toplevelValue)
+        if _JSON_WS.match(self.s, idx).end() != len(self.s):
+            raise LoadError, "input doesn't appear to be JSON"
+        # Now that we've seen everything, check the version and the
+        # reconciliation status.
+        self.io._deserializeHeader(self.header, self.annotDoc, priorSignal = self.priorSignal)
+        if self.header.has_key("asets"):
+            for adir in self.header["asets"]:
+                self.io._deserializeAnnotationSet(adir, self.annotDoc, self.annotMap, self.aPairs)
+        self.io._deserializeAnnotationValues(self.aPairs)
+
+    def _toplevelValue(self, key, idx):
+        if (key == "asets") and self.header.has_key("signal"):
+            self.io._deserializeHeader(self.header, self.annotDoc, priorSignal = self.priorSignal)
+            return self._scanArray(idx, self._asetValue)
+        self.header[key], idx = self._decode(idx)
+        return idx
+
+    def _asetValue(self, idx):
+        s = self.s
+        adir = {}
+        def asetValue(key, idx):
+            if key == "annots":
+                spanRows = _readJSONSpanRows(s, idx)
+                if spanRows is not None:
+                    adir[key], idx = spanRows
+                    return idx
+            adir[key], idx = self._decode(idx)
+            return idx
+        idx = self._scanObject(idx, asetValue)
+        self.io._deserializeAnnotationSet(adir, self.annotDoc, self.annotMap, self.aPairs)
+        return idx
+
+    def _decode(self, idx):
+        try:
+            return _JSON_DECODER.raw_decode(self.s, idx)
+        except ValueError:
+            raise LoadError, "input doesn't appear to be JSON"
+
+    # valueFn is called with the key and the index of the value, and
+    # returns the index after the value.
+    
+    def _scanObject(self, idx, valueFn):
+        s = self.s
+        idx = _JSON_WS.match(s, idx).end()
+        if s[idx:idx+1] != "{":
+            raise LoadError, "input doesn't appear to be JSON"
+        idx = _JSON_WS.match(s, idx + 1).end()
+        if s[idx:idx+1] == "}":
+            return idx + 1
+        while True:
+            if s[idx:idx+1] != '"':
+                raise LoadError, "input doesn't appear to be JSON"
+            try:
+                key, idx = json.decoder.scanstring(s, idx + 1)
+            except ValueError:
+                raise LoadError, "input doesn't appear to be JSON"
+            idx = _JSON_WS.match(s, idx).end()
+            if s[idx:idx+1] != ":":
+                raise LoadError, "input doesn't appear to be JSON"
+            idx = valueFn(key, _JSON_WS.match(s, idx + 1).end())
+            idx = _JSON_WS.match(s, idx).end()
+            c = s[idx:idx+1]
+            if c == "}":
+                return idx + 1
+            elif c != ",":
+                raise LoadError, "input doesn't appear to be JSON"
+            idx = _JSON_WS.match(s, idx + 1).end()
+
+    # Same here, except without the key.
+    
+    def _scanArray(self, idx, valueFn):
+        s = self.s
+        idx = _JSON_WS.match(s, idx).end()
+        if s[idx:idx+1] != "[":
+            raise LoadError, "input doesn't appear to be JSON"
+        idx = _JSON_WS.match(s, idx + 1).end()
+        if s[idx:idx+1] == "]":
+            return idx + 1
+        while True:
+            idx = _JSON_WS.match(s, valueFn(idx)).end()
+            c = s[idx:idx+1]
+            if c == "]":
+                return idx + 1
+            elif c != ",":
+                raise LoadError, "input doesn't appear to be JSON"
+            idx = _JSON_WS.match(s, idx + 1).end()
+
 #
 # Raw reading/writing
 #
 
 class RawDocumentIO(DocumentFileIO):
 
+    # The whole file is the signal, so if it's UTF-8 (or ASCII,
+    # which is a subset), we can map it directly.
+    
+    def _readFromMappedFile(self, path, **kw):
+        if codecs.lookup(self.encoding).name not in ("utf-8", "ascii"):
+            return None
+        fp = open(path, "rb")
+        try:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return None
+            m = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        try:
+            signal = MAT.Document.MappedSignal(m)
+        except UnicodeDecodeError, e:
+            raise LoadError, self._unicodeErrorString(e, self.encoding)
+        return self._readDocument(signal, **kw)
+
     def deserialize(self, s, annotDoc):
         annotDoc.signal = s
 
     def writeToUnicodeString(self, annotDoc):
         return annotDoc.signal
 
+    outputArgs = _COMPRESSION_OUTPUT_ARGS
+
 declareDocumentIO("raw", RawDocumentIO, True, True)
 
 #
@@ -744,20 +1257,193 @@ class ManagerError(Exception):
 
 import os
 
+# The input_dir and output_dir can also be tar or zip archives. The
+# members are read and written in place, without extracting them,
+# and input_file_re is matched against the member names (which may
+# include the folders inside the archive). A tar archive can be
+# compressed with gzip or bzip2.
+
+import tarfile, zipfile, threading, time, cStringIO
+
+_TAR_WRITE_MODES = [(".tar", "w"), (".tar.gz", "w:gz"), (".tgz", "w:gz"),
+                    (".tar.bz2", "w:bz2"), (".tbz2", "w:bz2"), (".tbz", "w:bz2")]
+
+# Returns the tarfile mode for writing, or "zip", or None if
+# the name doesn't look like an archive we can write.
+
+def _archiveWriteMode(path):
+    lowerPath = path.lower()
+    if lowerPath.endswith(".zip"):
+        return "zip"
+    for suff, mode in _TAR_WRITE_MODES:
+        if lowerPath.endswith(suff):
+            return mode
+    return None
+
+# We never want a member name to write outside the output
+# directory, so we discard anything that might take us up or out.
+
+def _safeMemberPath(name):
+    return "/".join([p for p in name.replace("\\", "/").split("/") if p not in ("", ".", "..")])
+
+class _ArchiveReader:
+
+    def __init__(self, path):
+        self.path = path
+        # A zip file can look like a tar file, but not the other way around.
+        if zipfile.is_zipfile(path):
+            self.isZip = True
+        elif tarfile.is_tarfile(path):
+            self.isZip = False
+        else:
+            raise LoadError, ("%s is neither a directory nor a tar or zip archive" % path)
+        self._lock = threading.Lock()
+        self._archive = None
+        self._pid = None
+        self._members = None
+
+    # A forked prefetch worker shares the file position with its
+    # parent, so each process opens the archive for itself.
+    
+    def _open(self):
+        if self._pid != os.getpid():
+            try:
+                if self.isZip:
+                    self._archive = zipfile.ZipFile(self.path, "r")
+                else:
+                    self._archive = tarfile.open(self.path, "r:*")
+            except (tarfile.TarError, zipfile.BadZipfile, IOError), e:
+                raise LoadError, ("Error opening archive %s: %s" % (self.path, str(e)))
+            self._pid = os.getpid()
+        return self._archive
+
+    # In archive order, which is the cheapest order to read a
+    # compressed tar file in.
+    
+    def memberNames(self):
+        self._lock.acquire()
+        try:
+            self._ensureMembers()
+            return self._memberOrder[:]
+        finally:
+            self._lock.release()
+
+    def _ensureMembers(self):
+        if self._members is None:
+            archive = self._open()
+            try:
+                if self.isZip:
+                    infos = [(i.filename, i) for i in archive.infolist() if not i.filename.endswith("/")]
+                else:
+                    infos = [(i.name, i) for i in archive.getmembers() if i.isfile()]
+            except (tarfile.TarError, zipfile.BadZipfile, IOError), e:
+                raise LoadError, ("Error reading archive %s: %s" % (self.path, str(e)))
+            # The tar lookup by name is a linear search, so we keep our own.
+            self._members = dict(infos)
+            self._memberOrder = [name for (name, info) in infos]
+
+    def read(self, name):
+        self._lock.acquire()
+        try:
+            self._ensureMembers()
+            archive = self._open()
+            try:
+                info = self._members[name]
+            except KeyError:
+                raise LoadError, ("no member %s in archive %s" % (name, self.path))
+            try:
+                if self.isZip:
+                    return archive.read(info)
+                else:
+                    fp = archive.extractfile(info)
+                    try:
+                        return fp.read()
+                    finally:
+                        fp.close()
+            except (tarfile.TarError, zipfile.BadZipfile, IOError), e:
+                raise LoadError, ("Error reading %s from archive %s: %s" % (name, self.path, str(e)))
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if (self._archive is not None) and (self._pid == os.getpid()):
+            self._archive.close()
+        self._archive = None
+        self._pid = None
+
+class _ArchiveWriter:
+
+    def __init__(self, path, compressionLevel = None):
+        self.path = path
+        mode = _archiveWriteMode(path)
+        if mode == "zip":
+            self.isZip = True
+            self._archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, True)
+        else:
+            self.isZip = False
+            if (mode != "w") and (compressionLevel is not None):
+                self._archive = tarfile.open(path, mode, compresslevel = compressionLevel)
+            else:
+                self._archive = tarfile.open(path, mode)
+
+    def write(self, name, s):
+        if self.isZip:
+            info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0644 << 16
+            self._archive.writestr(info, s)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(s)
+            info.mtime = int(time.time())
+            info.mode = 0644
+            self._archive.addfile(info, cStringIO.StringIO(s))
+
+    def close(self):
+        self._archive.close()
+
 class DocumentIOManager:
 
     def __init__(self, task = None):
 
         self.task = task
-
+        self.prefetch = 0
+        self.prefetchMode = None
+        self._inputArchive = None
+        self._outputArchive = None
+        self._outputIsArchive = False
+        self._inputFileFilter = None
+
+    # If prefetch is a positive number, the files are read and
+    # deserialized by a pool of that many workers, ahead of whoever's
+    # consuming them (see _prefetchFiles()). prefetch_mode is "process"
+    # (the default, where fork() is available) or "thread".
+    
     def configure(self, input_file = None, input_dir = None, input_file_re = None,
                   input_encoding = None, input_file_type = None, steps = None, undo_through = None,
                   output_file = None, output_file_type = None, output_dir = None,
                   output_fsuff = None, output_encoding = None,
                   inputFileList = None, inputFileType = None, outputFileType = None,
+                  prefetch = None, prefetch_mode = None,
                   **params):
         
         # Do some sanity checking.
+        if prefetch is not None:
+            try:
+                prefetch = int(prefetch)
+            except ValueError:
+                raise ManagerError, "prefetch must be an integer"
+            if prefetch < 0:
+                raise ManagerError, "prefetch must not be negative"
+        if prefetch_mode is None:
+            if hasattr(os, "fork"):
+                prefetch_mode = "process"
+            else:
+                prefetch_mode = "thread"
+        elif prefetch_mode not in ("process", "thread"):
+            raise ManagerError, "prefetch_mode must be one of 'process', 'thread'"
+        elif (prefetch_mode == "process") and (not hasattr(os, "fork")):
+            raise ManagerError, "prefetch_mode 'process' isn't available on this platform"
         if inputFileType is None:
             if not inputDocumentIODeclared(input_file_type):
                 raise ManagerError, ("input_file_type must be one of " + ", ".join(["'"+x+"'" for x in allInputDocumentIO()]))
@@ -797,17 +1483,37 @@ class DocumentIOManager:
         self.inputFileType = inputFileType
         self.outputFileType = outputFileType
         self.writeable = (input_file and output_file) or (input_dir and output_dir)
+        self.prefetch = prefetch or 0
+        self.prefetchMode = prefetch_mode
+
+        # An input_dir which is a file must be an archive. An output_dir
+        # which isn't already a directory is an archive if its name says
+        # it is; we don't create it until we write to it.
+        self._inputArchive = None
+        if input_dir and (inputFileList is None) and os.path.isfile(input_dir):
+            try:
+                self._inputArchive = _ArchiveReader(input_dir)
+            except LoadError, e:
+                raise ManagerError, str(e)
+        self._outputArchive = None
+        self._outputIsArchive = bool(output_dir and (not os.path.isdir(output_dir)) and \
+                                     (_archiveWriteMode(output_dir) is not None))
         
-        if self.inputFileType is None:
-            self.inputFileType = getDocumentIO(self.input_file_type, encoding = self.input_encoding,
-                                               task = self.task, **params)
-        # Load the writer, while I'm at it. A bit perverse, but this is where I get the
-        # params.
-
-        if self.writeable:
-            if self.outputFileType is None:
-                self.outputFileType = getDocumentIO(self.output_file_type, encoding = self.output_encoding,
-                                                    task = self.task, **params)
+        # The readers and writers both see all the params, so
+        # either might complain about, e.g., compression_level.
+        try:
+            if self.inputFileType is None:
+                self.inputFileType = getDocumentIO(self.input_file_type, encoding = self.input_encoding,
+                                                   task = self.task, **params)
+            # Load the writer, while I'm at it. A bit perverse, but this is where I get the
+            # params.
+
+            if self.writeable:
+                if self.outputFileType is None:
+                    self.outputFileType = getDocumentIO(self.output_file_type, encoding = self.output_encoding,
+                                                        task = self.task, **params)
+        except SaveError, e:
+            raise ManagerError, str(e)
                 
     # Utility.
     def _outputIsInWorkspace(self, p):
@@ -819,6 +1525,18 @@ class DocumentIOManager:
     
     def isWriteable(self):
         return self.writeable
+
+    # True if each document is written to a file of its own (see outputPath()).
+    
+    def writesOutputFiles(self):
+        return bool(self.writeable) and (not self._outputIsArchive) and \
+               (self.output_file != "-")
+
+    # fn is called on each input path; the paths it returns False
+    # for aren't loaded.
+
+    def filterInputFiles(self, fn):
+        self._inputFileFilter = fn
    
     # The loading should probably be a generator, but let's not bother with that right now.
     # This yields a list of pairs of <fullpath>, <matdocument>.
@@ -832,6 +1550,16 @@ class DocumentIOManager:
 
         if MAT.ExecutionContext._DEBUG:
             keepGoing = False
+
+        if self.prefetch and (len(inputFileList) > 1):
+            for f, doc, e in self._prefetchFiles(inputFileList):
+                if e is None:
+                    docPairs.append((f, doc))
+                elif keepGoing:
+                    skipPairs.append((f, str(e)))
+                else:
+                    raise e
+            return docPairs, skipPairs
         
         for f in inputFileList:
             if keepGoing:
@@ -856,6 +1584,16 @@ class DocumentIOManager:
 
         if MAT.ExecutionContext._DEBUG:
             keepGoing = False
+
+        if self.prefetch and (len(inputFileList) > 1):
+            for f, doc, e in self._prefetchFiles(inputFileList):
+                if e is None:
+                    yield (f, doc, None)
+                elif keepGoing:
+                    yield (f, None, str(e))
+                else:
+                    raise e
+            return
         
         for f in inputFileList:
             if keepGoing:                
@@ -865,8 +1603,74 @@ class DocumentIOManager:
                     yield (f, None, str(e))
             else:
                 yield (f, self._loadFile(f), None)
+
+    # Yields (<fullpath>, <matdoc>, <exception>) for each file, in order,
+    # where exactly one of matdoc and exception is None. The callers
+    # above decide what to do with the exceptions.
+
+    # In the thread pool, the workers just call _loadFile(). But
+    # CPython only lets one thread at a time parse, so that mostly buys
+    # overlapping file reads. In the process pool, each worker
+    # (forked with this manager, which it finds in _PREFETCH_MANAGER)
+    # reads the file the ordinary way, with the task and any convertor,
+    # and hands the document back as mat-bin. We still have to create
+    # the annotations which have attributes here, so this pays off when
+    # the parsing and conversion are the expensive part (XML, tokens,
+    # convertors), not when the documents are mostly attribute-bearing
+    # annotations. We never have more than twice as many files in flight
+    # as there are workers, so a slow consumer doesn't end up with the
+    # whole directory in memory.
+    
+    def _prefetchFiles(self, inputFileList):
+        global _PREFETCH_MANAGER
+        import multiprocessing, multiprocessing.pool
+        from collections import deque
+        if self.prefetchMode == "thread":
+            pool = multiprocessing.pool.ThreadPool(self.prefetch)
+            worker = self._tryLoadFile
+            binIO = None
+        else:
+            _PREFETCH_MANAGER = self
+            try:
+                pool = multiprocessing.Pool(self.prefetch)
+            finally:
+                _PREFETCH_MANAGER = None
+            worker = _prefetchLoadFile
+            binIO = getDocumentIO("mat-bin", task = self.task)
+        pending = deque()
+        i = 0
+        try:
+            while True:
+                while (i < len(inputFileList)) and (len(pending) < 2 * self.prefetch):
+                    pending.append((inputFileList[i], pool.apply_async(worker, (inputFileList[i],))))
+                    i += 1
+                if not pending:
+                    break
+                f, result = pending.popleft()
+                doc, e = result.get()
+                if (binIO is not None) and (e is None):
+                    try:
+                        doc = binIO.readFromByteSequence(doc, taskSeed = self.task)
+                    except Exception, e:
+                        doc = None
+                yield (f, doc, e)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _tryLoadFile(self, p):
+        try:
+            return self._loadFile(p), None
+        except Exception, e:
+            return None, e
         
     def _processInputFileList(self):
+        inputFileList = self._listInputFiles()
+        if self._inputFileFilter is not None:
+            inputFileList = [p for p in inputFileList if self._inputFileFilter(p)]
+        return inputFileList
+        
+    def _listInputFiles(self):
         if self.inputFileList is not None:
             return self.inputFileList
         elif self.input_file is not None:
@@ -875,6 +1679,15 @@ class DocumentIOManager:
             input_file_re = self.input_file_re
             if input_file_re is not None:
                 input_file_re = re.compile("^"+input_file_re+"$")
+            if self._inputArchive is not None:
+                try:
+                    names = self._inputArchive.memberNames()
+                except LoadError, e:
+                    raise ManagerError, str(e)
+                # The "path" is the member name under the archive name;
+                # _loadFile() and writeDocument() know what to do with it.
+                return [os.path.join(self.input_dir, name) for name in names
+                        if (input_file_re is None) or input_file_re.match(name)]
             files = os.listdir(self.input_dir)
             inputFileList = []
             for f in files:
@@ -883,8 +1696,22 @@ class DocumentIOManager:
                     inputFileList.append(fullP)
             return inputFileList
 
+    # The member name of a path from _processInputFileList(),
+    # if the input is an archive; otherwise None.
+    
+    def _archiveMemberName(self, p):
+        if self._inputArchive is not None:
+            prefix = os.path.join(self.input_dir, "")
+            if p.startswith(prefix):
+                return p[len(prefix):]
+        return None
+
     def _loadFile(self, p):
         try:
+            memberName = self._archiveMemberName(p)
+            if memberName is not None:
+                return self.inputFileType.readFromByteSequence(self._inputArchive.read(memberName),
+                                                               taskSeed = self.task)
             return self.inputFileType.readFromSource(p, taskSeed = self.task)
         except IOError:
             if MAT.ExecutionContext._DEBUG:
@@ -897,15 +1724,52 @@ class DocumentIOManager:
             else:
                 raise ManagerError, ("Load error: " + str(e))
 
+    # The raw contents of an input path, e.g., for checksums.
+
+    def readInputBytes(self, p):
+        memberName = self._archiveMemberName(p)
+        if memberName is not None:
+            return self._inputArchive.read(memberName)
+        fp = open(p, "rb")
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    # Documents from an archive keep the folders they were in.
+
+    def _outputName(self, fName):
+        memberName = self._archiveMemberName(fName)
+        if memberName is not None:
+            oName = _safeMemberPath(memberName)
+        else:
+            oName = os.path.basename(fName)
+        if self.output_fsuff:
+            oName += self.output_fsuff
+        return oName
+
+    # The file the document for the input path is written to, or None
+    # if it isn't written to a file of its own.
+    
+    def outputPath(self, fName):
+        if not self.writesOutputFiles():
+            return None
+        elif self.output_file:
+            return self.output_file
+        else:
+            return os.path.join(self.output_dir, self._outputName(fName))
+    
     def writeDocument(self, fName, doc):
-        if self.output_dir and not os.path.exists(self.output_dir):
-            os.makedirs(self.output_dir)
         if self.output_file:
             oFile = self.output_file
         else:
-            oFile = os.path.join(self.output_dir, os.path.basename(fName))
-            if self.output_fsuff:
-                oFile += self.output_fsuff
+            oName = self._outputName(fName)
+            if self._outputIsArchive:
+                self._writeArchiveMember(oName, doc)
+                return
+            oFile = os.path.join(self.output_dir, oName)
+            if not os.path.exists(os.path.dirname(oFile)):
+                os.makedirs(os.path.dirname(oFile))
         try:
             self.outputFileType.writeToTarget(doc, oFile)
         except SaveError, e:
@@ -914,6 +1778,51 @@ class DocumentIOManager:
             else:
                 raise ManagerError, ("Error saving file %s: %s" % (oFile, str(e)))
 
+    def _writeArchiveMember(self, oName, doc):
+        try:
+            if self._outputArchive is None:
+                d = os.path.dirname(self.output_dir)
+                if d and not os.path.exists(d):
+                    os.makedirs(d)
+                self._outputArchive = _ArchiveWriter(self.output_dir,
+                                                     getattr(self.outputFileType, "compressionLevel", None))
+            # The writer does the conversion and encoding, as usual.
+            buf = cStringIO.StringIO()
+            self.outputFileType.writeToTarget(doc, buf)
+            self._outputArchive.write(oName, buf.getvalue())
+        except (SaveError, tarfile.TarError, IOError), e:
+            if MAT.ExecutionContext._DEBUG:
+                raise
+            else:
+                raise ManagerError, ("Error saving %s to archive %s: %s" % (oName, self.output_dir, str(e)))
+
+    # Call this when you're done; an output archive isn't
+    # complete until it's closed.
+    
+    def close(self):
+        if self._outputArchive is not None:
+            self._outputArchive.close()
+            self._outputArchive = None
+        if self._inputArchive is not None:
+            self._inputArchive.close()
+
+# The worker for the process pool in DocumentIOManager._prefetchFiles().
+# Whatever we return has to be pickled, so if the exception
+# can't be, we send its message instead.
+
+_PREFETCH_MANAGER = None
+
+def _prefetchLoadFile(p):
+    import cPickle
+    doc, e = _PREFETCH_MANAGER._tryLoadFile(p)
+    if e is not None:
+        try:
+            cPickle.dumps(e)
+        except Exception:
+            e = ManagerError(str(e))
+        return None, e
+    return getDocumentIO("mat-bin").writeToByteSequence(doc), None
+
 #
 # DocumentMappings
 #
@@ -956,6 +1865,46 @@ class ConversionReporter(AnnotationReporter):
         headers, rows = AnnotationReporter.getHeadersAndRows(self)
         return headers + ["removal reason"], [a + [b] for (a, b) in zip(rows, self.reasons)]
 
+# Parsing and digesting an instruction set is a lot of work to do
+# every time an engine is created (and the registered convertors create
+# an engine each time they're used). So the digested instructions are cached
+# for the life of the process, keyed by the engine class and either the
+# instruction file and its modification time, or the XML string. The
+# digested instructions are never modified once they're built, so
+# the engines can share them.
+
+_DIS_INSTRUCTION_CACHE = {}
+
+# The label and attribute patterns are matched against the same
+# few names over and over again, document after document, so we compile
+# them once and remember the answers. Attribute value patterns are just
+# compiled; there's no telling how many values there might be.
+
+class _DISNamePattern:
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._re = re.compile("^(" + pattern + ")$")
+        self._results = {}
+
+    def match(self, name):
+        try:
+            return self._results[name]
+        except KeyError:
+            res = self._results[name] = (self._re.match(name) is not None)
+            return res
+
+def _compileDISPatterns(kv, keys, compiler):
+    kv = kv.copy()
+    for key in keys:
+        v = kv.get(key)
+        if type(v) in (str, unicode):
+            kv[key] = compiler(v)
+    return kv
+
+def _compileDISValuePattern(pattern):
+    return re.compile("^(" + pattern + ")$")
+
 class DocumentInstructionSetEngine:
 
     def __init__(self, instructionSetFile = None, instructionSetXML = None,
@@ -964,10 +1913,8 @@ class DocumentInstructionSetEngine:
         self.instructionSetXML = instructionSetXML
         if instructionSetFile and instructionSetXML:
             raise LoadError, "Can't have both instructionSetFile and instructionSetXML"
-        if instructionSetFile:
-            self._digestInstructionDom(XMLNodeFromFile(instructionSetFile, DIS_DESC))
-        elif instructionSetXML:
-            self._digestInstructionDom(XMLNodeFromString(instructionSetXML, DIS_DESC))
+        if instructionSetFile or instructionSetXML:
+            self._loadInstructions(instructionSetFile, instructionSetXML)
         self.recordConversions = False
         self.conversionRecorder = None
         self.conversionList = []
@@ -978,6 +1925,35 @@ class DocumentInstructionSetEngine:
         self.recordConversions = True
         self.conversionRecorder = ConversionReporter()
 
+    def _loadInstructions(self, instructionSetFile, instructionSetXML):
+        key = None
+        if instructionSetFile:
+            path = os.path.abspath(instructionSetFile)
+            try:
+                key = (self.__class__, "file", path, os.stat(path).st_mtime)
+            except OSError:
+                # Let the reader complain.
+                pass
+        else:
+            key = (self.__class__, "xml", instructionSetXML)
+        if key is not None:
+            try:
+                self.instructions = _DIS_INSTRUCTION_CACHE[key]
+                return
+            except KeyError:
+                pass
+        if instructionSetFile:
+            self._digestInstructionDom(XMLNodeFromFile(instructionSetFile, DIS_DESC))
+        else:
+            self._digestInstructionDom(XMLNodeFromString(instructionSetXML, DIS_DESC))
+        if key is not None:
+            if key[1] == "file":
+                # Forget the versions of this file we've already seen.
+                for k in _DIS_INSTRUCTION_CACHE.keys():
+                    if k[:3] == key[:3]:
+                        del _DIS_INSTRUCTION_CACHE[k]
+            _DIS_INSTRUCTION_CACHE[key] = self.instructions
+
     def _digestInstructionDom(self, domResult):
         # So the game is that the instructions are ALMOST exactly what we
         # call, but it has to be massaged just a bit in places.
@@ -991,7 +1967,8 @@ class DocumentInstructionSetEngine:
 
     def _digestLabelInstructions(self, labelInstructionNode):
         childInstructions = []
-        kv = labelInstructionNode.attrs.copy()
+        kv = _compileDISPatterns(labelInstructionNode.attrs, ("source_re", "excluding_re"),
+                                 _DISNamePattern)
         for instr in labelInstructionNode.orderedChildren:
             instrName = instr.label
             if instrName == "with_attrs":
@@ -1000,10 +1977,11 @@ class DocumentInstructionSetEngine:
                 except KeyError:
                     kv["with_attrs"] = [instr.wildcardAttrs]
             elif instrName == "of_attr":
-                newV = {"label": instr.attrs["label"],
-                        "label_re": instr.attrs["label_re"],
-                        "attr": instr.attrs["attr"],
-                        "attr_re": instr.attrs["attr_re"]}
+                newV = _compileDISPatterns({"label": instr.attrs["label"],
+                                            "label_re": instr.attrs["label_re"],
+                                            "attr": instr.attrs["attr"],
+                                            "attr_re": instr.attrs["attr_re"]},
+                                           ("label_re", "attr_re"), _DISNamePattern)
                 try:
                     kv["of_attr"].append(newV)
                 except KeyError:
@@ -1045,10 +2023,13 @@ class DocumentInstructionSetEngine:
                 childInstructions.append((instr.label, instrAttrs, None))                
             else:
                 childInstructions.append((instr.label, instr.attrs, None))
-        return ("attrs", attrInstructionNode.attrs, childInstructions or None)
+        return ("attrs", _compileDISPatterns(attrInstructionNode.attrs, ("source_re", "excluding_re"),
+                                             _DISNamePattern),
+                childInstructions or None)
 
     def _digestValueInstructions(self, valueInstructionNode):
-        return ("values", valueInstructionNode.attrs,
+        return ("values", _compileDISPatterns(valueInstructionNode.attrs, ("source_re", "excluding_re"),
+                                              _compileDISValuePattern),
                 [(instr.label, instr.attrs, None) for instr in valueInstructionNode.orderedChildren] or None)
 
     def _execute(self, sourceDoc, targetDoc):
@@ -0,0 +1,245 @@
+# Copyright (C) 2007 - 2009 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# A long-lived MATEngine. Loading the plugins, reading the task.xml
+# files and setting up the tasks (their annotation type repositories,
+# their replacers, etc.) can take much longer than processing a small
+# folder. So the daemon does all that once, and then reads jobs, one
+# JSON object per line, from standard input or a Unix socket, and writes
+# a JSON object on a line of its own back for each one.
+
+# A job looks like this:
+
+# {"id": <anything>, "task": <task name>, "workflow": <workflow name>,
+#  "steps": "zone,tag" (or ["zone", "tag"]), "undo_through": <step>,
+#  ...}
+
+# task and workflow can be omitted if there's only one to choose from.
+# The rest of the job is either the MATEngine.Run() arguments for the
+# files (input_file or input_dir, input_file_type, output_file or
+# output_dir, output_file_type, etc.), or "documents", a list of
+# documents, each of which is a MAT-JSON object or a string (the signal
+# of a raw document). Anything else is passed to the steps, as it would
+# be on the command line (e.g., "replacer"). If "step_statistics" is
+# "yes" or "per_document", the response has the statistics for the
+# job's steps, as "stepStatistics" (see MAT.ToolChain.StepStatistics);
+# the daemon doesn't take --step_statistics, since it would have to
+# keep them all until it exits.
+
+# The response looks like this:
+
+# {"id": <the id of the job>, "success": true or false,
+#  "error": <the error, or null>, "errorStep": <the step which failed,
+#  or "[init]", or null>, "outputs": [<path>, ...] or "documents": [...]}
+
+# where "outputs" is there for the files, and lists the outputs which were
+# written (for an archive, it's the archive), and "documents" is there for
+# the documents, and lists them, in order, as MAT-JSON objects.
+
+# There are two other kinds of jobs: {"op": "ping"}, which just
+# succeeds, and {"op": "shutdown"}, which succeeds and then stops
+# the daemon. The jobs are done one at a time, in the order they arrive;
+# the engine can still use workers for each one (see the "workers" argument).
+
+import os, sys, socket
+import MAT
+from MAT import json, Error, PluginMgr, DocumentIO, Document
+from MAT.ToolChain import MATEngine, ConfigurationError, StepStatistics
+
+class EngineDaemonError(Exception):
+    pass
+
+# These are the arguments which aren't passed to the engine.
+
+_JOB_KEYS = ["id", "op", "task", "workflow", "documents", "step_statistics"]
+
+# These only make sense for files.
+
+_FILE_ARGS = ["input_file", "input_dir", "input_file_re", "input_encoding", "input_file_type",
+              "output_file", "output_dir", "output_fsuff", "output_file_type",
+              "output_encoding", "prefetch", "prefetch_mode", "stream_chunk", "journal"]
+
+class _DaemonMATEngine(MATEngine):
+
+    def __init__(self, *args, **kw):
+        self.outputs = []
+        MATEngine.__init__(self, *args, **kw)
+
+    def ReportOutputWritten(self, fname, outputPath):
+        if outputPath is not None:
+            self.outputs.append(outputPath)
+
+class EngineDaemon:
+
+    def __init__(self, pluginDir = None):
+        if pluginDir is None:
+            pluginDir = PluginMgr.LoadPlugins()
+        self.pluginDir = pluginDir
+        self.shutdownRequested = False
+
+    # Returns the response. This never raises an error, unless
+    # we're in debug mode.
+
+    def doJob(self, job):
+        resp = {"id": None, "success": False, "error": None, "errorStep": None}
+        if type(job) is not dict:
+            resp["error"] = "job must be a JSON object"
+            resp["errorStep"] = "[init]"
+            return resp
+        resp["id"] = job.get("id")
+        op = job.get("op", "run")
+        try:
+            if op == "ping":
+                pass
+            elif op == "shutdown":
+                self.shutdownRequested = True
+            elif op == "run":
+                self._runJob(job, resp)
+            else:
+                raise EngineDaemonError, ("unknown op '%s'" % op)
+            resp["success"] = True
+        except Error.MATError, e:
+            if MAT.ExecutionContext._DEBUG:
+                raise
+            resp["error"] = str(e.errstr or "<no information>")
+            resp["errorStep"] = e.phase
+        except ConfigurationError, (engine, err):
+            if MAT.ExecutionContext._DEBUG:
+                raise
+            resp["error"] = str(err)
+            resp["errorStep"] = "[init]"
+        except Exception, e:
+            if MAT.ExecutionContext._DEBUG:
+                raise
+            resp["error"] = str(e) or e.__class__.__name__
+            resp["errorStep"] = "[init]"
+        return resp
+
+    def _runJob(self, job, resp):
+        params = {}
+        for k, v in job.items():
+            if k not in _JOB_KEYS:
+                params[str(k)] = v
+        if type(params.get("steps")) in (str, unicode):
+            params["steps"] = [str(s) for s in params["steps"].split(",") if s]
+        stats = None
+        if job.get("step_statistics") in ("yes", "per_document"):
+            stats = StepStatistics(perDocument = (job["step_statistics"] == "per_document"))
+        engine = _DaemonMATEngine(task = job.get("task"), workflow = job.get("workflow"),
+                                  pluginDir = self.pluginDir, stepStatistics = stats)
+        try:
+            self._runEngine(engine, job, params, resp)
+        finally:
+            if stats is not None:
+                resp["stepStatistics"] = stats.asJSONObj()
+
+    def _runEngine(self, engine, job, params, resp):
+        docs = job.get("documents")
+        if docs is None:
+            engine.Run(**params)
+            if (not engine.outputs) and params.get("output_dir") and \
+               os.path.isfile(params["output_dir"]):
+                # An archive.
+                engine.outputs.append(params["output_dir"])
+            resp["outputs"] = engine.outputs
+            return
+        for k in _FILE_ARGS:
+            if params.has_key(k):
+                raise EngineDaemonError, ("%s can't be used with documents" % k)
+        if type(docs) is not list:
+            raise EngineDaemonError, "documents must be a list"
+        steps = params.pop("steps", None)
+        undoThrough = params.pop("undo_through", None)
+        jsonIO = DocumentIO.getDocumentIO("mat-json", task = engine.taskObj)
+        pairs = []
+        i = 0
+        for d in docs:
+            if type(d) in (str, unicode):
+                doc = engine.taskObj.newDocument(signal = unicode(d))
+            elif type(d) is dict:
+                doc = engine.taskObj.newDocument()
+                jsonIO._deserializeFromJSON(d, doc)
+            else:
+                raise EngineDaemonError, "each document must be a MAT-JSON object or a string"
+            pairs.append(("<doc%d>" % i, doc))
+            i += 1
+        pairs = engine.RunDataPairs(pairs, steps, undoThrough = undoThrough, **params)
+        results = []
+        for fname, iData in pairs:
+            if isinstance(iData, Document.AnnotatedDoc):
+                results.append(jsonIO.renderJSONObj(iData))
+            else:
+                results.append(iData)
+        resp["documents"] = results
+
+    def doJobLine(self, line):
+        try:
+            job = json.loads(line)
+        except ValueError, e:
+            return {"id": None, "success": False, "error": "job isn't JSON: %s" % e,
+                    "errorStep": "[init]"}
+        return self.doJob(job)
+
+    # Reads jobs from inp until it's exhausted, or we're asked to shut down.
+    # We use readline(), because iterating over a file reads ahead.
+
+    def serveStream(self, inp, out):
+        while not self.shutdownRequested:
+            line = inp.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            out.write(json.dumps(self.doJobLine(line)) + "\n")
+            out.flush()
+
+    # The responses go to our standard output, and everything else that
+    # would have (e.g., a subprocess which inherits it) goes to
+    # standard error instead.
+
+    def serveStdio(self):
+        sys.stdout.flush()
+        out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        try:
+            self.serveStream(sys.stdin, out)
+        finally:
+            out.close()
+
+    # Each connection is served until the client closes it, and then
+    # we take the next one. If there's a socket at the path already, and
+    # nobody's listening, it's left over from an earlier daemon, and we
+    # remove it. The reader has to be buffered; an unbuffered readline()
+    # on a socket reads one byte at a time, which is hopeless for
+    # inline documents. serveStream() flushes the writer after each response.
+
+    def serveSocket(self, path):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                try:
+                    probe.connect(path)
+                except socket.error:
+                    os.remove(path)
+                else:
+                    raise EngineDaemonError, ("another daemon is listening on %s" % path)
+            finally:
+                probe.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+            server.listen(5)
+            while not self.shutdownRequested:
+                conn, ignore = server.accept()
+                inp = conn.makefile("rb")
+                out = conn.makefile("wb")
+                try:
+                    self.serveStream(inp, out)
+                finally:
+                    inp.close()
+                    out.close()
+                    conn.close()
+        finally:
+            server.close()
+            if os.path.exists(path):
+                os.remove(path)
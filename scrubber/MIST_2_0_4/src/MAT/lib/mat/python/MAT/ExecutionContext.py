@@ -11,6 +11,7 @@ _SUBPROCESS_STATISTICS = False
 _PRESERVE_TEMPFILES = False
 _DEBUG = False
 _VERBOSE_CONFIG = False
+_STEP_STATISTICS = None
 
 import tempfile, os, shutil
 
@@ -120,6 +121,29 @@ def setSubprocessStatistics(boolVal):
                 except ImportError:
                     pass
 
+# Every MATEngine which doesn't have its own StepStatistics records
+# its steps in this one, and it's saved to the path when the process
+# exits. See MAT.ToolChain.StepStatistics. It keeps at most maxEntries
+# entries (the most recent ones), so that a huge per-document run doesn't
+# eat the memory; the step totals still cover everything. This is for
+# processes which run and exit. The servers (MATWeb, MATEngineDaemon)
+# don't offer it; they return the statistics with each request instead.
+# The format is checked now, rather than when the process exits.
+
+STEP_STATISTICS_MAX_ENTRIES = 100000
+
+def setStepStatistics(path, perDocument = False, format = None,
+                      maxEntries = STEP_STATISTICS_MAX_ENTRIES):
+    global _STEP_STATISTICS
+    if path is None:
+        _STEP_STATISTICS = None
+    else:
+        import atexit
+        from MAT.ToolChain import StepStatistics
+        format = StepStatistics.saveFormat(path, format)
+        _STEP_STATISTICS = StepStatistics(perDocument = perDocument, maxEntries = maxEntries)
+        atexit.register(_STEP_STATISTICS.save, os.path.abspath(path), format = format)
+
 # Set a default from the configuration.
 
 if MATConfig.get("SUBPROCESS_DEBUG") == "yes":
@@ -135,7 +159,9 @@ def _printVersionAndExit(option, opt, value, parser):
     import sys
     sys.exit(1)
 
-def addOptions(optionBearer):
+# The servers pass stepStatistics = False; see setStepStatistics().
+
+def addOptions(optionBearer, stepStatistics = True):
     optionBearer.add_option("--version",
                             help = "Print version number and exit",
                             action = "callback",
@@ -150,6 +176,13 @@ def addOptions(optionBearer):
     optionBearer.add_option("--subprocess_statistics", dest = "subprocess_statistics",
                             action = "store_true",
                             help = "Enable subprocess statistics (memory/time), if the capability is available and it isn't globally enabled.")
+    if stepStatistics:
+        optionBearer.add_option("--step_statistics", dest = "step_statistics",
+                                metavar = "file",
+                                help = "Record the wall time, CPU time, document and character counts, and peak memory of each step the engine runs on each batch, and save them to the file when the program exits. The file is CSV if its name ends in .csv, JSON otherwise. Only the most recent %d entries are saved, but the step totals cover the whole run." % STEP_STATISTICS_MAX_ENTRIES)
+        optionBearer.add_option("--step_statistics_per_document", dest = "step_statistics_per_document",
+                                action = "store_true",
+                                help = "If --step_statistics is specified, also record the per-document steps for each document separately.")
     optionBearer.add_option("--tmpdir_root", dest = "tmpdir_root",
                             metavar = "dir",
                             help = "Override the default system location for temporary files. If the directory doesn't exist, it will be created. Use this feature to control where temporary files are created, for added security, or in conjunction with --preserve_tempfiles, as a debugging aid.")
@@ -169,6 +202,9 @@ def extractOptions(options):
         setSubprocessDebug(options.subprocess_debug)
     if options.subprocess_statistics is not None:
         setSubprocessStatistics(True)
+    if getattr(options, "step_statistics", None) is not None:
+        setStepStatistics(options.step_statistics,
+                          perDocument = options.step_statistics_per_document is not None)
     if options.debug is not None:
         setDebug(True)
     if options.verbose_config is not None:
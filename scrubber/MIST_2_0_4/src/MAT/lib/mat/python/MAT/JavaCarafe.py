@@ -183,7 +183,13 @@ class CarafeTagger(Tagger):
     # create CARAFE_INSTRUCTION - at the point of tagging, I'd only
     # have SEGMENT:annotator=MACHINE. See below.
 
-    def Process(self, annotSets, removeOverlaps = None, argsAreDirectories = True):
+    # removeOverlaps is a list of annotation labels which can't overlap
+    # each other; overlapPolicy is the policy for AnnotatedDoc.removeOverlaps().
+    # The discarded annotations are recorded in self.overlapReport, as
+    # (annotSet, discarded, kept, reason).
+    
+    def Process(self, annotSets, removeOverlaps = None, argsAreDirectories = True,
+                overlapPolicy = "earliest"):
 
         # At the moment, Carafe behaves as if it has a single region
         # for the whole document if it encounters no matching regions.
@@ -248,6 +254,8 @@ class CarafeTagger(Tagger):
                     except KeyError:
                         if curSeg and (seg.end <= curSeg.end):
                             toRemove.append(seg)
+                # We've changed the segment boundaries in place.
+                d._clearAnnotationIndex(["SEGMENT"])
                 # And we also need to remove all the content annotations
                 # which are in any of the regions. The regions will
                 # be ordered.
@@ -304,10 +312,16 @@ class CarafeTagger(Tagger):
                              # Only pass annotations which AREN'T the content annotations.
                              removeOnInput = contentTags,
                              mergeOnOutput = tagsToMerge)
+        self.overlapReport = []
         for annotSet in annotSets:
             annotSet.removeAnnotations(atypes = ["CARAFE_INSTRUCTION"])
             if removeOverlaps is not None:
-                annotSet.removeOverlaps(removeOverlaps)
+                for discarded, kept, reason in annotSet.removeOverlaps(removeOverlaps, policy = overlapPolicy):
+                    self.overlapReport.append((annotSet, discarded, kept, reason))
+        if self.overlapReport:
+            # One warning for the batch, rather than one per annotation.
+            print >> sys.stderr, "Warning: discarded %d overlapping annotation(s) in %d document(s)" % \
+                  (len(self.overlapReport), len(set([r[0] for r in self.overlapReport])))
 
     def _enhanceCmdline(self, s):
         s.extend(["--mode", "json", "--model", "%(tagger_model)s", "--region", "CARAFE_INSTRUCTION"],
@@ -810,11 +824,15 @@ class CarafeModelBuilder(MAT.ModelBuilder.ModelBuilder):
 
         # It used to be the case that we could just copy over documents which
         # were already in the right format. But now we have to find those segments
-        # which are useable, and mark them.
+        # which are useable, and mark them. The filter closes over the flag,
+        # rather than self, so that the regions can be cached (see
+        # processableRegions()).
+
+        goldOnly = self.partialTrainingOnGoldOnly
         
         def usableSeg(seg):
             if (seg.get("annotator") in [None, "MACHINE"]) or \
-               (self.partialTrainingOnGoldOnly and (seg.get("status") == "non-gold")):
+               (goldOnly and (seg.get("status") == "non-gold")):
                 return False
             else:
                 return True
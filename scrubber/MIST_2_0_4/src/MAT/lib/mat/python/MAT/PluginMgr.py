@@ -1564,6 +1564,48 @@ class PluginStep(Operation):
             pairsDone.append((fname, iData))
         return pairsDone
 
+    # Streaming. When MATEngine runs in streaming mode (see
+    # MATEngine.Run()), doBatch() is called on one chunk of documents
+    # at a time. That's fine for most steps, but a step which needs
+    # to see the whole batch before it can finish any document
+    # should set batchLevel to True and split its doBatch() into two
+    # passes: digestBatch() is called on every chunk in turn, then
+    # endBatchDigestion(), and then replaceBatch() on every chunk
+    # again, in the same order. The state is whatever
+    # startBatchStream() returns; nothing else survives between
+    # the passes, since the documents are saved and reloaded in
+    # between.
+
+    batchLevel = False
+
+    def startBatchStream(self, **kw):
+        return None
+
+    def digestBatch(self, state, iDataPairs, **kw):
+        raise PluginError, "not implemented"
+
+    def endBatchDigestion(self, state, **kw):
+        pass
+
+    def replaceBatch(self, state, iDataPairs, **kw):
+        raise PluginError, "not implemented"
+
+    # Sharding. When MATEngine runs with workers (see MATEngine.Run()),
+    # a per-document step's doBatch() is called in worker processes, each
+    # on its own slice of the documents. A step is per-document if each
+    # document's result depends only on that document. By default, that's
+    # any step which isn't batchLevel and uses the default doBatch();
+    # a step whose doBatch() is really per-document, or whose do()
+    # isn't, can set perDocument to True or False to say so.
+
+    perDocument = None
+
+    def isPerDocument(self):
+        if self.perDocument is not None:
+            return self.perDocument
+        return (not self.batchLevel) and \
+               (self.__class__.doBatch.im_func is PluginStep.doBatch.im_func)
+
     # Utilities.
 
     def getTrueZoneInfo(self):
@@ -1661,6 +1703,14 @@ class MultiStep(PluginStep):
             iDataPairs = [(fname, d[fname]) for fname in fOrder]
         return iDataPairs
 
+    def isPerDocument(self):
+        if self.perDocument is not None:
+            return self.perDocument
+        for p in self.proxies:
+            if not p.isPerDocument():
+                return False
+        return not self.batchLevel
+
     def isDone(self, annotSet):
         for p in self.proxies:
             if not p.isDone(annotSet):
@@ -1855,6 +1905,15 @@ class TagStep(PluginStep):
         else:
             return PluginStep.doBatch(self, iDataPairs, **kw)
 
+    # This doBatch() is per-document, but the ones in the
+    # children (e.g., the Carafe tagger) usually aren't.
+
+    def isPerDocument(self):
+        if self.perDocument is not None:
+            return self.perDocument
+        return (not self.batchLevel) and \
+               (self.__class__.doBatch.im_func is TagStep.doBatch.im_func)
+
     def findServers(self, serverTable):
         pass
 
@@ -1,7 +1,7 @@
 # Copyright (C) 2007 - 2009 The MITRE Corporation. See the toplevel
 # file LICENSE for license terms.
 
-import os, sys, traceback, codecs
+import os, sys, traceback, codecs, time
 from MAT import Error, PluginMgr, DocumentIO, Document
 
 class ConfigurationError(Exception):
@@ -37,10 +37,16 @@ class NoUsageConfigurationError(ConfigurationError):
 from MAT.Operation import XMLOpArgumentAggregator, OpArgument
 import MAT.ExecutionContext
 
+# If stepStatistics is a StepStatistics object (see below), the
+# engine records the cost of each step in it. Otherwise, it uses the
+# global one, if there is one (see MAT.ExecutionContext.setStepStatistics()).
+
 class MATEngine:
 
-    def __init__(self, taskObj = None, workflow = None, task = None, pluginDir = None):
+    def __init__(self, taskObj = None, workflow = None, task = None, pluginDir = None,
+                 stepStatistics = None):
         self.taskObj = taskObj
+        self.stepStatistics = stepStatistics
         if self.taskObj is None:
             # We need to find one.
             pluginDir = pluginDir or PluginMgr.LoadPlugins()
@@ -85,7 +91,7 @@ class MATEngine:
     # arguments. We need: input_file, input_dir, input_file_re,
     # input_encoding, input_file_type, output_file, output_dir,
     # output_fsuff, output_file_type, output_encoding, workflow, steps,
-    # print_steps, undo_through. I suppose I should be adding these
+    # print_steps, undo_through, prefetch, prefetch_mode, stream_chunk, workers, journal. I suppose I should be adding these
     # by making the MATEngine an option bearer, but that's just not
     # in the cards at the moment.
 
@@ -124,7 +130,12 @@ class MATEngine:
                      OpArgument("workflow", hasArg = True),
                      OpArgument("steps", hasArg = True),
                      OpArgument("print_steps", hasArg = True),
-                     OpArgument("undo_through", hasArg = True)]
+                     OpArgument("undo_through", hasArg = True),
+                     OpArgument("prefetch", hasArg = True),
+                     OpArgument("prefetch_mode", hasArg = True),
+                     OpArgument("stream_chunk", hasArg = True),
+                     OpArgument("workers", hasArg = True),
+                     OpArgument("journal", hasArg = True)]
     
     def aggregatorExtract(self, aggregator, failOnFileTypes = False, **params):
         aggregator.addOptions(self.INTERNAL_ARGS)
@@ -150,6 +161,27 @@ class MATEngine:
     # on the command line. Some of them are intended only to be used
     # internally, such inputFileList. 
 
+    # If stream_chunk is a positive number, the engine doesn't load
+    # all the documents at once. It reads them stream_chunk at a time,
+    # runs the steps on each chunk, and writes each chunk out as soon
+    # as it's done, so only a chunk or so is ever in memory. Steps which
+    # need to see the whole batch at once (see PluginStep.batchLevel)
+    # are run in two passes over the stream, and the documents are
+    # saved to a temporary directory in between. Since the documents
+    # aren't kept, Run() returns None in this case.
+
+    # If workers is greater than 1, the per-document steps are run
+    # by a pool of that many worker processes. See RunDataPairs().
+
+    # If journal is a path, each document is recorded in that file
+    # (see RunJournal) as soon as its output is written, and the
+    # documents it records as already done, with the same steps, are
+    # skipped. So a run which dies can be restarted with the same
+    # arguments, and it'll pick up where it left off; use stream_chunk
+    # too, so the outputs are written as it goes. Note that the documents
+    # which are skipped don't take part in the batch-level steps, and aren't
+    # among the pairs returned.
+
     def Run(self, input_file = None, input_dir = None, input_file_re = None,
             input_encoding = None, input_file_type = None, steps = None, undo_through = None,
             output_file = None, output_file_type = None, output_dir = None,
@@ -157,6 +189,9 @@ class MATEngine:
             # These three parameters might be passed in when this is called
             # programmatically, but not from the command line.
             inputFileList = None, inputFileType = None, outputFileType = None,
+            # See DocumentIOManager.configure().
+            prefetch = None, prefetch_mode = None,
+            stream_chunk = None, workers = None, journal = None,
             **params):
         
         # First, preprocess some of the arguments.
@@ -166,6 +201,22 @@ class MATEngine:
                 if steps == ['']:
                     steps = []
 
+        if stream_chunk is not None:
+            try:
+                stream_chunk = int(stream_chunk)
+            except ValueError:
+                raise ConfigurationError, (self, "stream_chunk must be an integer")
+            if stream_chunk < 0:
+                raise ConfigurationError, (self, "stream_chunk must not be negative")
+
+        if workers is not None:
+            try:
+                workers = int(workers)
+            except ValueError:
+                raise ConfigurationError, (self, "workers must be an integer")
+            if workers < 0:
+                raise ConfigurationError, (self, "workers must not be negative")
+
         # Make sure we have a task.
         self._ensureOperationalTask(steps, **params)
 
@@ -180,12 +231,49 @@ class MATEngine:
                          inputFileList = inputFileList,
                          inputFileType = inputFileType,
                          outputFileType = outputFileType,
+                         prefetch = prefetch, prefetch_mode = prefetch_mode,
                          **params)
         except DocumentIO.ManagerError, e:
             raise ConfigurationError, (self, str(e))
 
+        runJournal = None
+        if journal is not None:
+            if not dm.writesOutputFiles():
+                raise ConfigurationError, (self, "journal requires an output file or directory, which can't be an archive or standard output")
+            if input_file == "-":
+                raise ConfigurationError, (self, "journal can't be used with standard input")
+            try:
+                runJournal = RunJournal(journal, steps, undo_through)
+            except (IOError, ValueError), e:
+                raise ConfigurationError, (self, "can't open journal %s: %s" % (journal, e))
+            dm.filterInputFiles(lambda p: not runJournal.isDone(dm, p))
+
+        # The manager may have an output archive to finish.
+        try:
+            return self._runWithManager(dm, steps, undo_through, stream_chunk, workers,
+                                        runJournal = runJournal, **params)
+        finally:
+            dm.close()
+            if runJournal is not None:
+                runJournal.close()
+
+    def _runWithManager(self, dm, steps, undo_through, stream_chunk, workers,
+                        runJournal = None, **params):
+
         from MAT.ExecutionContext import _DEBUG
 
+        if stream_chunk:
+            for chunk in self._streamDataPairs(self._loadChunks(dm, stream_chunk),
+                                               steps, undo_through, workers = workers, **params):
+                if dm.isWriteable():
+                    for fname, Output in chunk:
+                        self._writeOutput(dm, fname, Output)
+                        if runJournal is not None:
+                            runJournal.record(dm, fname)
+                    if runJournal is not None:
+                        runJournal.sync()
+            return None
+
         try:
             # Now, create the idata pairs. We're not going to keep going,
             # so we ignore the skipPairs.
@@ -198,7 +286,8 @@ class MATEngine:
 
         # Central call. This is where the work gets done.
         
-        iDataPairs = self.RunDataPairs(inputPairs, steps, undoThrough = undo_through, **params)
+        iDataPairs = self.RunDataPairs(inputPairs, steps, undoThrough = undo_through,
+                                       workers = workers, **params)
         resultTable = {}
         for fname, iData in iDataPairs:
             resultTable[fname] = iData
@@ -206,28 +295,165 @@ class MATEngine:
         # And then the end.
 
         if dm.isWriteable():
-            # The complexity here is that the output may not be in the
-            # appropriate format to save. That is, if it's raw, then
-            # we have to turn the signal into a document. If the
-            # output file type is mat-json, utf-8 is automatically enforced.
             for fname, idata in inputPairs:
-                Output = resultTable[fname]
-                if type(Output) is type(""):
-                    Output = Document.AnnotatedDoc(signal = Output.decode('ascii'))
-                elif type(Output) is type(u''):
-                    Output = Document.AnnotatedDoc(signal = Output)
-                elif not isinstance(Output, Document.AnnotatedDoc):
-                    raise NoUsageConfigurationError, (self, "Output is neither text nor a document")
-                try:
-                    dm.writeDocument(fname, Output)
-                except Exception, e:
-                    if _DEBUG:                        
-                        raise
-                    else:
-                        raise NoUsageConfigurationError, (self, "Error opening file %s for writing." % fname)
+                self._writeOutput(dm, fname, resultTable[fname])
+                if runJournal is not None:
+                    runJournal.record(dm, fname)
+            if runJournal is not None:
+                runJournal.sync()
 
         return iDataPairs
 
+    def _writeOutput(self, dm, fname, Output):
+        from MAT.ExecutionContext import _DEBUG
+        # The complexity here is that the output may not be in the
+        # appropriate format to save. That is, if it's raw, then
+        # we have to turn the signal into a document. If the
+        # output file type is mat-json, utf-8 is automatically enforced.
+        if type(Output) is type(""):
+            Output = Document.AnnotatedDoc(signal = Output.decode('ascii'))
+        elif type(Output) is type(u''):
+            Output = Document.AnnotatedDoc(signal = Output)
+        elif not isinstance(Output, Document.AnnotatedDoc):
+            raise NoUsageConfigurationError, (self, "Output is neither text nor a document")
+        try:
+            dm.writeDocument(fname, Output)
+        except Exception, e:
+            if _DEBUG:                        
+                raise
+            else:
+                raise NoUsageConfigurationError, (self, "Error opening file %s for writing." % fname)
+        self.ReportOutputWritten(fname, dm.outputPath(fname))
+
+    #
+    # Streaming
+    #
+
+    # Yields lists of at most chunkSize (<fname>, <doc>) pairs.
+    
+    def _loadChunks(self, dm, chunkSize):
+        from MAT.ExecutionContext import _DEBUG
+        chunk = []
+        loader = dm.loadPairsIncrementally()
+        while True:
+            try:
+                fname, doc, ignore = loader.next()
+            except StopIteration:
+                break
+            except Exception, e:
+                if _DEBUG:
+                    raise
+                else:
+                    raise NoUsageConfigurationError, (self, str(e))
+            chunk.append((fname, doc))
+            if len(chunk) == chunkSize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # Splits the steps at the first batch-level step, following the
+    # order in which RunDataPairs() will look for them. Returns
+    # (<steps before>, <batch step object or None>, <steps after>).
+    # If the steps are out of order, or unknown, we don't split, and
+    # RunDataPairs() will complain on the first chunk.
+    
+    def _splitStepsAtBatchStep(self, steps):
+        if (not steps) or (not self.operationalTask.getWorkflows().has_key(self.workFlow)):
+            return steps, None, []
+        workflow = self.operationalTask.getWorkflows()[self.workFlow]
+        i = 0
+        for stepObj in workflow.stepList:
+            if (i < len(steps)) and (steps[i] == stepObj.stepName):
+                if stepObj.batchLevel:
+                    return steps[:i], stepObj, steps[i+1:]
+                i += 1
+        return steps, None, []
+
+    # Takes and yields chunks. If there's no batch-level step, each chunk
+    # just goes through RunDataPairs(). Otherwise, each chunk goes
+    # through the steps before the batch-level step, and is digested
+    # and saved as mat-bin; once they're all digested, each chunk is
+    # reloaded and replaced, and the result streams through the
+    # remaining steps (which may themselves have a batch-level step).
+    
+    def _streamDataPairs(self, chunks, steps, undoThrough, workers = None, **params):
+        before, batchStep, after = self._splitStepsAtBatchStep(steps)
+        if batchStep is None:
+            for chunk in chunks:
+                yield self.RunDataPairs(chunk, before, undoThrough = undoThrough,
+                                        workers = workers, **params)
+            return
+        localParams = self._stepParams(batchStep, params)
+        binIO = DocumentIO.getDocumentIO("mat-bin", task = self.operationalTask)
+        with MAT.ExecutionContext.Tmpdir() as spoolDir:
+            state = self._runBatchPass(batchStep, batchStep.startBatchStream, **localParams)
+            # The spool is a list of chunks of (<fname>, <path>, <data>),
+            # where the path is None if the data isn't a document.
+            spool = []
+            i = 0
+            for chunk in chunks:
+                chunk = self.RunDataPairs(chunk, before, undoThrough = undoThrough,
+                                          workers = workers, **params)
+                pairsToDo = [(fname, iData) for fname, iData in chunk
+                             if batchStep.stepCanBeDone(iData)]
+                if pairsToDo:
+                    self._runBatchPass(batchStep, batchStep.digestBatch, state, pairsToDo, **localParams)
+                spooled = []
+                for fname, iData in chunk:
+                    if isinstance(iData, Document.AnnotatedDoc):
+                        path = os.path.join(spoolDir, "%d.bin" % i)
+                        i += 1
+                        binIO.writeToTarget(iData, path)
+                        spooled.append((fname, path, None))
+                    else:
+                        spooled.append((fname, None, iData))
+                spool.append(spooled)
+            self._runBatchPass(batchStep, batchStep.endBatchDigestion, state, **localParams)
+
+            def replacedChunks():
+                for spooled in spool:
+                    chunk = []
+                    for fname, path, iData in spooled:
+                        if path is not None:
+                            iData = binIO.readFromSource(path)
+                            os.remove(path)
+                        chunk.append((fname, iData))
+                    pairsToDo = [(fname, iData) for fname, iData in chunk
+                                 if batchStep.stepCanBeDone(iData)]
+                    if pairsToDo:
+                        pairsDone = self._runBatchPass(batchStep, batchStep.replaceBatch,
+                                                       state, pairsToDo, **localParams)
+                        chunk = self._recordStepResults(batchStep, chunk, pairsDone)
+                    yield chunk
+
+            for chunk in self._streamDataPairs(replacedChunks(), after, None,
+                                               workers = workers, **params):
+                yield chunk
+
+    # The pairs, if the pass has any, are the last positional argument.
+    
+    def _runBatchPass(self, stepObj, meth, *args, **kw):
+        stats = self._getStepStatistics()
+        if stats is not None:
+            token = stats.startBatch()
+        try:
+            res = meth(*args, **kw)
+        except Exception, e:
+            if MAT.ExecutionContext._DEBUG:
+                raise
+            else:
+                raise Error.MATError(stepObj.stepName, str(e), show_tb = True)
+        if stats is not None:
+            stats.record(token, stepObj.stepName, meth.__name__,
+                         (len(args) > 1 and args[-1]) or [])
+        return res
+
+    def _getStepStatistics(self):
+        if self.stepStatistics is not None:
+            return self.stepStatistics
+        return MAT.ExecutionContext._STEP_STATISTICS
+
     # OK, time to introduce batch processing. Let's make iData 
     # a little more complicated than before; it should be a sequence
     # of (<fname>, <docobj>) pairs. The idea is that each step
@@ -249,8 +475,15 @@ class MATEngine:
     # an unordered set, and rely on the system to ensure the
     # operational order.
 
+    # If workers is greater than 1, each per-document step (see
+    # PluginStep.isPerDocument()) is run by a pool of that many worker
+    # processes, each working on a contiguous slice of the documents.
+    # The steps are recorded, and reported, in the same order as they
+    # would be otherwise; but the documents which come back are new
+    # objects, so use the pairs this returns.
+
     def RunDataPairs(self, iDataPairs, steps = None, 
-                     undoThrough = None, **params):
+                     undoThrough = None, workers = None, **params):
 
         self._ensureOperationalTask(steps, **params)
 
@@ -260,6 +493,8 @@ class MATEngine:
 
         workflow = self.operationalTask.getWorkflows()[self.workFlow]
 
+        stats = self._getStepStatistics()
+
         if undoThrough is not None:
             try:
                 successors = self.operationalTask.getStepSuccessors()[undoThrough]
@@ -283,10 +518,16 @@ class MATEngine:
                     # This workflow doesn't have this step. Get the default step.
                     successorStep = self.operationalTask.getDefaultStep(successor)
                 try:
+                    if stats is not None:
+                        token = stats.startBatch()
+                    pairsUndone = []
                     for fname, iData in iDataPairs:
                         if successor in iData.getStepsDone():
                             successorStep.undo(iData)
                             iData.stepUndone(successor)
+                            pairsUndone.append((fname, iData))
+                    if (stats is not None) and pairsUndone:
+                        stats.record(token, successor, "undo", pairsUndone)
                     self.ReportBatchUndoStepResult(successorStep, iDataPairs)
                 except Exception, e:
                     if MAT.ExecutionContext._DEBUG:
@@ -306,48 +547,38 @@ class MATEngine:
 
             if steps and (steps[0] == stepName):
             
-                localParams = params
-                if stepObj.runSettings:
-                    # So we have to be very, very careful not to have
-                    # extra values in either the stepObj params or in the
-                    # cmdline params. At one point, the cmdline params
-                    # were reporting defaults too aggressively,  and it wasn't
-                    # possible to distinguish between an explicitly specified
-                    # value and a default value. Now,  it should be cleanly
-                    # managed. I've also fixed the same thing for
-                    # the step values.
-                    localParams = stepObj.enhanceAndExtract(XMLOpArgumentAggregator(stepObj.runSettings))
-                    # NOW we can override with the command line.
-                    for key, val in params.items():
-                        if val is not None:
-                            localParams[key] = val
+                localParams = self._stepParams(stepObj, params)
                 
                 # Filter the ones which need to be done. 
                 pairsToDo = [(fname, iData) for fname, iData in iDataPairs
                              if stepObj.stepCanBeDone(iData)]
                 if pairsToDo: 
-                    fOrder = [fname for fname, iData in iDataPairs]
-                    d = dict(iDataPairs)
-
+                    recordFor = None
+                    if stats is not None:
+                        token = stats.startBatch()
                     try:
-                        pairsDone = stepObj.doBatch(pairsToDo, **localParams)
+                        if self._canShard(stepObj, pairsToDo, workers):
+                            pairsDone, recordFor = self._shardedDoBatch(stepObj, pairsToDo, workers,
+                                                                        localParams)
+                        elif (stats is not None) and stats.perDocument and stepObj.isPerDocument():
+                            # One at a time, so each document can be measured.
+                            pairsDone = []
+                            for pair in pairsToDo:
+                                docToken = stats.startDocument(token)
+                                pairsDone.extend(stepObj.doBatch([pair], **localParams))
+                                stats.record(docToken, stepName, "doBatch", [pair], fname = pair[0])
+                        else:
+                            pairsDone = stepObj.doBatch(pairsToDo, **localParams)
                     except Exception, e:
                         if MAT.ExecutionContext._DEBUG:
                             raise
                         else:
                             raise Error.MATError(stepName, str(e), show_tb = True)
+                    if stats is not None:
+                        stats.record(token, stepName, "doBatch", pairsToDo)
 
-                    # Update the dictionary and reconstitute iDataPairs.
-                    # Only record the step done if the output object is the same as
-                    # the input object.
-                    for fname, iData in pairsDone:
-                        oldData = d[fname]
-                        if (iData is oldData) and \
-                           isinstance(iData, Document.AnnotatedDoc):
-                            iData.recordStep(stepName)
-                        d[fname] = iData
-                    self.ReportBatchStepResult(stepObj, pairsDone)
-                    iDataPairs = [(fname, d[fname]) for fname in fOrder]
+                    iDataPairs = self._recordStepResults(stepObj, iDataPairs, pairsDone,
+                                                         recordFor = recordFor)
                 
                 steps[0:1] = []
 
@@ -356,6 +587,104 @@ class MATEngine:
 
         return iDataPairs
 
+    def _stepParams(self, stepObj, params):
+        localParams = params
+        if stepObj.runSettings:
+            # So we have to be very, very careful not to have
+            # extra values in either the stepObj params or in the
+            # cmdline params. At one point, the cmdline params
+            # were reporting defaults too aggressively,  and it wasn't
+            # possible to distinguish between an explicitly specified
+            # value and a default value. Now,  it should be cleanly
+            # managed. I've also fixed the same thing for
+            # the step values.
+            localParams = stepObj.enhanceAndExtract(XMLOpArgumentAggregator(stepObj.runSettings))
+            # NOW we can override with the command line.
+            for key, val in params.items():
+                if val is not None:
+                    localParams[key] = val
+        return localParams
+
+    # If recordFor is not None, it's the set of files whose output
+    # object was the same as the input object in the worker that
+    # produced it (see _shardedDoBatch()).
+
+    def _recordStepResults(self, stepObj, iDataPairs, pairsDone, recordFor = None):
+        # Update the dictionary and reconstitute iDataPairs.
+        # Only record the step done if the output object is the same as
+        # the input object.
+        fOrder = [fname for fname, iData in iDataPairs]
+        d = dict(iDataPairs)
+        for fname, iData in pairsDone:
+            if recordFor is None:
+                sameObj = iData is d[fname]
+            else:
+                sameObj = fname in recordFor
+            if sameObj and isinstance(iData, Document.AnnotatedDoc):
+                iData.recordStep(stepObj.stepName)
+            d[fname] = iData
+        self.ReportBatchStepResult(stepObj, pairsDone)
+        return [(fname, d[fname]) for fname in fOrder]
+
+    #
+    # Sharding
+    #
+
+    # We don't shard in debug mode, so the errors come out where they happen.
+    # And we only know how to ship plain documents.
+    
+    def _canShard(self, stepObj, pairsToDo, workers):
+        if (not workers) or (workers < 2) or (len(pairsToDo) < 2) or \
+           (not hasattr(os, "fork")) or MAT.ExecutionContext._DEBUG:
+            return False
+        if not stepObj.isPerDocument():
+            return False
+        for fname, iData in pairsToDo:
+            if getattr(iData, "__class__", None) is not Document.AnnotatedDoc:
+                return False
+        return True
+
+    # The documents go to the workers, and come back, as mat-bin. The
+    # workers are forked for each step, with the step and its parameters
+    # in _SHARD_STEP, so the parameters never have to be pickled. Each
+    # slice gets its own random seed, drawn from ours, so the
+    # workers don't all make the same random choices. Returns the pairs
+    # done, in order, and the set of files to record the step for.
+    
+    def _shardedDoBatch(self, stepObj, pairsToDo, workers, localParams):
+        global _SHARD_STEP
+        import multiprocessing, random
+        binIO = DocumentIO.getDocumentIO("mat-bin", task = self.operationalTask)
+        nShards = min(len(pairsToDo), workers * _SHARDS_PER_WORKER)
+        seedBase = random.getrandbits(64)
+        shards = []
+        for i in range(nShards):
+            shardPairs = pairsToDo[(i * len(pairsToDo)) / nShards:((i + 1) * len(pairsToDo)) / nShards]
+            shards.append((seedBase, i, [(fname, binIO.writeToByteSequence(iData))
+                                         for fname, iData in shardPairs]))
+        _SHARD_STEP = (self, stepObj, localParams)
+        try:
+            pool = multiprocessing.Pool(workers)
+        finally:
+            _SHARD_STEP = None
+        try:
+            results = pool.map(_shardDoBatch, shards, 1)
+        finally:
+            pool.terminate()
+            pool.join()
+        pairsDone = []
+        recordFor = set()
+        for shardResults, err in results:
+            if err is not None:
+                raise PluginMgr.PluginError, err
+            for fname, sameObj, isDoc, data in shardResults:
+                if isDoc:
+                    data = binIO.readFromByteSequence(data, taskSeed = self.operationalTask)
+                if sameObj:
+                    recordFor.add(fname)
+                pairsDone.append((fname, data))
+        return pairsDone, recordFor
+
     def ReportBatchStepResult(self, stepObj, iDataPairs):
         # This can be overridden, if desired.
         for fname, iData in iDataPairs:
@@ -372,3 +701,297 @@ class MATEngine:
     def ReportUndoStepResult(self, stepObj, fname, iData):
         pass
 
+    # outputPath is None if the output doesn't go to a file of
+    # its own (see DocumentIOManager.outputPath()).
+    
+    def ReportOutputWritten(self, fname, outputPath):
+        pass
+
+# The worker for MATEngine._shardedDoBatch(). The error, if
+# there is one, comes back as a string, since the MAT errors
+# can't be unpickled.
+
+_SHARD_STEP = None
+
+_SHARDS_PER_WORKER = 4
+
+def _shardDoBatch((seedBase, i, shard)):
+    import random
+    engine, stepObj, localParams = _SHARD_STEP
+    random.seed((seedBase, i))
+    binIO = DocumentIO.getDocumentIO("mat-bin", task = engine.operationalTask)
+    try:
+        pairs = [(fname, binIO.readFromByteSequence(s, taskSeed = engine.operationalTask))
+                 for fname, s in shard]
+        d = dict(pairs)
+        results = []
+        for fname, iData in stepObj.doBatch(pairs, **localParams):
+            if isinstance(iData, Document.AnnotatedDoc):
+                results.append((fname, iData is d[fname], True, binIO.writeToByteSequence(iData)))
+            else:
+                results.append((fname, False, False, iData))
+        return results, None
+    except Exception, e:
+        return None, str(e)
+
+#
+# Journals
+#
+
+# A RunJournal is a file of JSON objects, one per line, each recording
+# a document whose output has been written: the input path and the SHA-1
+# of its contents, the steps (and undo_through), and the output path and the
+# SHA-1 of its contents. A document is done if its latest entry has
+# the same steps, and both its input and its output are unchanged.
+# Entries are only ever appended, so if the run dies in the middle of
+# one, we ignore the fragment.
+
+def _sha1(s):
+    import hashlib
+    return hashlib.sha1(s).hexdigest()
+
+class RunJournal:
+
+    def __init__(self, path, steps, undoThrough):
+        from MAT import json
+        self.path = path
+        self.steps = list(steps or [])
+        self.undoThrough = undoThrough
+        self.entries = {}
+        needsNewline = False
+        if os.path.exists(path):
+            fp = open(path, "rb")
+            s = fp.read()
+            fp.close()
+            needsNewline = s and (not s.endswith("\n"))
+            for line in s.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if type(entry) is dict and entry.has_key("input"):
+                    self.entries[entry["input"]] = entry
+        self.fp = open(path, "ab")
+        if needsNewline:
+            self.fp.write("\n")
+
+    def isDone(self, dm, fname):
+        entry = self.entries.get(fname)
+        if (entry is None) or (entry.get("steps") != self.steps) or \
+           (entry.get("undo_through") != self.undoThrough):
+            return False
+        outPath = dm.outputPath(fname)
+        if (entry.get("output") != outPath) or (not os.path.isfile(outPath)):
+            return False
+        try:
+            fp = open(outPath, "rb")
+            try:
+                outHash = _sha1(fp.read())
+            finally:
+                fp.close()
+            return (outHash == entry.get("output_hash")) and \
+                   (_sha1(dm.readInputBytes(fname)) == entry.get("input_hash"))
+        except (IOError, DocumentIO.LoadError):
+            return False
+
+    # Call this after the output for fname is written.
+    
+    def record(self, dm, fname):
+        from MAT import json
+        outPath = dm.outputPath(fname)
+        fp = open(outPath, "rb")
+        try:
+            outHash = _sha1(fp.read())
+        finally:
+            fp.close()
+        entry = {"input": fname, "input_hash": _sha1(dm.readInputBytes(fname)),
+                 "steps": self.steps, "undo_through": self.undoThrough,
+                 "output": outPath, "output_hash": outHash}
+        self.entries[fname] = entry
+        self.fp.write(json.dumps(entry) + "\n")
+        self.fp.flush()
+
+    # Makes sure what's been recorded survives a crash.
+    
+    def sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        if self.fp is not None:
+            self.sync()
+            self.fp.close()
+            self.fp = None
+
+#
+# Step statistics
+#
+
+# A StepStatistics object records, for each step the engine runs on
+# each batch, the wall time and CPU time in seconds, the number of
+# documents and signal characters, and the peak RSS so far, in
+# kilobytes. The CPU time and the peak RSS include the worker
+# processes, if there are any. This costs a couple of system calls
+# per step per batch, so it can be left on.
+
+# The phase is the step method which was run: "doBatch" or "undo", or,
+# when the batch-level steps are streamed, "startBatchStream",
+# "digestBatch", "endBatchDigestion" or "replaceBatch".
+
+# If perDocument is true, the per-document steps (see
+# PluginStep.isPerDocument()) are run a document at a time, and each
+# document gets its own entry, with the file name, ahead of the entry for its
+# batch. Documents which are sharded across workers don't get their own entries.
+
+# The global one (see MAT.ExecutionContext) may be shared by the
+# threads of the web service, so the batch numbers and entries are
+# locked.
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _cpuSeconds():
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+def _peakRSSKB():
+    if resource is None:
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # The Mac reports it in bytes.
+    if sys.platform == "darwin":
+        rss = rss / 1024
+    return rss
+
+class StepStatistics:
+
+    FIELDS = ["batch", "step", "phase", "file", "documents", "characters",
+              "wall_time", "cpu_time", "peak_rss_kb"]
+
+    # If maxEntries is set, only the most recent maxEntries entries
+    # are kept (droppedEntries counts the others). The totals in
+    # summarize() are kept as we go, so they still cover everything.
+
+    def __init__(self, perDocument = False, maxEntries = None):
+        import threading
+        self.perDocument = perDocument
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        from collections import deque
+        self.entries = deque(maxlen = self.maxEntries)
+        self.droppedEntries = 0
+        self._totals = {}
+        self._totalsOrder = []
+        self._lastBatch = 0
+
+    # Returns the token to pass to record().
+    
+    def startBatch(self):
+        with self._lock:
+            self._lastBatch += 1
+            batch = self._lastBatch
+        return (batch, time.time(), _cpuSeconds())
+
+    def startDocument(self, batchToken):
+        return (batchToken[0], time.time(), _cpuSeconds())
+
+    def record(self, token, stepName, phase, iDataPairs, fname = None):
+        batch, wallStart, cpuStart = token
+        chars = 0
+        for ignore, iData in iDataPairs:
+            if isinstance(iData, Document.AnnotatedDoc):
+                chars += len(iData.signal)
+            elif isinstance(iData, basestring):
+                chars += len(iData)
+        entry = {"batch": batch, "step": stepName, "phase": phase, "file": fname,
+                 "documents": len(iDataPairs), "characters": chars,
+                 "wall_time": time.time() - wallStart,
+                 "cpu_time": _cpuSeconds() - cpuStart,
+                 "peak_rss_kb": _peakRSSKB()}
+        with self._lock:
+            if len(self.entries) == self.maxEntries:
+                self.droppedEntries += 1
+            self.entries.append(entry)
+            if fname is None:
+                self._addToTotals(entry)
+
+    # The totals for each step and phase, in the order they were first seen.
+    # The per-document entries don't count, since their batches already do.
+
+    def _addToTotals(self, e):
+        key = (e["step"], e["phase"])
+        t = self._totals.get(key)
+        if t is None:
+            t = self._totals[key] = {"step": e["step"], "phase": e["phase"], "batches": 0,
+                                     "documents": 0, "characters": 0,
+                                     "wall_time": 0.0, "cpu_time": 0.0, "peak_rss_kb": None}
+            self._totalsOrder.append(key)
+        t["batches"] += 1
+        for k in ["documents", "characters", "wall_time", "cpu_time"]:
+            t[k] += e[k]
+        if e["peak_rss_kb"] is not None:
+            t["peak_rss_kb"] = max(t["peak_rss_kb"], e["peak_rss_kb"])
+    
+    def summarize(self):
+        with self._lock:
+            return [self._totals[key].copy() for key in self._totalsOrder]
+
+    def asJSONObj(self):
+        with self._lock:
+            entries = list(self.entries)
+            dropped = self.droppedEntries
+        return {"steps": self.summarize(), "entries": entries, "dropped_entries": dropped}
+
+    # The format is "json" or "csv". If it's not given, it's "csv" if
+    # the path ends in .csv, "json" otherwise. The CSV has only the
+    # entries, one per row, in the order of FIELDS.
+    
+    # The format is "json" or "csv"; if it's None, it's "csv" if the
+    # path ends in .csv, and "json" otherwise.
+
+    @staticmethod
+    def saveFormat(path, format = None):
+        if format is None:
+            if path.lower().endswith(".csv"):
+                return "csv"
+            else:
+                return "json"
+        elif format not in ("json", "csv"):
+            raise ValueError, ("unknown step statistics format '%s'" % format)
+        return format
+
+    def save(self, path, format = None):
+        format = self.saveFormat(path, format)
+        if format == "json":
+            from MAT import json
+            fp = open(path, "w")
+            try:
+                json.dump(self.asJSONObj(), fp, indent = 2)
+            finally:
+                fp.close()
+        else:
+            import csv
+            fp = open(path, "wb")
+            try:
+                w = csv.writer(fp)
+                w.writerow(self.FIELDS)
+                with self._lock:
+                    entries = list(self.entries)
+                for e in entries:
+                    row = []
+                    for k in self.FIELDS:
+                        v = e[k]
+                        if v is None:
+                            v = ""
+                        elif type(v) is unicode:
+                            v = v.encode("utf-8")
+                        row.append(v)
+                    w.writerow(row)
+            finally:
+                fp.close()
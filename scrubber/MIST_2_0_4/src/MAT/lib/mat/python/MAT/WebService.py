@@ -594,7 +594,10 @@ class WebService:
     # undo_through has undo_through. Duh. undo_through won't call
     # setSuccess.
         
-    def steps(self, steps = None, undo_through = None, **kw):
+    # If step_statistics is "yes" or "per_document", the result
+    # also has the stepStatistics for the steps (see MAT.ToolChain.StepStatistics).
+
+    def steps(self, steps = None, undo_through = None, step_statistics = None, **kw):
 
         OutputObj = {"error": None,
                      "errorStep": None,
@@ -609,7 +612,8 @@ class WebService:
 
         UNDO_THROUGH = None
 
-        INPUT = self._stepsCore(OutputObj, STEPS, UNDO_THROUGH, **kw)
+        INPUT = self._stepsCore(OutputObj, STEPS, UNDO_THROUGH,
+                                _getfirst(step_statistics), **kw)
 
         # Make sure all the annotated documents are encoded.
 
@@ -619,7 +623,7 @@ class WebService:
 
         return OutputObj
 
-    def undo_through(self, steps = None, undo_through = None, **kw):
+    def undo_through(self, steps = None, undo_through = None, step_statistics = None, **kw):
 
         OutputObj = {"error": None,
                      "errorStep": None,
@@ -628,14 +632,15 @@ class WebService:
 
         UNDO_THROUGH = _getfirst(undo_through)
 
-        INPUT = self._stepsCore(OutputObj, STEPS, UNDO_THROUGH, **kw)
+        INPUT = self._stepsCore(OutputObj, STEPS, UNDO_THROUGH,
+                                _getfirst(step_statistics), **kw)
 
         # Insert the modified document.
         OutputObj["doc"] = _jsonIO.renderJSONObj(INPUT)
 
         return OutputObj
 
-    def _stepsCore(self, outputObj, steps, undoThrough, **kw):
+    def _stepsCore(self, outputObj, steps, undoThrough, stepStatistics, **kw):
 
         STEPS = steps
         UNDO_THROUGH = undoThrough
@@ -711,9 +716,13 @@ class WebService:
                 setError(OutputObj, str(e), "[init]")
 
             if not LoadFailed:
+                STATS = None
+                if stepStatistics in ("yes", "per_document"):
+                    from MAT.ToolChain import StepStatistics
+                    STATS = StepStatistics(perDocument = (stepStatistics == "per_document"))
                 try:
                     engine = CGIMATEngine(OutputObj, taskObj = TASK_OBJ,
-                                          workflow = WORKFLOW)
+                                          workflow = WORKFLOW, stepStatistics = STATS)
                     engine.RunDataPairs([("<cgi>", INPUT)], steps = STEPS[:],
                                         pluginDir = plugins, undoThrough = UNDO_THROUGH, **pDir)
                 except MAT.Error.MATError, e:
@@ -726,6 +735,8 @@ class WebService:
                         #import traceback
                         #errstr = errstr + traceback.format_exc()
                     setError(OutputObj, errstr, e.phase)
+                if STATS is not None:
+                    OutputObj["stepStatistics"] = STATS.asJSONObj()
 
         return INPUT
 
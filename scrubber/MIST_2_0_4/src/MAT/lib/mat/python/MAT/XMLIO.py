@@ -241,6 +241,15 @@ class _ParserState:
 
 from MAT.Operation import OpArgument, OptionTemplate
 
+# Earliest start, latest end.
+
+def _annotNestingKey(annot):
+    return (annot.start, -annot.end)
+
+# The largest piece of the signal the writer produces at once.
+
+_SIGNAL_SEGMENT = 1 << 16
+
 class XMLDocumentIO(DocumentFileIO):
 
     def __init__(self, xml_input_is_overlay = False, xml_translate_all = False, signal_is_xml = False,
@@ -272,15 +281,29 @@ class XMLDocumentIO(DocumentFileIO):
         state = _ParserState(annotDoc, self.xmlInputIsOverlay, self.xmlTranslateAll or (not annotDoc.atypeRepository.globalTypeRepository))
         state.parse(s)        
     
+    # The writer computes the boundary events once, and then produces
+    # the output a piece at a time, so writeToTarget() can stream
+    # it to the file without ever holding the whole thing.
+    
     def writeToUnicodeString(self, annotDoc):
+        return "".join(self._xmlSegments(annotDoc))
+
+    def _writeToStream(self, annotDoc, write, encoding = None):
+        for seg in self._xmlSegments(annotDoc):
+            if encoding is None:
+                write(seg)
+            else:
+                write(seg.encode(encoding))
+
+    def _xmlSegments(self, annotDoc):
         signalIsXML = self.signalIsXML or \
                       (annotDoc.metadata.has_key("signal_type") and
                        annotDoc.metadata["signal_type"] == "xml")
         # Get all the annotations. Let's not care about overlap right now,
         # since overlap will happen if I'm writing everything out, because
         # it'll be nested. So just get the annotations and then
-        # sort them, and if we ever get a crossing dependency, we'll
-        # have to check otherwise.
+        # sort them. Note that crossing annotations aren't caught;
+        # they'll produce ill-formed XML.
         # Split the atypes into spanned and spanless.
         spanned = []
         spanless = []
@@ -302,28 +325,7 @@ class XMLDocumentIO(DocumentFileIO):
             spanlessAnnots = annotDoc.getAnnotations(atypes = spanless)
         # We now know they can nest. So let's sort them.        
         # Sort them first by earliest start, latest end.
-        annots.sort(self._cmpAnnot)
-        # Now, I can loop through the annots, and keep a stack,
-        # and we know when to pop the stack because of
-        # how the indexes work.
-        indices = {}
-        lastAnnot = None
-        for annot in annots:
-            if lastAnnot and \
-               (((lastAnnot.start < annot.start) and (lastAnnot.end < annot.end)) or \
-                ((lastAnnot.start > annot.start) and (lastAnnot.end > annot.end))):
-                raise SaveError, "crossing dependencies"
-            try:
-                indices[annot.start][0].append(annot)
-            except KeyError:
-                indices[annot.start] = [[annot], []]
-            try:
-                indices[annot.end][1].append(annot)
-            except KeyError:
-                indices[annot.end] = [[], [annot]]
-        indexList = indices.keys()
-        indexList.sort()
-        segs = []
+        annots.sort(key = _annotNestingKey)
         # So we need to add a toplevel XML tag if we don't already have one, and if
         # we're not adding our own info.
         # The signal is not XML, and
@@ -340,44 +342,72 @@ class XMLDocumentIO(DocumentFileIO):
                   (annots[0].end < len(annotDoc.signal)) or \
                   spanlessAnnots or \
                   (not self.excludeMetadata))
+        return self._generateSegments(annotDoc, self._boundaryEvents(annots),
+                                      spanlessAnnots, signalIsXML, addTop)
+
+    # Returns a list of (<offset>, <annots starting>, <annots ending>),
+    # sorted by offset. The starts are outermost first, and the
+    # ends are innermost first.
+    
+    def _boundaryEvents(self, annots):
+        indices = {}
+        for annot in annots:
+            try:
+                indices[annot.start][0].append(annot)
+            except KeyError:
+                indices[annot.start] = [[annot], []]
+            try:
+                indices[annot.end][1].append(annot)
+            except KeyError:
+                indices[annot.end] = [[], [annot]]
+        events = []
+        for i in sorted(indices.keys()):
+            [starts, ends] = indices[i]
+            # Reverse the ends.
+            ends.reverse()
+            events.append((i, starts, ends))
+        return events
+
+    def _generateSegments(self, annotDoc, events, spanlessAnnots, signalIsXML, addTop):
+        signal = annotDoc.signal
         if addTop:
-            segs.append("<__top>")
+            yield "<__top>"
         pos = 0
         atypesInserted = False
-        for i in indexList:
+        for i, starts, ends in events:
             if pos < i:
-                seg = annotDoc.signal[pos:i]
-                if not signalIsXML:
-                    seg = xml.sax.saxutils.escape(seg)
-                segs.append(seg)
+                for seg in self._signalSegments(signal, pos, i, signalIsXML):
+                    yield seg
                 pos = i
-            [starts, ends] = indices[i]
-            # Reverse the ends.
-            ends.reverse()
             for endAnnot in ends:
-                segs.append("</" + endAnnot.atype.lab + ">")
+                yield "</" + endAnnot.atype.lab + ">"
             for startAnnot in starts:
                 if not atypesInserted:
                     if not self.excludeMetadata:
-                        segs.append(self._formatAtypes(annotDoc))
+                        yield self._formatAtypes(annotDoc)
                     atypesInserted = True
                     if spanlessAnnots:
                         for sAnnot in spanlessAnnots:
-                            segs.append(self._formatAnnot(sAnnot, spanless = True))
-                segs.append(self._formatAnnot(startAnnot))
-        if pos < len(annotDoc.signal):
-            seg = annotDoc.signal[pos:]
-            if not signalIsXML:
-                seg = xml.sax.saxutils.escape(seg)
-            segs.append(seg)
+                            yield self._formatAnnot(sAnnot, spanless = True)
+                yield self._formatAnnot(startAnnot)
+        if pos < len(signal):
+            for seg in self._signalSegments(signal, pos, len(signal), signalIsXML):
+                yield seg
         if addTop:
-            segs.append("</__top>")
+            yield "</__top>"
         if not self.excludeMetadata:
-            segs.append("<!-- _mat_metadata_ "+ base64.b64encode(json.dumps(annotDoc.metadata)) + " -->")
-        return "".join(segs)
+            yield "<!-- _mat_metadata_ "+ base64.b64encode(json.dumps(annotDoc.metadata)) + " -->"
 
-    def _cmpAnnot(self, ann1, ann2):
-        return cmp(ann1.start, ann2.start) or -cmp(ann1.end, ann2.end)
+    # Escaping only looks at single characters, so we can
+    # escape a piece at a time.
+    
+    def _signalSegments(self, signal, start, end, signalIsXML):
+        while start < end:
+            seg = signal[start:min(end, start + _SIGNAL_SEGMENT)]
+            if not signalIsXML:
+                seg = xml.sax.saxutils.escape(seg)
+            yield seg
+            start += _SIGNAL_SEGMENT
 
     def _formatAtypes(self, annotDoc):
         segs = ["<_mat:atypes>"]
@@ -42,6 +42,7 @@ import MAT.Operation
 import MAT.Workspace
 import MAT.DocumentIO
 import MAT.XMLIO
+import MAT.BinaryIO
 import MAT.WebClient
 import MAT.ReconciliationDocument
 import MAT.ComparisonDocument
@@ -0,0 +1,241 @@
+# Copyright (C) 2007 - 2009 The MITRE Corporation. See the toplevel
+# file LICENSE for license terms.
+
+# Some simple benchmarks for the document internals. These aren't
+# unit tests (they don't assert anything, and they take a while), so
+# they're not named mat_*_unittest.py and mat_unittest.py won't
+# pick them up. Run them by hand:
+
+# python mat_benchmark.py [ --tokens <n> ] [ --annotations <n> ] benchmark...
+
+import sys, os, time
+
+MAT_HOME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(MAT_HOME, "lib", "mat", "python"))
+import MAT
+
+import MAT.Document, resource
+
+# A document with nTokens five-character tokens, separated by single spaces,
+# with a sentence every 20 tokens.
+
+def _makeTokenizedDoc(nTokens):
+    d = MAT.Document.AnnotatedDoc(u"abcde " * nTokens)
+    lexType = d.findAnnotationType("lex")
+    sType = d.findAnnotationType("SENTENCE")
+    for i in range(nTokens):
+        d.createAnnotation(i * 6, (i * 6) + 5, lexType)
+        if i % 20 == 19:
+            d.createAnnotation((i - 19) * 6, (i * 6) + 5, sType)
+    return d
+
+def _maxRSSKB():
+    # On Linux, this is in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# This is the layout annotations had before they used __slots__, as
+# a point of comparison.
+
+class _DictAnnotation:
+    def __init__(self, doc, start, end, atype, attrs):
+        self.doc = doc
+        self.id = None
+        self.atype = atype
+        self.attrs = attrs
+        self.start = start
+        self.end = end
+
+def _annotSize(a):
+    size = sys.getsizeof(a) + sys.getsizeof(a.attrs)
+    try:
+        size += sys.getsizeof(a.__dict__)
+    except AttributeError:
+        pass
+    return size
+
+def memoryBenchmark(nTokens, nAnnots):
+    print "Tokens:", nTokens
+    # Do the lazy tokens first, since we can only see the peak RSS.
+    startRSS = _maxRSSKB()
+    lazyD = MAT.Document.AnnotatedDoc(u"abcde " * nTokens)
+    lazyD.createLazyAnnotations("lex", range(0, nTokens * 6, 6), range(5, nTokens * 6, 6))
+    lazyRSS = _maxRSSKB()
+    print "Peak RSS growth building the document with lazy tokens: %.1f MB" % ((lazyRSS - startRSS) / 1024.0)
+    startRSS = lazyRSS
+    d = _makeTokenizedDoc(nTokens)
+    docRSS = _maxRSSKB()
+    toks = d.orderAnnotations(["lex"])
+    idx = d.atypeDict[d.anameDict["lex"]]._getIndex()
+    indexRSS = _maxRSSKB()
+    slotSize = _annotSize(toks[0])
+    dictSize = _annotSize(_DictAnnotation(d, 0, 5, toks[0].atype, []))
+    print "Bytes per token annotation, __slots__:", slotSize
+    print "Bytes per token annotation, __dict__:", dictSize
+    print "Estimated savings for token annotations: %.1f MB" % ((dictSize - slotSize) * nTokens / (1024.0 * 1024.0))
+    print "Bytes per token in the index start/end columns:", \
+          (idx.starts.itemsize + idx.ends.itemsize)
+    print "Peak RSS growth building the document: %.1f MB" % ((docRSS - startRSS) / 1024.0)
+    print "Peak RSS growth building the index: %.1f MB" % ((indexRSS - docRSS) / 1024.0)
+
+# Retagging: what CarafeTagger.Process does to a document before it
+# retags it, namely remove all the content annotations in the regions
+# being tagged, and then what the tagger does afterward, namely add
+# the new ones.
+
+def _makeContentDoc(nTokens, nAnnots):
+    d = _makeTokenizedDoc(nTokens)
+    pType = d.findAnnotationType("PERSON")
+    step = max(1, nTokens / nAnnots)
+    for i in range(nAnnots):
+        t = (i * step) % nTokens
+        d.createAnnotation(t * 6, (t * 6) + 5, pType)
+    return d
+
+def retagBenchmark(nTokens, nAnnots):
+    print "Tokens:", nTokens, "Content annotations:", nAnnots
+    d = _makeContentDoc(nTokens, nAnnots)
+    d.orderAnnotations(["PERSON"])
+    toRemove = d.getAnnotations(["PERSON"])
+    t0 = time.time()
+    d.removeAnnotationGroup(toRemove)
+    t1 = time.time()
+    print "Removing the annotations as a group: %.3f sec" % (t1 - t0)
+    for a in toRemove:
+        d._addAnnotation(a)
+    t2 = time.time()
+    print "Adding them back: %.3f sec" % (t2 - t1)
+    d.orderAnnotations(["PERSON"])
+    # This is how removeAnnotationGroup used to work.
+    t3 = time.time()
+    d.atypeRepository.removeAnnotationIDs(toRemove)
+    for a in toRemove:
+        d.atypeDict[a.atype].remove(a)
+    t4 = time.time()
+    print "Removing the annotations one at a time: %.3f sec" % (t4 - t3)
+
+# Reading MAT-JSON: the streaming reader vs. json.loads and then
+# walking the tree.
+
+def jsonReadBenchmark(nTokens, nAnnots):
+    print "Tokens:", nTokens, "Content annotations:", nAnnots
+    import MAT.DocumentIO
+    from MAT import json
+    jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+    s = jsonIO.writeToUnicodeString(_makeContentDoc(nTokens, nAnnots))
+    print "Characters:", len(s)
+    t0 = time.time()
+    jsonIO._deserializeFromJSON(json.loads(s), MAT.Document.AnnotatedDoc())
+    t1 = time.time()
+    print "Reading with json.loads: %.3f sec" % (t1 - t0)
+    jsonIO.deserialize(s, MAT.Document.AnnotatedDoc())
+    t2 = time.time()
+    print "Reading with the streaming reader: %.3f sec" % (t2 - t1)
+
+# mat-bin vs. mat-json: file size and the time to load from a file.
+
+def binaryIOBenchmark(nTokens, nAnnots):
+    print "Tokens:", nTokens, "Content annotations:", nAnnots
+    import MAT.DocumentIO, MAT.BinaryIO, tempfile, shutil
+    d = _makeContentDoc(nTokens, nAnnots)
+    tmpDir = tempfile.mkdtemp()
+    try:
+        for ioName in ["mat-json", "mat-bin"]:
+            docIO = MAT.DocumentIO.getDocumentIO(ioName)
+            path = os.path.join(tmpDir, "doc")
+            docIO.writeToTarget(d, path)
+            t0 = time.time()
+            docIO.readFromSource(path)
+            t1 = time.time()
+            print "%s: %.1f MB, loaded in %.3f sec" % \
+                  (ioName, os.stat(path).st_size / (1024.0 * 1024.0), t1 - t0)
+    finally:
+        shutil.rmtree(tmpDir)
+
+# Document conversion, the way MATTransducer and the registered
+# convertors do it: a new engine for every document. The first pass
+# forgets the digested instruction set each time, which is what used to
+# happen; the second uses the process-wide cache. The corpus is
+# nAnnots documents of 1000 tokens each.
+
+_TRANSDUCER_XML = """<instructions>
+  <labels source_re="PER.*|ORG.*">
+    <attrs source_re="t.*">
+      <values source_re="[a-z]+">
+        <map target_value="x"/>
+      </values>
+    </attrs>
+    <map target="ENAMEX"/>
+  </labels>
+  <labels source="lex" excluding_re="PER.*"><touch/></labels>
+  <labels source_re="S.*"><touch/></labels>
+  <discard_untouched/>
+</instructions>"""
+
+def transducerBenchmark(nTokens, nAnnots):
+    import MAT.DocumentIO, tempfile, shutil
+    nDocs = nAnnots
+    print "Documents:", nDocs
+    d = _makeContentDoc(1000, 50)
+    d.findAnnotationType("PERSON").ensureAttribute("type")
+    for a in d.getAnnotations(["PERSON"]):
+        a["type"] = "abc"
+    tmpDir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpDir, "instructions.xml")
+        fp = open(path, "w")
+        fp.write(_TRANSDUCER_XML)
+        fp.close()
+        for cached in [False, True]:
+            t0 = time.time()
+            for i in range(nDocs):
+                if not cached:
+                    MAT.DocumentIO._DIS_INSTRUCTION_CACHE.clear()
+                engine = MAT.DocumentIO.DocumentInstructionSetEngine(instructionSetFile = path)
+                MAT.DocumentIO.DocumentInstructionSetEngineConvertor(engine).inputConvert(d, MAT.Document.AnnotatedDoc())
+            t1 = time.time()
+            print "%s: %.3f sec" % ((cached and "Cached instructions") or "Uncached instructions", t1 - t0)
+    finally:
+        shutil.rmtree(tmpDir)
+
+BENCHMARKS = {"memory": memoryBenchmark,
+              "retag": retagBenchmark,
+              "jsonread": jsonReadBenchmark,
+              "binio": binaryIOBenchmark,
+              "transducer": transducerBenchmark}
+
+#
+# Main
+#
+
+def Usage():
+    print "Usage: mat_benchmark.py [ --tokens <n> ] [ --annotations <n> ] benchmark..."
+    print "--tokens <n>: the number of tokens in the test document. Default is 100000."
+    print "--annotations <n>: the number of content annotations in the test document. Default is 5000."
+    print "benchmark: one or more of %s" % ", ".join(sorted(BENCHMARKS.keys()))
+    sys.exit(1)
+
+import getopt
+try:
+    opts, args = getopt.getopt(sys.argv[1:], "", ["tokens=", "annotations="])
+except getopt.GetoptError:
+    Usage()
+
+TOKENS = 100000
+ANNOTATIONS = 5000
+
+for key, val in opts:
+    if key == "--tokens":
+        TOKENS = int(val)
+    elif key == "--annotations":
+        ANNOTATIONS = int(val)
+    else:
+        Usage()
+
+if not args:
+    Usage()
+
+for arg in args:
+    if not BENCHMARKS.has_key(arg):
+        Usage()
+    BENCHMARKS[arg](TOKENS, ANNOTATIONS)
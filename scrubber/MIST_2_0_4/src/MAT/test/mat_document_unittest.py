@@ -162,6 +162,405 @@ class AttributeOrderTestCase(MAT.UnitTest.MATTestCase):
         except KeyError:
             pass
 
+# The sorted interval index.
+
+class AnnotationIndexTestCase(MAT.UnitTest.MATTestCase):
+
+    def _makeDoc(self):
+        d = MAT.Document.AnnotatedDoc(u"a" * 100)
+        # Out of order, and with a tie on the start.
+        for (s, e) in [(20, 25), (0, 5), (10, 15), (5, 10), (10, 12), (30, 60)]:
+            d.createAnnotation(s, e, "lex")
+        d.createAnnotation(8, 14, "PERSON")
+        d.createAnnotation(40, 45, "PERSON")
+        return d
+
+    def testOrder(self):
+        d = self._makeDoc()
+        toks = d.orderAnnotations(["lex"])
+        self.assertEqual([(a.start, a.end) for a in toks],
+                         [(0, 5), (5, 10), (10, 15), (10, 12), (20, 25), (30, 60)])
+        # Across types, ties are broken by the order of the types.
+        self.assertEqual([(a.atype.lab, a.start) for a in d.orderAnnotations(["PERSON", "lex"])],
+                         [("lex", 0), ("lex", 5), ("PERSON", 8), ("lex", 10), ("lex", 10),
+                          ("lex", 20), ("lex", 30), ("PERSON", 40)])
+        # The result is a copy.
+        toks[0:3] = []
+        self.assertEqual(len(d.orderAnnotations(["lex"])), 6)
+
+    def testQueries(self):
+        d = self._makeDoc()
+        self.assertEqual([(a.start, a.end) for a in d.getAnnotationsOverlapping(9, 21, ["lex"])],
+                         [(5, 10), (10, 15), (10, 12), (20, 25)])
+        # The long annotation is found even though it starts far to the left.
+        self.assertEqual([(a.start, a.end) for a in d.getAnnotationsOverlapping(42, 51)],
+                         [(30, 60), (40, 45)])
+        self.assertEqual([(a.start, a.end) for a in d.getAnnotationsContainedIn(5, 15, ["lex"])],
+                         [(5, 10), (10, 15), (10, 12)])
+        self.assertEqual((d.getFirstAnnotationAtOrAfter(6, ["lex"]).start), 10)
+        self.assertEqual((d.getFirstAnnotationAtOrAfter(6).start), 8)
+        self.assertEqual(d.getFirstAnnotationAtOrAfter(61, ["lex"]), None)
+        self.assertEqual(d.getAnnotationsOverlapping(0, 10, ["NOTHERE"]), [])
+
+    def testMaintenance(self):
+        d = self._makeDoc()
+        d.orderAnnotations(["lex"])
+        # Add, remove, import, reassign.
+        d.createAnnotation(70, 75, "lex")
+        d.createAnnotation(2, 3, "lex")
+        d.removeAnnotation(d.getFirstAnnotationAtOrAfter(5, ["lex"]))
+        self.assertEqual([a.start for a in d.orderAnnotations(["lex"])], [0, 2, 10, 10, 20, 30, 70])
+        d2 = MAT.Document.AnnotatedDoc(u"a" * 100)
+        d2.createAnnotation(1, 2, "lex")
+        d.importAnnotations(d2)
+        self.assertEqual([a.start for a in d.orderAnnotations(["lex"])], [0, 1, 2, 10, 10, 20, 30, 70])
+        d.atypeDict[d.anameDict["lex"]] = []
+        self.assertEqual(d.orderAnnotations(["lex"]), [])
+        d.createAnnotation(3, 4, "lex")
+        self.assertEqual(d.getAnnotationsContainedIn(0, 10, ["lex"])[0].start, 3)
+        # Moving annotations requires clearing the index.
+        a = d.getAnnotations(["PERSON"])[0]
+        a.start = 90
+        a.end = 95
+        d._clearAnnotationIndex(["PERSON"])
+        self.assertEqual([x.start for x in d.orderAnnotations(["PERSON"])], [40, 90])
+
+    def testGroupRemoval(self):
+        d = self._makeDoc()
+        d.orderAnnotations()
+        toks = d.getAnnotations(["lex"])
+        persons = d.getAnnotations(["PERSON"])
+        d.removeAnnotationGroup([toks[1], toks[3], persons[0], toks[5]])
+        self.assertEqual([(a.start, a.end) for a in d.getAnnotations(["lex"])],
+                         [(20, 25), (10, 15), (10, 12)])
+        self.assertEqual([(a.start, a.end) for a in d.orderAnnotations(["lex"])],
+                         [(10, 15), (10, 12), (20, 25)])
+        self.assertEqual([a.start for a in d.getAnnotationsOverlapping(0, 100)], [10, 10, 20, 40])
+        # Removing things which aren't there is fine.
+        d.removeAnnotationGroup([toks[1], persons[1]])
+        self.assertEqual(d.getAnnotations(["PERSON"]), [])
+
+    def testCompactStorage(self):
+        d = self._makeDoc()
+        a = d.createAnnotation(50, 55, "PERSON", {"type": "PER"})
+        # No per-instance dictionary, but the dictionary-style
+        # attribute interface still works.
+        self.failIf(hasattr(a, "__dict__"))
+        self.assertEqual(a["type"], "PER")
+        self.assertEqual(a.get("nothere", "x"), "x")
+        a["type"] = "ORG"
+        self.assertEqual(a.getByName("type"), "ORG")
+        idx = d.atypeDict[d.anameDict["lex"]]._getIndex()
+        self.assertEqual(list(idx.starts), [0, 5, 10, 10, 20, 30])
+        self.assertEqual(list(idx.ends), [5, 10, 15, 12, 25, 60])
+
+    def testSplit(self):
+        d = self._makeDoc()
+        intervals = [(0, 15), (20, 60), (61, 100)]
+        subDocs = d.split(intervals)
+        self.assertEqual(len(subDocs), 3)
+        for (s, e), subD in zip(intervals, subDocs):
+            self.assertEqual(subD.signal, d.signal[s:e])
+            expected = [(a.atype.lab, a.start - s, a.end - s) for a in d.orderAnnotations()
+                        if (a.start >= s) and (a.end <= e)]
+            self.assertEqual([(a.atype.lab, a.start, a.end) for a in subD.orderAnnotations()], expected)
+            copyD = d.copy(signalInterval = (s, e))
+            self.assertEqual([(a.atype.lab, a.start, a.end) for a in copyD.orderAnnotations()], expected)
+        self.assertEqual([(a.start, a.end) for a in subDocs[0].orderAnnotations(["PERSON"])], [(8, 14)])
+        self.assertEqual(subDocs[2].orderAnnotations(), [])
+        # Removed types are gone.
+        subDocs = d.split(intervals, removeAnnotationTypes = ["PERSON"])
+        self.failIf(subDocs[1].anameDict.has_key("PERSON"))
+        # No spanless annotations.
+        d.createSpanlessAnnotation("RELATION")
+        self.assertRaises(MAT.Document.DocumentError, d.split, intervals)
+
+# Lazy annotations (i.e., tokens).
+
+DOC_SAMPLE_3 = u'{"signal": "I like France.", "metadata": {}, "asets": [{"type": "lex", "attrs": [], "annots": [[0, 1], [2, 6], [7, 13], [13, 14]]}, {"type": "ENAMEX", "attrs": ["TYPE"], "annots": [[7, 13, "LOCATION"]]}]}'
+
+class LazyAnnotationTestCase(MAT.UnitTest.MATTestCase):
+
+    def _isLazy(self, d, lab):
+        return d.atypeDict._getRaw(d.anameDict[lab])._lazy is not None
+
+    def testReadAndWrite(self):
+        d = _jsonIO.readFromUnicodeString(DOC_SAMPLE_3)
+        self.failUnless(self._isLazy(d, "lex"))
+        self.failIf(self._isLazy(d, "ENAMEX"))
+        self.failUnless(d.hasAnnotations(["lex"]))
+        starts, ends = d.getAnnotationSpans(["lex"])
+        self.assertEqual((list(starts), list(ends)), ([0, 2, 7, 13], [1, 6, 13, 14]))
+        # Writing doesn't create them either.
+        from MAT import json
+        j = json.loads(_jsonIO.writeToUnicodeString(d))
+        self.failUnless(self._isLazy(d, "lex"))
+        lexSet = [a for a in j["asets"] if a["type"] == "lex"][0]
+        self.assertEqual(lexSet["annots"], [[0, 1], [2, 6], [7, 13], [13, 14]])
+        # But asking for them does.
+        toks = d.orderAnnotations(["lex"])
+        self.failIf(self._isLazy(d, "lex"))
+        self.assertEqual([(t.start, t.end) for t in toks], [(0, 1), (2, 6), (7, 13), (13, 14)])
+        self.assertEqual(len(d.atypeDict[d.anameDict["lex"]]), 4)
+
+    def testImportAndCopy(self):
+        d = _jsonIO.readFromUnicodeString(DOC_SAMPLE_3)
+        d2 = MAT.Document.AnnotatedDoc(u"xx" + d.signal)
+        d2.importAnnotations(d, atypes = ["lex"], offset = 2)
+        self.failUnless(self._isLazy(d, "lex"))
+        self.failUnless(self._isLazy(d2, "lex"))
+        self.assertEqual(list(d2.getAnnotationSpans(["lex"])[0]), [2, 4, 9, 15])
+        d3 = d.copy(signalInterval = (2, 14))
+        self.failUnless(self._isLazy(d3, "lex"))
+        self.assertEqual([(a.start, a.end) for a in d3.orderAnnotations(["lex"])],
+                         [(0, 4), (5, 11), (11, 12)])
+        # If the target already has real annotations, the
+        # imported ones are real too.
+        d4 = MAT.Document.AnnotatedDoc(d.signal)
+        d4.createAnnotation(0, 1, "lex")
+        d4.importAnnotations(d, atypes = ["lex"])
+        self.failIf(self._isLazy(d4, "lex"))
+        self.assertEqual(len(d4.getAnnotations(["lex"])), 5)
+
+# Brokering annotations to an external process, which sees the document
+# without the content annotations, and gives us back new ones.
+
+class BrokerTestCase(MAT.UnitTest.MATTestCase):
+
+    def _process(self, docs, io, seen):
+        from MAT import json
+        for d in docs:
+            j = json.loads(io.writeToByteSequence(d))
+            seen.append(sorted([a["type"] for a in j["asets"]]))
+            j["asets"].append({"type": "ENAMEX", "attrs": ["TYPE"], "annots": [[2, 6, "VERB"]]})
+            io.readFromByteSequence(json.dumps(j), seedDocument = d, update = True)
+
+    def testBroker(self):
+        import MAT.Command
+        for io in [_jsonIO, MAT.DocumentIO.getDocumentIO('mat-json-v1')]:
+            d = _jsonIO.readFromUnicodeString(DOC_SAMPLE_3)
+            d.metadata["phasesDone"] = ["zone"]
+            seen = []
+            MAT.Command.brokerAnnotations([d], lambda docs: self._process(docs, io, seen),
+                                          removeOnInput = ["ENAMEX"],
+                                          truncateAndMergeOnOutput = ["ENAMEX"])
+            self.assertEqual(seen, [["lex"]])
+            # The tokens were neither copied nor created.
+            self.failUnless(d.atypeDict._getRaw(d.anameDict["lex"])._lazy is not None)
+            self.assertEqual([(a.start, a.end, a["TYPE"]) for a in d.getAnnotations(["ENAMEX"])],
+                             [(2, 6, "VERB")])
+            self.assertEqual(len(d.getAnnotations(["lex"])), 4)
+            self.assertEqual(d.metadata, {"phasesDone": ["zone"]})
+
+    def testView(self):
+        d = _jsonIO.readFromUnicodeString(DOC_SAMPLE_3)
+        v = MAT.Document.FilteredDocView(d, removeAnnotationTypes = ["lex"])
+        self.assertEqual([a.atype.lab for a in v.getAnnotations()], ["ENAMEX"])
+        v.truncate()
+        self.assertEqual(v.getAnnotations(), [])
+        self.assertEqual(len(d.getAnnotations()), 5)
+        self.failUnless(d.anameDict.has_key("lex"))
+        # The annotations we keep can't point to the ones we don't.
+        d = MAT.Document.AnnotatedDoc(u"I like France.")
+        loc = d.createAnnotation(7, 13, "LOCATION")
+        t = d.findAnnotationType("MENTION")
+        t.ensureAttribute("ref", aType = "annotation")
+        d.createAnnotation(7, 13, "MENTION", {"ref": loc})
+        self.assertRaises(MAT.Document.DocumentError, MAT.Document.FilteredDocView, d,
+                          removeAnnotationTypes = ["LOCATION"])
+        MAT.Document.FilteredDocView(d, removeAnnotationTypes = ["MENTION"])
+
+# Adjusting content annotations to token boundaries.
+
+class _AlignmentTask:
+
+    def getAnnotationTypesByCategory(self, cat):
+        return {"content": ["PERSON"], "token": ["lex"]}[cat]
+
+class TokenAlignmentTestCase(MAT.UnitTest.MATTestCase):
+
+    def testAdjust(self):
+        #                                  0123456789012345678901234
+        d = MAT.Document.AnnotatedDoc(u"John Smith met Mary Jones")
+        for (s, e) in [(0, 4), (5, 10), (11, 14), (15, 19), (20, 25)]:
+            d.createAnnotation(s, e, "lex")
+        # Aligned, start in the middle of a token, end in the middle
+        # of a token, and an annotation entirely between tokens.
+        d.createAnnotation(0, 10, "PERSON")
+        d.createAnnotation(12, 14, "PERSON")
+        d.createAnnotation(15, 22, "PERSON")
+        aligned = d.getAnnotations(["PERSON"])[0]
+        d.adjustTagsToTokens(_AlignmentTask())
+        self.assertEqual([(a.start, a.end) for a in d.orderAnnotations(["PERSON"])],
+                         [(0, 10), (11, 14), (15, 25)])
+        self.failUnless(d.getAnnotations(["PERSON"])[0] is aligned)
+        # The index was cleared, so the queries see the new boundaries.
+        self.assertEqual([a.start for a in d.getAnnotationsContainedIn(11, 25, ["PERSON"])], [11, 15])
+        # Annotations after the last token go away.
+        d2 = MAT.Document.AnnotatedDoc(u"John  ")
+        d2.createAnnotation(0, 4, "lex")
+        d2.createAnnotation(5, 6, "PERSON")
+        d2.adjustTagsToTokens(_AlignmentTask())
+        self.assertEqual(d2.getAnnotations(["PERSON"]), [])
+
+# Removing overlaps.
+
+class OverlapTestCase(MAT.UnitTest.MATTestCase):
+
+    def _makeDoc(self):
+        d = MAT.Document.AnnotatedDoc(u"a" * 50)
+        d.createAnnotation(0, 10, "PERSON", {"confidence": "0.2"})
+        d.createAnnotation(0, 4, "LOCATION", {"confidence": "0.1"})
+        d.createAnnotation(3, 6, "PERSON", {"confidence": "0.9"})
+        d.createAnnotation(20, 30, "PERSON")
+        d.createAnnotation(25, 27, "LOCATION", {"confidence": "0.5"})
+        d.createAnnotation(40, 45, "ORGANIZATION")
+        d.createAnnotation(41, 42, "ORGANIZATION")
+        return d
+
+    def _spans(self, d):
+        return [(a.atype.lab, a.start, a.end) for a in d.orderAnnotations()]
+
+    def testPolicies(self):
+        d = self._makeDoc()
+        report = d.removeOverlaps(["PERSON", "LOCATION"])
+        # Organizations aren't touched.
+        self.assertEqual(self._spans(d), [("LOCATION", 0, 4), ("PERSON", 20, 30),
+                                          ("ORGANIZATION", 40, 45), ("ORGANIZATION", 41, 42)])
+        self.assertEqual([(r[0].start, r[1].start, r[2]) for r in report],
+                         [(0, 0, "shorter"), (3, 0, "earlier"), (25, 20, "earlier")])
+        d = self._makeDoc()
+        d.removeOverlaps(["PERSON", "LOCATION"], policy = "shortest")
+        self.assertEqual([x for x in self._spans(d) if x[0] != "ORGANIZATION"],
+                         [("PERSON", 3, 6), ("LOCATION", 25, 27)])
+        d = self._makeDoc()
+        d.removeOverlaps(["PERSON", "LOCATION"], policy = "confidence")
+        self.assertEqual([x for x in self._spans(d) if x[0] != "ORGANIZATION"],
+                         [("PERSON", 3, 6), ("LOCATION", 25, 27)])
+        self.assertRaises(MAT.Document.DocumentError, d.removeOverlaps, ["PERSON"], policy = "nothere")
+        # Nothing left to remove.
+        self.assertEqual(d.removeOverlaps(["PERSON", "LOCATION"]), [])
+
+# Processable regions, and their cache.
+
+class _RegionTask:
+
+    def getTrueZoneInfo(self):
+        return "zone", "region_type", ["body"]
+
+def _usableSeg(seg):
+    return seg.get("annotator") in [None, "MACHINE"]
+
+class ProcessableRegionsTestCase(MAT.UnitTest.MATTestCase):
+
+    def testCache(self):
+        d = MAT.Document.AnnotatedDoc(u"a" * 40)
+        d.createAnnotation(0, 30, "zone", {"region_type": "body"})
+        d.createAnnotation(0, 10, "SEGMENT", {"annotator": "MACHINE"})
+        seg = d.createAnnotation(10, 20, "SEGMENT", {"annotator": None})
+        d.createAnnotation(20, 30, "SEGMENT", {"annotator": "MACHINE"})
+        regions = MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask(),
+                                                               segmentFilterFn = _usableSeg)[0]
+        self.assertEqual(regions, [[0, 10, ["region_type", "body"]], [10, 30, ["region_type", "body"]]])
+        self.assertEqual(len(d._regionCache), 1)
+        # The callers get a copy.
+        regions[0][1] = 5
+        self.assertEqual(MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask(),
+                                                                      segmentFilterFn = _usableSeg)[0],
+                         [[0, 10, ["region_type", "body"]], [10, 30, ["region_type", "body"]]])
+        # Changing an attribute, moving a segment or adding a zone invalidates it.
+        seg["annotator"] = "someone"
+        self.assertEqual(MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask(),
+                                                                      segmentFilterFn = _usableSeg)[0],
+                         [[0, 10, ["region_type", "body"]], [20, 30, ["region_type", "body"]]])
+        seg["annotator"] = None
+        self.assertEqual(MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask(),
+                                                                      segmentFilterFn = _usableSeg)[0],
+                         [[0, 10, ["region_type", "body"]], [10, 30, ["region_type", "body"]]])
+        # Whoever moves a segment ought to clear the index.
+        seg.start = 12
+        d._clearAnnotationIndex(["SEGMENT"])
+        self.assertEqual(MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask(),
+                                                                      segmentFilterFn = _usableSeg)[0],
+                         [[0, 10, ["region_type", "body"]], [12, 30, ["region_type", "body"]]])
+        # But we notice if they don't.
+        seg.start = 14
+        self.assertEqual(MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask(),
+                                                                      segmentFilterFn = _usableSeg)[0],
+                         [[0, 10, ["region_type", "body"]], [14, 30, ["region_type", "body"]]])
+        version = d.atypeDict._getRaw(d.anameDict["SEGMENT"])._version
+        MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask(), segmentFilterFn = _usableSeg)
+        self.assertEqual(d.atypeDict._getRaw(d.anameDict["SEGMENT"])._version, version)
+        d.createAnnotation(30, 40, "zone", {"region_type": "body"})
+        self.assertEqual(MAT.Document.AnnotatedDoc.processableRegions([d], task = _RegionTask())[0],
+                         [[0, 30, ["region_type", "body"]], [30, 40, ["region_type", "body"]]])
+        # With no zoning or segments, it's the whole document.
+        d2 = MAT.Document.AnnotatedDoc(u"a" * 40)
+        self.assertEqual(MAT.Document.AnnotatedDoc.processableRegions([d2])[0], [[0, 40, None]])
+
+    def testFilterKeys(self):
+        d = MAT.Document.AnnotatedDoc(u"a" * 30)
+        d.createAnnotation(0, 10, "SEGMENT", {"annotator": "MACHINE"})
+        d.createAnnotation(10, 20, "SEGMENT", {"annotator": "someone", "status": "non-gold"})
+        d.createAnnotation(20, 30, "SEGMENT", {"annotator": "someone", "status": "gold"})
+        # Like the model builder's filter, which closes over a flag.
+        def makeFilter(goldOnly):
+            def usableSeg(seg):
+                if (seg.get("annotator") in [None, "MACHINE"]) or \
+                   (goldOnly and (seg.get("status") == "non-gold")):
+                    return False
+                return True
+            return usableSeg
+        def regions(fn):
+            return [r[:2] for r in MAT.Document.AnnotatedDoc.processableRegions([d], segmentFilterFn = fn)[0]]
+        self.assertEqual(regions(makeFilter(True)), [[20, 30]])
+        self.assertEqual(len(d._regionCache), 1)
+        # A new filter with the same flag finds the cached entry.
+        self.assertEqual(regions(makeFilter(True)), [[20, 30]])
+        self.assertEqual(len(d._regionCache), 1)
+        self.assertEqual(regions(makeFilter(False)), [[10, 30]])
+        self.assertEqual(len(d._regionCache), 2)
+        # Default arguments count too.
+        self.assertEqual(regions(lambda seg, goldOnly = True: True), [[0, 30]])
+        self.assertEqual(len(d._regionCache), 3)
+        # But not filters which depend on objects.
+        holder = {"goldOnly": True}
+        self.assertEqual(regions(lambda seg: holder["goldOnly"]), [[0, 30]])
+        self.assertEqual(len(d._regionCache), 3)
+
+# Slicing documents into regions.
+
+class DocSliceTestCase(MAT.UnitTest.MATTestCase):
+
+    def testRegionsAndIndexes(self):
+        d = MAT.Document.AnnotatedDoc(u"John Smith left")
+        toks = [d.createAnnotation(s, e, "lex") for (s, e) in [(0, 4), (5, 10), (11, 15)]]
+        p = d.createAnnotation(0, 10, "PERSON")
+        mgr = MAT.Document.DocSliceManager([d])
+        regions = mgr.getRegions()
+        # It's an iterator.
+        self.failIf(isinstance(regions, list))
+        regions = list(regions)
+        self.assertEqual([(r.start, r.end) for r in regions], [(0, 4), (4, 5), (5, 10), (10, 11), (11, 15)])
+        R = MAT.Document.SignalRegion
+        self.assertEqual(sorted([(e.eType, e.label) for e in regions[0].get()]),
+                         [(R.STARTS, "PERSON"), (R.MATCHES, "lex")])
+        self.assertEqual([(e.eType, e.annot) for e in regions[1].get()], [(R.WITHIN, p)])
+        self.assertEqual(sorted([(e.eType, e.label) for e in regions[2].get()]),
+                         [(R.ENDS, "PERSON"), (R.MATCHES, "lex")])
+        self.assertEqual(regions[3].get(), [])
+        e = regions[2].get(label = "PERSON")[0]
+        regions[2].removeEntry(e)
+        self.assertEqual(regions[2].get(label = "PERSON"), [])
+        I = MAT.Document.SignalIndex
+        indexes = list(mgr.getIndexes())
+        self.assertEqual([i.index for i in indexes], [4, 5, 10, 11, 15])
+        self.assertEqual([(e.eType, e.annot) for e in indexes[1].get()],
+                         [(I.STARTS, toks[1]), (I.CROSSES, p)])
+        # Skipping.
+        mgr = MAT.Document.DocSliceManager([d], skipTable = {d: [("lex", None)]})
+        self.assertEqual([(r.start, r.end) for r in mgr.getRegions()], [(0, 10)])
+
 # Next, let's see if we can import a document and infer its steps done.
 
 class StepsDoneInferenceTest(PluginContextTestCase):
@@ -494,6 +893,51 @@ class AnnotationIDTest(PluginContextTestCase):
         # But you should be able to remove the two of them together.
         doc.removeAnnotationGroup([a2, a1])
 
+    def _rebuiltInverseIdDict(self, doc):
+        atr = doc.atypeRepository
+        saved = atr._inverseIdDict, atr._forwardIdDict, atr._staleReferrers
+        atr._clearIDReferences()
+        atr._buildInverseIdDict()
+        d = atr._inverseIdDict
+        atr._inverseIdDict, atr._forwardIdDict, atr._staleReferrers = saved
+        return d
+
+    def testIncrementalInverseIDs(self):
+        # Once the inverse ID dictionary is built, setting and clearing
+        # annotation-valued attributes and removing annotations should
+        # update it, rather than throwing it away.
+        doc = MAT.Document.AnnotatedDoc(signal = u"This is a test document.")
+        nouns = [doc.createAnnotation(i, i + 1, "NOUN") for i in range(10)]
+        v = doc.createAnnotation(10, 12, "VERB")
+        v.atype.ensureAttribute("subj", aType = "annotation")
+        v.atype.ensureAttribute("objs", aType = "annotation", aggregation = "list")
+        v["subj"] = nouns[0]
+        v["objs"] = MAT.Annotation.AttributeValueList(nouns[1:4])
+        atr = doc.atypeRepository
+        atr._buildInverseIdDict()
+        d = atr._inverseIdDict
+        self.assertEqual(d, self._rebuiltInverseIdDict(doc))
+        v["subj"] = nouns[4]
+        v["objs"].append(nouns[5])
+        v["objs"].remove(nouns[1])
+        doc.removeAnnotation(nouns[0])
+        doc.removeAnnotation(nouns[1])
+        self.assertTrue(atr._inverseIdDict is d)
+        self.assertEqual(d, self._rebuiltInverseIdDict(doc))
+        self.assertEqual(d[nouns[4].id], set([(v, "subj", None)]))
+        self.assertEqual(d[nouns[5].id], set([(v, "objs", "list")]))
+        v["subj"] = None
+        doc.removeAnnotation(nouns[4])
+        # Forcibly detaching works too.
+        doc.removeAnnotationGroup([nouns[2]], forceDetach = True)
+        self.assertEqual(list(v["objs"]), [nouns[3], nouns[5]])
+        self.assertTrue(atr._inverseIdDict is d)
+        self.assertEqual(d, self._rebuiltInverseIdDict(doc))
+        # And removing the pointer cleans up after it.
+        doc.removeAnnotation(v)
+        atr._buildInverseIdDict()
+        self.assertEqual(d, {})
+
 class AttributeTypeTest(PluginContextTestCase):
 
     def setUp(self):
@@ -246,3 +246,314 @@ class ArgParsingTestCase(TestTaskTestCase):
                                         'xml_translate_all': False,
                                         'xml_output_tag_exclusions': None,
                                         'signal_is_xml': True})
+
+# Streaming. The count step is batch-level, so the documents are
+# digested chunk by chunk, spooled, and replaced; the number step
+# after it has to see the count of the whole batch.
+
+# A directory of raw documents to stream, and one to write to.
+
+class StreamFixtureTestCase(TestTaskTestCase):
+
+    instantiable = False
+
+    # One directory per test. Not self.id(), which would make the
+    # daemon's socket path too long.
+
+    def setUp(self):
+        TestTaskTestCase.setUp(self)
+        self.tmpDir = os.path.join(self.testContext["TMPDIR"],
+                                   "%s.%s" % (self.__class__.__name__, self._testMethodName))
+        self.inDir = os.path.join(self.tmpDir, "in")
+        self.outDir = os.path.join(self.tmpDir, "out")
+        os.makedirs(self.inDir)
+        os.makedirs(self.outDir)
+        for i in range(5):
+            fp = open(os.path.join(self.inDir, "doc%d.txt" % i), "w")
+            fp.write("Document number %d.\n" % i)
+            fp.close()
+
+class StreamTestCase(StreamFixtureTestCase):
+
+    def _run(self, **kw):
+        e = MAT.ToolChain.MATEngine(self.task, "Stream")
+        res = e.Run(input_dir = self.inDir, input_file_type = "raw",
+                    output_dir = self.outDir, output_fsuff = ".json",
+                    output_file_type = "mat-json",
+                    steps = "mark,count,number", **kw)
+        _jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = self.task)
+        docs = {}
+        for f in os.listdir(self.outDir):
+            docs[f] = _jsonIO.readFromSource(os.path.join(self.outDir, f))
+        return res, docs
+
+    def testStream(self):
+        res, batchDocs = self._run()
+        self.assertEqual(len(res), 5)
+        for chunk in [1, 2, 5, 7]:
+            res, docs = self._run(stream_chunk = chunk)
+            self.assertEqual(res, None)
+            self.assertEqual(sorted(docs.keys()), sorted(batchDocs.keys()))
+            for f, d in docs.items():
+                self.assertEqual(d.signal, batchDocs[f].signal)
+                self.assertEqual(d.metadata["batch_size"], 5)
+                self.assertEqual(d.metadata["number"], 50)
+                self.assertTrue(d.metadata["marked"])
+                self.assertEqual(sorted(d.getStepsDone()), ["count", "mark", "number"])
+
+    def testStreamWithoutBatchStep(self):
+        e = MAT.ToolChain.MATEngine(self.task, "Stream")
+        e.Run(input_dir = self.inDir, input_file_type = "raw",
+              output_dir = self.outDir, output_fsuff = ".json",
+              output_file_type = "mat-json", steps = "mark", stream_chunk = "2")
+        self.assertEqual(len(os.listdir(self.outDir)), 5)
+        try:
+            e.Run(input_dir = self.inDir, input_file_type = "raw",
+                  steps = "mark", stream_chunk = "two")
+            self.fail("should have hit an error")
+        except MAT.ToolChain.ConfigurationError, e:
+            self.assertTrue(str(e).find("stream_chunk must be an integer") > -1)
+
+    # The per-document steps go to the workers; the batch step doesn't.
+    
+    def testWorkers(self):
+        e = MAT.ToolChain.MATEngine(self.task, "Stream")
+        wf = e.taskObj.getWorkflows()["Stream"]
+        self.assertEqual([(s.stepName, s.isPerDocument()) for s in wf.stepList],
+                         [("mark", True), ("count", False), ("number", True)])
+        res, batchDocs = self._run()
+        for kw in [{"workers": 3}, {"workers": "2", "stream_chunk": 3}]:
+            wRes, docs = self._run(**kw)
+            if wRes is not None:
+                self.assertEqual([f for f, d in wRes], [f for f, d in res])
+            self.assertEqual(sorted(docs.keys()), sorted(batchDocs.keys()))
+            pids = set()
+            for f, d in docs.items():
+                self.assertEqual(d.signal, batchDocs[f].signal)
+                self.assertEqual(d.metadata["batch_size"], 5)
+                self.assertEqual(d.metadata["number"], 50)
+                self.assertEqual(d.getStepsDone(), batchDocs[f].getStepsDone())
+                pids.add(d.metadata["marked_by"])
+            self.failIf(os.getpid() in pids)
+        try:
+            self._run(workers = "many")
+            self.fail("should have hit an error")
+        except MAT.ToolChain.ConfigurationError, e:
+            self.assertTrue(str(e).find("workers must be an integer") > -1)
+
+    def testJournal(self):
+        journal = os.path.join(self.tmpDir, "journal")
+        e = MAT.ToolChain.MATEngine(self.task, "Stream")
+        def run(**kw):
+            res = e.Run(input_dir = self.inDir, input_file_type = "raw",
+                        output_dir = self.outDir, output_fsuff = ".json",
+                        output_file_type = "mat-json", journal = journal, **kw)
+            if res is not None:
+                return sorted([os.path.basename(f) for f, d in res])
+        allDocs = ["doc%d.txt" % i for i in range(5)]
+        self.assertEqual(run(steps = "mark"), allDocs)
+        self.assertEqual(run(steps = "mark"), [])
+        # Lose an output, damage another, change an input, and die
+        # in the middle of an entry.
+        os.remove(os.path.join(self.outDir, "doc1.txt.json"))
+        fp = open(os.path.join(self.outDir, "doc2.txt.json"), "a")
+        fp.write(" ")
+        fp.close()
+        fp = open(os.path.join(self.inDir, "doc3.txt"), "w")
+        fp.write("Document number three.\n")
+        fp.close()
+        fp = open(journal, "a")
+        fp.write('{"input": ')
+        fp.close()
+        self.assertEqual(run(steps = "mark"), ["doc1.txt", "doc2.txt", "doc3.txt"])
+        # Nothing left to do, so nothing more is recorded.
+        fp = open(journal, "r")
+        nLines = len(fp.readlines())
+        fp.close()
+        run(steps = "mark", stream_chunk = 2)
+        fp = open(journal, "r")
+        self.assertEqual(len(fp.readlines()), nLines)
+        fp.close()
+        # Different steps start over.
+        self.assertEqual(run(steps = "mark,count,number"), allDocs)
+        try:
+            e.Run(input_dir = self.inDir, input_file_type = "raw",
+                  steps = "mark", journal = journal)
+            self.fail("should have hit an error")
+        except MAT.ToolChain.ConfigurationError, err:
+            self.assertTrue(str(err).find("journal requires an output") > -1)
+
+    def testStepStatistics(self):
+        stats = MAT.ToolChain.StepStatistics(perDocument = True)
+        e = MAT.ToolChain.MATEngine(self.task, "Stream", stepStatistics = stats)
+        e.Run(input_dir = self.inDir, input_file_type = "raw",
+              steps = "mark,count,number")
+        # Each document of mark and number, then its batch; count is batch-level.
+        self.assertEqual([(x["step"], x["file"] is None) for x in stats.entries],
+                         [("mark", False)] * 5 + [("mark", True), ("count", True)] + \
+                         [("number", False)] * 5 + [("number", True)])
+        total = sum([len("Document number %d.\n" % i) for i in range(5)])
+        for x in stats.entries:
+            self.assertEqual(x["phase"], "doBatch")
+            if x["file"] is None:
+                self.assertEqual((x["documents"], x["characters"]), (5, total))
+            else:
+                self.assertEqual(x["documents"], 1)
+            self.assertTrue(x["wall_time"] >= 0 and x["cpu_time"] >= 0)
+        self.assertEqual([(x["step"], x["batches"], x["documents"]) for x in stats.summarize()],
+                         [("mark", 1, 5), ("count", 1, 5), ("number", 1, 5)])
+        # Streaming records each pass of the batch step, and each chunk.
+        stats.clear()
+        stats.perDocument = False
+        e.Run(input_dir = self.inDir, input_file_type = "raw",
+              steps = "mark,count,number", stream_chunk = 2)
+        self.assertEqual([(x["step"], x["phase"], x["batches"], x["documents"])
+                          for x in stats.summarize()],
+                         [("count", "startBatchStream", 1, 0), ("mark", "doBatch", 3, 5),
+                          ("count", "digestBatch", 3, 5), ("count", "endBatchDigestion", 1, 0),
+                          ("count", "replaceBatch", 3, 5), ("number", "doBatch", 3, 5)])
+        # And undo.
+        pairs = e.Run(input_dir = self.inDir, input_file_type = "raw", steps = "mark")
+        stats.clear()
+        e.RunDataPairs(pairs[:2], undoThrough = "mark")
+        self.assertEqual([(x["step"], x["phase"], x["documents"]) for x in stats.entries],
+                         [("mark", "undo", 2)])
+        jsonPath = os.path.join(self.outDir, "stats.json")
+        csvPath = os.path.join(self.outDir, "stats.csv")
+        stats.save(jsonPath)
+        stats.save(csvPath)
+        from MAT import json
+        fp = open(jsonPath, "r")
+        d = json.load(fp)
+        fp.close()
+        self.assertEqual(d["steps"][0]["step"], "mark")
+        self.assertEqual(len(d["entries"]), 1)
+        import csv
+        fp = open(csvPath, "rb")
+        rows = list(csv.reader(fp))
+        fp.close()
+        self.assertEqual(rows[0], MAT.ToolChain.StepStatistics.FIELDS)
+        self.assertEqual(rows[1][1:5], ["mark", "undo", "", "2"])
+        self.assertRaises(ValueError, stats.save, jsonPath, format = "xml")
+        # A bad format is caught when the statistics are set up.
+        before = MAT.ExecutionContext._STEP_STATISTICS
+        self.assertRaises(ValueError, MAT.ExecutionContext.setStepStatistics, jsonPath, format = "xml")
+        self.failUnless(MAT.ExecutionContext._STEP_STATISTICS is before)
+
+    def testStepStatisticsCap(self):
+        stats = MAT.ToolChain.StepStatistics(perDocument = True)
+        capped = MAT.ToolChain.StepStatistics(perDocument = True, maxEntries = 3)
+        for s in [stats, capped]:
+            e = MAT.ToolChain.MATEngine(self.task, "Stream", stepStatistics = s)
+            e.Run(input_dir = self.inDir, input_file_type = "raw",
+                  steps = "mark,count,number")
+        # Only the most recent entries, but the totals cover everything.
+        self.assertEqual(list(capped.entries)[-1]["step"], "number")
+        self.assertEqual((len(capped.entries), capped.droppedEntries), (3, len(stats.entries) - 3))
+        self.assertEqual([(x["step"], x["batches"], x["documents"]) for x in capped.summarize()],
+                         [(x["step"], x["batches"], x["documents"]) for x in stats.summarize()])
+        self.assertEqual(capped.asJSONObj()["dropped_entries"], capped.droppedEntries)
+
+class EngineDaemonTestCase(StreamFixtureTestCase):
+
+    def setUp(self):
+        StreamFixtureTestCase.setUp(self)
+        import MAT.EngineDaemon
+        self.daemon = MAT.EngineDaemon.EngineDaemon(pluginDir = self.pDict)
+
+    def testDocuments(self):
+        resp = self.daemon.doJob({"id": 1, "task": "Test task", "workflow": "Stream",
+                                  "steps": u"mark,count,number",
+                                  "documents": [u"First.", {"signal": u"Second.", "metadata": {},
+                                                            "asets": [], "version": 2}]})
+        self.assertEqual((resp["id"], resp["success"], resp["error"]), (1, True, None))
+        self.assertEqual([d["signal"] for d in resp["documents"]], ["First.", "Second."])
+        self.assertEqual([d["metadata"]["number"] for d in resp["documents"]], [20, 20])
+        self.assertFalse(resp.has_key("stepStatistics"))
+
+    def testStepStatistics(self):
+        # Each job gets its own.
+        for i in range(2):
+            resp = self.daemon.doJob({"task": "Test task", "workflow": "Stream",
+                                      "steps": u"mark,count", "step_statistics": "yes",
+                                      "documents": [u"First.", u"Second."]})
+            self.assertTrue(resp["success"])
+            self.assertEqual([(x["step"], x["batches"], x["documents"])
+                              for x in resp["stepStatistics"]["steps"]],
+                             [("mark", 1, 2), ("count", 1, 2)])
+        # And the daemon doesn't offer the global ones.
+        from MAT.Operation import OptionParser
+        parser = OptionParser()
+        MAT.ExecutionContext.addOptions(parser, stepStatistics = False)
+        self.assertFalse(parser.has_option("--step_statistics"))
+
+    def testFiles(self):
+        resp = self.daemon.doJob({"id": 2, "task": "Test task", "workflow": "Stream",
+                                  "steps": u"mark", "input_dir": self.inDir,
+                                  "input_file_type": "raw", "output_dir": self.outDir,
+                                  "output_fsuff": ".json", "output_file_type": "mat-json"})
+        self.assertTrue(resp["success"])
+        self.assertEqual(sorted(resp["outputs"]),
+                         sorted([os.path.join(self.outDir, f) for f in os.listdir(self.outDir)]))
+        self.assertEqual(len(resp["outputs"]), 5)
+
+    def testErrors(self):
+        resp = self.daemon.doJob({"id": 3, "task": "No such task", "documents": []})
+        self.assertEqual((resp["success"], resp["errorStep"]), (False, "[init]"))
+        resp = self.daemon.doJob({"id": 4, "task": "Test task", "workflow": "Stream",
+                                  "steps": u"mark", "input_dir": self.inDir, "documents": []})
+        self.assertEqual((resp["success"], resp["errorStep"]), (False, "[init]"))
+        # The daemon keeps going.
+        self.assertTrue(self.daemon.doJob({"op": "ping"})["success"])
+
+    def testServeStream(self):
+        from MAT import json
+        import cStringIO
+        inp = cStringIO.StringIO("\n".join(['{"id": 1, "op": "ping"}', 'not JSON', '',
+                                            '{"id": 2, "task": "Test task", "workflow": "Stream", "steps": "mark", "documents": ["x"]}',
+                                            '{"id": 3, "op": "shutdown"}',
+                                            '{"id": 4, "op": "ping"}']) + "\n")
+        out = cStringIO.StringIO()
+        self.daemon.serveStream(inp, out)
+        resps = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual([(r["id"], r["success"]) for r in resps],
+                         [(1, True), (None, False), (2, True), (3, True)])
+        self.assertTrue(resps[2]["documents"][0]["metadata"]["marked"])
+
+    def testServeSocket(self):
+        from MAT import json
+        import socket, threading, time
+        path = os.path.join(self.outDir, "daemon.sock")
+        # A stale socket, which nobody's listening on.
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        t = threading.Thread(target = self.daemon.serveSocket, args = (path,))
+        t.start()
+        try:
+            # Long enough to need more than one read.
+            signal = "A rather long document. " * 20000
+            resps = []
+            for jobs in [['{"id": 1, "op": "ping"}',
+                          json.dumps({"id": 2, "task": "Test task", "workflow": "Stream",
+                                      "steps": "mark", "documents": [signal]})],
+                         ['{"id": 3, "op": "shutdown"}']]:
+                conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                for i in range(100):
+                    try:
+                        conn.connect(path)
+                        break
+                    except socket.error:
+                        time.sleep(.1)
+                conn.sendall("".join([j + "\n" for j in jobs]))
+                inp = conn.makefile("rb")
+                for j in jobs:
+                    resps.append(json.loads(inp.readline()))
+                inp.close()
+                conn.close()
+        finally:
+            t.join(30)
+        self.assertFalse(t.isAlive())
+        self.assertEqual([(r["id"], r["success"]) for r in resps], [(1, True), (2, True), (3, True)])
+        self.assertEqual(resps[1]["documents"][0]["signal"], signal)
+        self.assertFalse(os.path.exists(path))
@@ -108,3 +108,499 @@ class FakeXMLInlineTestCase(PluginContextTestCase):
         self.assertEqual(set([(a.start, a.end) for a in d.getAnnotations(["LASTNAME"])]), set([(12, 16)]))
         self.assertEqual(d.getAnnotations(["LASTNAME"])[0]["cap"], "yes")
         self.assertEqual(set([(a.start, a.end) for a in d.getAnnotations(["PERSON"])]), set([(7, 16)]))
+
+# The JSON reader walks the asets itself rather than calling
+# json.loads on the whole document. It ought to get exactly what
+# the tree-based reader gets, whatever order the keys come in.
+
+import MAT.UnitTest, MAT.Document, MAT.Annotation
+from MAT import json
+
+def _makeIODoc():
+    d = MAT.Document.AnnotatedDoc(u"John Smith went to Paris.")
+    for start, end in [(0, 4), (5, 10), (11, 15), (16, 18), (19, 24), (24, 25)]:
+        d.createAnnotation(start, end, "lex")
+    pType = d.findAnnotationType("PERSON")
+    pType.ensureAttribute("conf", aType = "float")
+    pType.ensureAttribute("tags", aggregation = "set")
+    rType = d.findAnnotationType("REL", hasSpan = False)
+    rType.ensureAttribute("arg", aType = "annotation")
+    p = d.createAnnotation(0, 10, pType, {"conf": 1.0, "tags": MAT.Annotation.AttributeValueSet(["a"])})
+    d.createAnnotation(19, 24, "LOCATION")
+    d.createSpanlessAnnotation(rType, {"arg": p})
+    d.metadata["source"] = u"test"
+    return d
+
+def _renderSorted(d, jsonIO):
+    j = jsonIO.renderJSONObj(d)
+    j["asets"].sort(key = lambda a: a["type"])
+    return j
+
+class JSONStreamTestCase(MAT.UnitTest.MATTestCase):
+
+    def testAgreesWithTree(self):
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        j = jsonIO.renderJSONObj(_makeIODoc())
+        # The writer's order, pretty-printed, and sorted (in which the
+        # signal comes after the asets and the annots before the attrs).
+        for s in [json.dumps(j), json.dumps(j, indent = 2), json.dumps(j, sort_keys = True)]:
+            treeDoc = MAT.Document.AnnotatedDoc()
+            jsonIO._deserializeFromJSON(json.loads(s), treeDoc)
+            streamDoc = MAT.Document.AnnotatedDoc()
+            jsonIO.deserialize(s, streamDoc)
+            self.assertEqual(_renderSorted(streamDoc, jsonIO), _renderSorted(treeDoc, jsonIO))
+            self.assertEqual(streamDoc.metadata, {"source": "test"})
+            rel = streamDoc.getAnnotations(["REL"])[0]
+            self.failUnless(rel["arg"] is streamDoc.getAnnotations(["PERSON"])[0])
+            self.assertEqual(type(streamDoc.getAnnotations(["PERSON"])[0]["conf"]), float)
+
+    def testSpanChunks(self):
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        d = MAT.Document.AnnotatedDoc(u"abcde " * 1000)
+        d.createLazyAnnotations("lex", range(0, 6000, 6), range(5, 6000, 6))
+        s = jsonIO.writeToUnicodeString(d)
+        oldChunk = MAT.DocumentIO._JSON_SPAN_CHUNK
+        MAT.DocumentIO._JSON_SPAN_CHUNK = 100
+        try:
+            d2 = jsonIO.readFromUnicodeString(s)
+        finally:
+            MAT.DocumentIO._JSON_SPAN_CHUNK = oldChunk
+        starts, ends = d2.getAnnotationSpans(["lex"])
+        self.assertEqual(list(starts), range(0, 6000, 6))
+        self.assertEqual(list(ends), range(5, 6000, 6))
+
+    def testUnusualRows(self):
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        # Rows which aren't pairs go through the ordinary decoder.
+        d = jsonIO.readFromUnicodeString(u'{"signal": "abc def", "asets": [{"type": "lex", "attrs": [], "annots": [[0, 3, 5], [4, 7]]}, {"type": "X", "attrs": [{"name": "n", "type": "int"}], "annots": [[0, 3, 5], [4, 7, 6]]}, {"type": "Y", "attrs": [], "annots": [ ]}]}')
+        self.assertEqual([(a.start, a.end) for a in d.orderAnnotations(["lex"])], [(0, 3), (4, 7)])
+        self.assertEqual([a["n"] for a in d.orderAnnotations(["X"])], [5, 6])
+        for s in [u'', u'{', u'{"signal": "abc"} x', u'{"asets": [{"type": "lex", "attrs": [], "annots": [[0, 3] [4, 7]]}]}',
+                  # Truncated in the middle of the rows.
+                  u'{"signal": "ab", "asets": [{"type": "lex", "attrs": [], "annots": [[0, 1], [1, 2']:
+            self.assertRaises(MAT.Document.LoadError, jsonIO.readFromUnicodeString, s)
+
+# The binary format should hold everything the JSON format does.
+
+import MAT.BinaryIO
+
+class BinaryIOTestCase(MAT.UnitTest.MATTestCase):
+
+    def testRoundTrip(self):
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        binIO = MAT.DocumentIO.getDocumentIO("mat-bin")
+        d = _makeIODoc()
+        # Some non-ASCII, so the signal offsets aren't byte offsets.
+        d.signal = u"J\u00f6hn" + d.signal[4:]
+        d.createLazyAnnotations("tok", [0, 5], [4, 10])
+        d2 = binIO.readFromByteSequence(binIO.writeToByteSequence(d))
+        self.assertEqual(d2.signal, d.signal)
+        self.assertEqual(d2.metadata, {"source": "test"})
+        self.failUnless(d2.atypeDict._getRaw(d2.anameDict["tok"])._lazy is not None)
+        self.assertEqual(_renderSorted(d2, jsonIO), _renderSorted(d, jsonIO))
+        rel = d2.getAnnotations(["REL"])[0]
+        self.failUnless(rel["arg"] is d2.getAnnotations(["PERSON"])[0])
+        self.assertEqual(type(d2.getAnnotations(["PERSON"])[0]["conf"]), float)
+
+    def testFilesAndConverters(self):
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        d = _makeIODoc()
+        tmpPath = os.path.join(self.testContext["TMPDIR"], "binaryio")
+        os.makedirs(tmpPath)
+        jsonPath = os.path.join(tmpPath, "doc.json")
+        binPath = os.path.join(tmpPath, "doc.bin")
+        jsonPath2 = os.path.join(tmpPath, "doc2.json")
+        jsonIO.writeToTarget(d, jsonPath)
+        MAT.BinaryIO.convertJSONToBinary(jsonPath, binPath)
+        MAT.BinaryIO.convertBinaryToJSON(binPath, jsonPath2)
+        self.assertEqual(_renderSorted(jsonIO.readFromSource(jsonPath2), jsonIO), _renderSorted(d, jsonIO))
+        binIO = MAT.DocumentIO.getDocumentIO("mat-bin")
+        self.assertEqual(binIO.readFromSource(binPath).signal, d.signal)
+        # Garbage.
+        fp = open(binPath, "wb")
+        fp.write("not a document")
+        fp.close()
+        self.assertRaises(MAT.Document.LoadError, binIO.readFromSource, binPath)
+        self.assertRaises(MAT.Document.LoadError, binIO.readFromUnicodeString, u"abc")
+        self.assertRaises(MAT.DocumentIO.SaveError, binIO.writeToUnicodeString, d)
+
+    def testTruncation(self):
+        binIO = MAT.DocumentIO.getDocumentIO("mat-bin")
+        d = _makeIODoc()
+        d.createLazyAnnotations("tok", [0, 5], [4, 10])
+        s = binIO.writeToByteSequence(d)
+        # Into the sections, into the header, and into the prefix.
+        for cut in [1, 4, 7, 8, 30, len(s) - MAT.BinaryIO._HEADER_START - 2, len(s) - 8]:
+            self.assertRaises(MAT.Document.LoadError, binIO.readFromByteSequence, s[:-cut])
+        # An offset column which is short by one entry still unpacks,
+        # so it has to be caught by the count.
+        version, headerLength = MAT.BinaryIO._PREFIX.unpack(s[6:MAT.BinaryIO._HEADER_START])
+        base = MAT.BinaryIO._HEADER_START + headerLength
+        header = MAT.json.loads(s[MAT.BinaryIO._HEADER_START:base])
+        tokD = [aD for aD in header["asets"] if aD["type"] == "tok"][0]
+        tokD["ends"][1] -= 4
+        sHeader = MAT.json.dumps(header)
+        s2 = s[:6] + MAT.BinaryIO._PREFIX.pack(version, len(sHeader)) + sHeader + s[base:]
+        self.assertRaises(MAT.Document.LoadError, binIO.readFromByteSequence, s2)
+        # And the same document, intact, still reads.
+        self.assertEqual(binIO.readFromByteSequence(s).signal, d.signal)
+
+# Signals over memory-mapped UTF-8.
+
+class MappedSignalTestCase(MAT.UnitTest.MATTestCase):
+
+    def testSlicing(self):
+        # Make sure we cross the block boundaries in the index.
+        u = u"J\u00f6hn \u4e2d went home.\n" * 300
+        b = u.encode("utf-8")
+        sig = MAT.Document.MappedSignal("xx" + b + "yy", 2, 2 + len(b))
+        self.assertEqual(len(sig), len(u))
+        self.assertEqual(unicode(sig), u)
+        for i, j in [(0, 5), (1020, 1030), (1024, 2048), (3000, 6000), (-10, -2), (5, 2)]:
+            self.assertEqual(sig[i:j], u[i:j])
+        self.assertEqual(sig[1025], u[1025])
+        self.assertEqual(sig[-1], u"\n")
+        self.assertEqual(sig.encode("utf-8"), b)
+        self.assertEqual(sig.find(u"home", 2000), u.find(u"home", 2000))
+        self.failUnless(sig == u)
+
+    def testReaders(self):
+        u = u"J\u00f6hn went to Paris."
+        tmpPath = os.path.join(self.testContext["TMPDIR"], "mappedsignal")
+        os.makedirs(tmpPath)
+        rawPath = os.path.join(tmpPath, "doc.txt")
+        fp = open(rawPath, "wb")
+        fp.write(u.encode("utf-8"))
+        fp.close()
+        rawIO = MAT.DocumentIO.getDocumentIO("raw", encoding = "utf-8")
+        d = rawIO.readFromSource(rawPath, mapSignal = True)
+        self.failUnless(isinstance(d.signal, MAT.Document.MappedSignal))
+        self.assertEqual(d.signal, u)
+        # Not UTF-8, so it can't be mapped.
+        d = MAT.DocumentIO.getDocumentIO("raw", encoding = "latin1").readFromSource(rawPath, mapSignal = True)
+        self.assertEqual(type(d.signal), unicode)
+        # Annotate it, copy it, and write it out.
+        d = rawIO.readFromSource(rawPath, mapSignal = True)
+        d.createAnnotation(0, 4, "PERSON")
+        d.createAnnotation(13, 18, "LOCATION")
+        self.assertEqual(d.copy(signalInterval = (13, 19)).signal, u"Paris.")
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        jsonD = jsonIO.readFromUnicodeString(jsonIO.writeToUnicodeString(d))
+        self.assertEqual(jsonD.signal, u)
+        binPath = os.path.join(tmpPath, "doc.bin")
+        binIO = MAT.DocumentIO.getDocumentIO("mat-bin")
+        binIO.writeToTarget(d, binPath)
+        binD = binIO.readFromSource(binPath, mapSignal = True)
+        self.failUnless(isinstance(binD.signal, MAT.Document.MappedSignal))
+        self.assertEqual(binD.signal, u)
+        self.assertEqual([binD.signal[a.start:a.end] for a in binD.orderAnnotations(["PERSON", "LOCATION"])],
+                         [u"J\u00f6hn", u"Paris"])
+
+# Prefetching in the document manager has to give the same
+# results, in the same order, as loading the files one at a time.
+
+class PrefetchTestCase(MAT.UnitTest.MATTestCase):
+
+    def setUp(self):
+        MAT.UnitTest.MATTestCase.setUp(self)
+        # One directory per test.
+        self.tmpDir = os.path.join(self.testContext["TMPDIR"], self.id())
+        os.makedirs(self.tmpDir)
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        for i in range(7):
+            d = _makeIODoc()
+            d.metadata["i"] = i
+            jsonIO.writeToTarget(d, os.path.join(self.tmpDir, "doc%d.json" % i))
+        fp = open(os.path.join(self.tmpDir, "doc3.json"), "w")
+        fp.write("not JSON")
+        fp.close()
+
+    def _load(self, keepGoing, **kw):
+        dm = MAT.DocumentIO.DocumentIOManager()
+        dm.configure(input_dir = self.tmpDir, input_file_type = "mat-json", **kw)
+        docPairs, skipPairs = dm.loadPairs(keepGoing = keepGoing)
+        incr = [(f, (d is not None) and d.metadata["i"], err)
+                for f, d, err in dm.loadPairsIncrementally(keepGoing = keepGoing)]
+        return [(f, d.metadata["i"]) for f, d in docPairs], skipPairs, incr
+
+    def testPrefetch(self):
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        expected = self._load(True)
+        self.assertEqual(len(expected[0]), 6)
+        self.assertEqual(len(expected[1]), 1)
+        for mode in ["thread", "process"]:
+            res = self._load(True, prefetch = 3, prefetch_mode = mode)
+            self.assertEqual(res, expected)
+            dm = MAT.DocumentIO.DocumentIOManager()
+            dm.configure(input_dir = self.tmpDir, input_file_type = "mat-json",
+                         prefetch = 3, prefetch_mode = mode)
+            self.assertRaises(MAT.DocumentIO.ManagerError, dm.loadPairs)
+            docs = dm.loadPairs(keepGoing = True)[0]
+            self.assertEqual(_renderSorted(docs[0][1], jsonIO)["asets"],
+                             _renderSorted(_makeIODoc(), jsonIO)["asets"])
+        self.assertRaises(MAT.DocumentIO.ManagerError, MAT.DocumentIO.DocumentIOManager().configure,
+                          input_dir = self.tmpDir, input_file_type = "mat-json", prefetch_mode = "fork")
+
+# Compression. xz needs a module which may not be installed, so we
+# only try it if it's there.
+
+import gzip
+
+class CompressionTestCase(MAT.UnitTest.MATTestCase):
+
+    def testRoundTrip(self):
+        tmpPath = os.path.join(self.testContext["TMPDIR"], "compression")
+        os.makedirs(tmpPath)
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        d = _makeIODoc()
+        d.signal = u"J\u00f6hn" + d.signal[4:]
+        suffixes = [".gz", ".bz2"]
+        if MAT.DocumentIO.lzma is not None:
+            suffixes.append(".xz")
+        for name in ["mat-json", "raw", "mat-bin"]:
+            io = MAT.DocumentIO.getDocumentIO(name, encoding = "utf-8", compression_level = 1)
+            for suff in suffixes:
+                p = os.path.join(tmpPath, "doc" + suff)
+                io.writeToTarget(d, p)
+                # By suffix, and then by magic bytes.
+                noSuffix = os.path.join(tmpPath, "doc")
+                d2 = io.readFromSource(p, mapSignal = True)
+                os.rename(p, noSuffix)
+                d3 = io.readFromSource(noSuffix, mapSignal = True)
+                for dd in [d2, d3]:
+                    self.assertEqual(dd.signal, d.signal)
+                    if name != "raw":
+                        self.assertEqual(_renderSorted(dd, jsonIO), _renderSorted(d, jsonIO))
+        # What gets written is really gzip.
+        p = os.path.join(tmpPath, "doc.json.gz")
+        jsonIO.writeToTarget(d, p)
+        fp = gzip.GzipFile(p, "rb")
+        self.assertEqual(json.loads(fp.read().decode("utf-8"))["signal"], d.signal)
+        fp.close()
+
+    def testBadInput(self):
+        tmpPath = os.path.join(self.testContext["TMPDIR"], "badcompression")
+        os.makedirs(tmpPath)
+        p = os.path.join(tmpPath, "doc.json.gz")
+        fp = open(p, "wb")
+        fp.write("not compressed")
+        fp.close()
+        self.assertRaises(MAT.Document.LoadError, MAT.DocumentIO.getDocumentIO("mat-json").readFromSource, p)
+        self.assertRaises(MAT.DocumentIO.SaveError, MAT.DocumentIO.getDocumentIO, "raw", compression_level = 10)
+
+import MAT.XMLIO
+
+class XMLStreamWriterTestCase(MAT.UnitTest.MATTestCase):
+
+    def testOutput(self):
+        d = MAT.Document.AnnotatedDoc(signal = u"J\u00f6hn & <Mary> went.")
+        d.createAnnotation(0, 13, "A")
+        d.createAnnotation(0, 4, "A", {"x": u"a&b"})
+        d.createAnnotation(7, 13, "A")
+        xmlIO = MAT.DocumentIO.getDocumentIO("xml-inline", xml_output_exclude_metadata = True)
+        self.assertEqual(xmlIO.writeToUnicodeString(d),
+                         u'<__top><A><A x="a&amp;b">J\u00f6hn</A> &amp; <A>&lt;Mary&gt;</A></A> went.</__top>')
+
+    def testLongSignal(self):
+        # The signal is written in pieces; make sure the pieces
+        # come out right.
+        n = (MAT.XMLIO._SIGNAL_SEGMENT / 8) * 3
+        d = MAT.Document.AnnotatedDoc(signal = u"a<b&c>\u00e9 " * n)
+        d.createAnnotation(5, (n * 8) - 5, "X")
+        d.createAnnotation(MAT.XMLIO._SIGNAL_SEGMENT - 2, MAT.XMLIO._SIGNAL_SEGMENT + 2, "Y")
+        xmlIO = MAT.DocumentIO.getDocumentIO("xml-inline")
+        s = xmlIO.writeToUnicodeString(d)
+        import re
+        self.assertEqual(re.sub("<[^>]*>", "", s).count(u"&lt;b&amp;c&gt;"), n)
+        tmpPath = os.path.join(self.testContext["TMPDIR"], "xmlstream")
+        os.makedirs(tmpPath)
+        p = os.path.join(tmpPath, "doc.xml")
+        xmlIO.writeToTarget(d, p)
+        fp = open(p, "rb")
+        self.assertEqual(fp.read().decode("utf-8"), s)
+        fp.close()
+        d2 = xmlIO.readFromSource(p)
+        self.assertEqual(d2.signal, d.signal)
+        self.assertEqual(sorted([(a.start, a.end) for a in d2.getAnnotations(["X", "Y"])]),
+                         sorted([(a.start, a.end) for a in d.getAnnotations()]))
+
+class JSONRendererCacheTestCase(MAT.UnitTest.MATTestCase):
+
+    def _render(self, d, legacy = False):
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        jsonIO.legacyWriter = legacy
+        return dict([(aD["type"], aD) for aD in jsonIO.renderJSONObj(d)["asets"]])
+
+    def testIDTracking(self):
+        d = MAT.Document.AnnotatedDoc(signal = u"abcdef")
+        a1 = d.createAnnotation(0, 1, "A")
+        a2 = d.createAnnotation(1, 2, "A")
+        b = d.createAnnotation(2, 3, "B")
+        self.failIf(d.atypeRepository._labelMayHaveIDs("A"))
+        self.failIf(self._render(d)["A"]["hasID"])
+        b.atype.ensureAttribute("ref", aType = "annotation")
+        b["ref"] = a2
+        self.failUnless(d.atypeRepository._labelMayHaveIDs("A"))
+        self.failIf(d.atypeRepository._labelMayHaveIDs("B"))
+        asets = self._render(d)
+        self.failUnless(asets["A"]["hasID"])
+        self.assertEqual(asets["A"]["annots"], [[0, 1, None], [1, 2, a2.id]])
+        self.assertEqual(asets["B"]["annots"], [[2, 3, a2.id]])
+        # The legacy writer doesn't write IDs or annotation values.
+        self.assertEqual(self._render(d, legacy = True)["B"]["annots"], [[2, 3, None]])
+        d.removeAnnotationGroup([a2, b])
+        self.failIf(d.atypeRepository._labelMayHaveIDs("A"))
+        self.failIf(self._render(d)["A"]["hasID"])
+
+    def testSharedSchema(self):
+        # Two documents with the same schema share the renderer, but
+        # not the result.
+        docs = []
+        for v in [u"x", u"y"]:
+            d = MAT.Document.AnnotatedDoc(signal = u"abc")
+            d.createAnnotation(0, 1, "A", {"s": v})
+            a = d.createAnnotation(1, 2, "A")
+            a.atype.ensureAttribute("l", aggregation = "list")
+            a["l"] = MAT.Annotation.AttributeValueList([v])
+            docs.append(d)
+        r1 = self._render(docs[0])["A"]
+        r2 = self._render(docs[1])["A"]
+        self.assertEqual(r1["annots"], [[0, 1, u"x"], [1, 2, None, [u"x"]]])
+        self.assertEqual(r2["annots"], [[0, 1, u"y"], [1, 2, None, [u"y"]]])
+        self.assertEqual(r1["attrs"], r2["attrs"])
+        self.failIf(r1["attrs"][0] is r2["attrs"][0])
+
+class InstructionSetCacheTestCase(MAT.UnitTest.MATTestCase):
+
+    XML = """<instructions>
+  <labels source_re="PER.*"><map target="ENAMEX"/></labels>
+  <labels source_re="LOC|ORG" excluding_re="ORG"><discard/></labels>
+</instructions>"""
+
+    def _convert(self, engine):
+        d = MAT.Document.AnnotatedDoc(signal = u"John in Paris")
+        d.createAnnotation(0, 4, "PERSON")
+        d.createAnnotation(8, 13, "LOCATION")
+        d.createAnnotation(8, 13, "LOC")
+        t = MAT.Document.AnnotatedDoc()
+        MAT.DocumentIO.DocumentInstructionSetEngineConvertor(engine).inputConvert(d, t)
+        return sorted([(a.atype.lab, a.start, a.end) for a in t.getAnnotations()])
+
+    def testCache(self):
+        tmpPath = os.path.join(self.testContext["TMPDIR"], "instructionset")
+        os.makedirs(tmpPath)
+        p = os.path.join(tmpPath, "instructions.xml")
+        fp = open(p, "w")
+        fp.write(self.XML)
+        fp.close()
+        e1 = MAT.DocumentIO.DocumentInstructionSetEngine(instructionSetFile = p)
+        e2 = MAT.DocumentIO.DocumentInstructionSetEngine(instructionSetFile = p)
+        self.failUnless(e1.instructions is e2.instructions)
+        self.assertEqual(self._convert(e1), [("ENAMEX", 0, 4), ("LOCATION", 8, 13)])
+        self.assertEqual(self._convert(e2), [("ENAMEX", 0, 4), ("LOCATION", 8, 13)])
+        # A new modification time means the file is read again.
+        fp = open(p, "w")
+        fp.write(self.XML.replace("ENAMEX", "PER"))
+        fp.close()
+        st = os.stat(p)
+        os.utime(p, (st.st_atime, st.st_mtime + 10))
+        e3 = MAT.DocumentIO.DocumentInstructionSetEngine(instructionSetFile = p)
+        self.failIf(e3.instructions is e1.instructions)
+        self.assertEqual(self._convert(e3), [("LOCATION", 8, 13), ("PER", 0, 4)])
+        self.assertEqual(len([k for k in MAT.DocumentIO._DIS_INSTRUCTION_CACHE.keys()
+                              if k[1:3] == ("file", os.path.abspath(p))]), 1)
+        # Strings are cached too.
+        e4 = MAT.DocumentIO.DocumentInstructionSetEngine(instructionSetXML = self.XML)
+        e5 = MAT.DocumentIO.DocumentInstructionSetEngine(instructionSetXML = self.XML)
+        self.failUnless(e4.instructions is e5.instructions)
+        self.assertEqual(self._convert(e5), [("ENAMEX", 0, 4), ("LOCATION", 8, 13)])
+
+    def testNamePattern(self):
+        pat = MAT.DocumentIO._DISNamePattern("PER.*|ORG")
+        self.failUnless(pat.match("PERSON"))
+        self.failUnless(pat.match("ORG"))
+        self.failIf(pat.match("ORGANIZATION"))
+        self.failIf(pat.match("LOC"))
+        self.assertEqual(pat._results, {"PERSON": True, "ORG": True, "ORGANIZATION": False, "LOC": False})
+
+# Tar and zip archives as input_dir and output_dir.
+
+import tarfile, zipfile, StringIO
+
+class ArchiveTestCase(MAT.UnitTest.MATTestCase):
+
+    def setUp(self):
+        MAT.UnitTest.MATTestCase.setUp(self)
+        # One directory per test.
+        self.tmpDir = os.path.join(self.testContext["TMPDIR"], self.id())
+        os.makedirs(self.tmpDir)
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        self.members = []
+        for donor in ["donor1", "donor2"]:
+            for i in range(3):
+                d = _makeIODoc()
+                d.metadata["name"] = "%s/rec%d.json" % (donor, i)
+                self.members.append((d.metadata["name"], jsonIO.writeToByteSequence(d, "utf-8")))
+        self.members.append(("donor1/notes.txt", "not a document"))
+
+    def _makeArchive(self, name):
+        p = os.path.join(self.tmpDir, name)
+        if name.endswith(".zip"):
+            archive = zipfile.ZipFile(p, "w")
+            for mName, s in self.members:
+                archive.writestr(mName, s)
+        else:
+            archive = tarfile.open(p, "w:gz")
+            for mName, s in self.members:
+                info = tarfile.TarInfo(mName)
+                info.size = len(s)
+                archive.addfile(info, StringIO.StringIO(s))
+        archive.close()
+        return p
+
+    def testRead(self):
+        for name in ["in.tar.gz", "in.zip"]:
+            p = self._makeArchive(name)
+            for mode in [None, "thread", "process"]:
+                dm = MAT.DocumentIO.DocumentIOManager()
+                dm.configure(input_dir = p, input_file_type = "mat-json", input_file_re = ".*[.]json",
+                             prefetch = (mode and 2) or None, prefetch_mode = mode)
+                docPairs, skipPairs = dm.loadPairs()
+                dm.close()
+                self.assertEqual(skipPairs, [])
+                self.assertEqual([(f, d.metadata["name"]) for (f, d) in docPairs],
+                                 [(os.path.join(p, mName), mName) for (mName, s) in self.members[:-1]])
+
+    def testWrite(self):
+        p = self._makeArchive("in.tar.gz")
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json")
+        for outName in ["out.zip", "out.tar.bz2", "outdir"]:
+            out = os.path.join(self.tmpDir, "results", outName)
+            dm = MAT.DocumentIO.DocumentIOManager()
+            dm.configure(input_dir = p, input_file_type = "mat-json", input_file_re = "donor2/.*",
+                         output_dir = out, output_file_type = "mat-json", output_fsuff = ".out")
+            for f, d, err in dm.loadPairsIncrementally():
+                dm.writeDocument(f, d)
+            dm.close()
+            expected = ["donor2/rec%d.json.out" % i for i in range(3)]
+            if outName == "outdir":
+                self.assertEqual(sorted(os.listdir(os.path.join(out, "donor2"))),
+                                 [os.path.basename(e) for e in expected])
+                continue
+            dm = MAT.DocumentIO.DocumentIOManager()
+            dm.configure(input_dir = out, input_file_type = "mat-json")
+            docPairs, skipPairs = dm.loadPairs()
+            dm.close()
+            self.assertEqual([f for (f, d) in docPairs], [os.path.join(out, e) for e in expected])
+            self.assertEqual([d.metadata["name"] for (f, d) in docPairs], [e[:-4] for e in expected])
+            self.assertEqual(_renderSorted(docPairs[0][1], jsonIO)["asets"],
+                             _renderSorted(_makeIODoc(), jsonIO)["asets"])
+
+    def testBadArchive(self):
+        p = os.path.join(self.tmpDir, "in.tar")
+        fp = open(p, "w")
+        fp.write("not an archive")
+        fp.close()
+        self.assertRaises(MAT.DocumentIO.ManagerError, MAT.DocumentIO.DocumentIOManager().configure,
+                          input_dir = p, input_file_type = "mat-json")
+        self.assertEqual(MAT.DocumentIO._safeMemberPath("/a/../../b/./c"), "a/b/c")
@@ -59,3 +59,46 @@ class PureOptionProbeStep(ProbeStep):
                Option("--probe_f", action="store_true"),
                Option("--probe_g", type="string",
                       side_effect_callback = addFileType)]
+
+# For streaming. mark and number are ordinary document steps;
+# count needs to see the whole batch before it can finish any
+# document.
+
+class MarkStep(MAT.PluginMgr.PluginStep):
+
+    def do(self, annotSet, **kw):
+        import os
+        annotSet.metadata["marked"] = True
+        # So we can tell whether a worker did it.
+        annotSet.metadata["marked_by"] = os.getpid()
+        return annotSet
+
+    def undo(self, annotSet, **kw):
+        del annotSet.metadata["marked"]
+
+class CountStep(MAT.PluginMgr.PluginStep):
+
+    batchLevel = True
+
+    def doBatch(self, iDataPairs, **kw):
+        state = self.startBatchStream(**kw)
+        self.digestBatch(state, iDataPairs, **kw)
+        self.endBatchDigestion(state, **kw)
+        return self.replaceBatch(state, iDataPairs, **kw)
+
+    def startBatchStream(self, **kw):
+        return {"count": 0}
+
+    def digestBatch(self, state, iDataPairs, **kw):
+        state["count"] += len(iDataPairs)
+
+    def replaceBatch(self, state, iDataPairs, **kw):
+        for fname, annotSet in iDataPairs:
+            annotSet.metadata["batch_size"] = state["count"]
+        return iDataPairs
+
+class NumberStep(MAT.PluginMgr.PluginStep):
+
+    def do(self, annotSet, **kw):
+        annotSet.metadata["number"] = annotSet.metadata["batch_size"] * 10
+        return annotSet
@@ -340,3 +340,116 @@ class CoreferenceTest(MAT.UnitTest.MATTestCase):
         else:
             self.assertEqual(len(seen), 2)
         rEngine.EndDocumentForReplacement()
+
+# In a long-lived process, each nominate request has to get its own
+# replacer state; otherwise the first request's cache scope (and its
+# surrogates) leak into all the later ones.
+
+class DaemonReplacerTest(MAT.UnitTest.MATTestCase):
+
+    def testIndependentJobs(self):
+        import random, MAT.EngineDaemon
+        plugins = MAT.PluginMgr.LoadPlugins()
+        task = plugins.getTask("AMIA Deidentification")
+        jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = task)
+        daemon = MAT.EngineDaemon.EngineDaemon(pluginDir = plugins)
+
+        def runJob(scope, seed):
+            docs = []
+            for i in range(2):
+                d = task.newDocument(signal = u"John Smith was seen.")
+                d.createAnnotation(0, 10, "PATIENT")
+                docs.append(jsonIO.renderJSONObj(d))
+            random.seed(seed)
+            resp = daemon.doJob({"task": "AMIA Deidentification", "workflow": "Review/repair",
+                                 "steps": "nominate", "replacer": "clear -> clear",
+                                 "cache_scope": "PATIENT," + scope, "documents": docs})
+            self.assertTrue(resp["success"], resp["error"])
+            return [[a[2] for aset in d["asets"] if aset["type"] == "PATIENT" for a in aset["annots"]]
+                    for d in resp["documents"]]
+
+        batchRepls = runJob("batch", 1)
+        # Batch scope: the same surrogate in both documents.
+        self.assertEqual(batchRepls[0], batchRepls[1])
+        docRepls = runJob("doc", 2)
+        self.assertNotEqual(docRepls, batchRepls)
+        # And the same job again gets the same fresh state.
+        self.assertEqual(runJob("doc", 2), docRepls)
+        # But the resources are loaded only once.
+        self.assertTrue(task.newReplacer("clear -> clear").repository is \
+                        task.newReplacer("clear -> clear", cache_scope = "PATIENT,batch").repository)
+
+# The nominate step is split into passes, so that the engine can stream
+# (see MAT.ToolChain.MATEngine.Run()). Streaming through the spool
+# should give exactly what doBatch() does.
+
+class StreamedNominationTest(MAT.UnitTest.MATTestCase):
+
+    TEXTS = [(u"John Smith was seen on 3/4/2009 by Dr. Mary Jones at 617-555-1212.",
+              [(0, 10, "PATIENT"), (23, 31, "DATE"), (39, 49, "DOCTOR"), (53, 65, "PHONE")]),
+             (u"Mary Jones called John Smith about his 45 year old brother.",
+              [(0, 10, "DOCTOR"), (18, 28, "PATIENT"), (39, 41, "AGE")]),
+             (u"On 12/25/2008, Smith was admitted to Boston General Hospital.",
+              [(3, 13, "DATE"), (15, 20, "PATIENT"), (37, 60, "HOSPITAL")]),
+             (u"Nothing to see here.", []),
+             (u"Contact John at 508-555-0000 or 42 Main Street, Bedford.",
+              [(8, 12, "PATIENT"), (16, 28, "PHONE"), (32, 55, "LOCATION")])]
+
+    def setUp(self):
+        MAT.UnitTest.MATTestCase.setUp(self)
+        self.task = MAT.PluginMgr.LoadPlugins().getTask("AMIA Deidentification")
+        self.jsonIO = MAT.DocumentIO.getDocumentIO("mat-json", task = self.task)
+        tmpPath = os.path.join(self.testContext["TMPDIR"], self.id())
+        self.inDir = os.path.join(tmpPath, "in")
+        self.outDir = os.path.join(tmpPath, "out")
+        os.makedirs(self.inDir)
+        os.makedirs(self.outDir)
+        i = 0
+        for signal, annots in self.TEXTS:
+            d = self.task.newDocument(signal = signal)
+            for start, end, lab in annots:
+                d.createAnnotation(start, end, lab)
+            self.jsonIO.writeToTarget(d, os.path.join(self.inDir, "doc%d.json" % i))
+            i += 1
+
+    def _nominate(self, **kw):
+        import random, shutil
+        shutil.rmtree(self.outDir)
+        os.mkdir(self.outDir)
+        random.seed(17)
+        MAT.ToolChain.MATEngine(self.task, "Review/repair").Run(
+            input_dir = self.inDir, input_file_type = "mat-json",
+            output_dir = self.outDir, output_file_type = "mat-json",
+            steps = "nominate", replacer = "clear -> clear", **kw)
+        labels = self.task.getAnnotationTypesByCategory("content")
+        res = {}
+        for f in os.listdir(self.outDir):
+            d = self.jsonIO.readFromSource(os.path.join(self.outDir, f))
+            res[f] = (d.metadata.get("dateDelta"),
+                      [(a.start, a.end, a.atype.lab, a.get("redacted")) for a in d.orderAnnotations(labels)])
+        return res
+
+    def testStreamedNomination(self):
+        batchRes = self._nominate()
+        self.assertEqual(len(batchRes), len(self.TEXTS))
+        for f, (dateDelta, annots) in batchRes.items():
+            for start, end, lab, repl in annots:
+                self.failUnless(repl, "no replacement for %s %d-%d in %s" % (lab, start, end, f))
+        for chunk in [1, 2, 5]:
+            streamRes = self._nominate(stream_chunk = chunk)
+            self.assertEqual(sorted(streamRes.keys()), sorted(batchRes.keys()))
+            for f, (dateDelta, annots) in batchRes.items():
+                # The same annotations got replacements...
+                self.assertEqual([a[:3] + (a[3] is not None,) for a in streamRes[f][1]],
+                                 [a[:3] + (a[3] is not None,) for a in annots])
+                # ... and, with the same seed, the same ones.
+                self.assertEqual(streamRes[f], (dateDelta, annots))
+
+    def testDocumentChangedBetweenPasses(self):
+        step = self.task.getStep("Review/repair", "nominate")
+        d = self.jsonIO.readFromSource(os.path.join(self.inDir, "doc0.json"))
+        state = step.startBatchStream(replacer = "clear -> clear")
+        step.digestBatch(state, [("doc0", d)], replacer = "clear -> clear")
+        d.createAnnotation(0, 4, "PATIENT")
+        self.assertRaises(MAT.Error.MATError, step.replaceBatch, state, [("doc0", d)],
+                          replacer = "clear -> clear")
@@ -573,6 +573,7 @@ class DeidTaskDescriptor(PluginTaskDescriptor):
         self._rdirCache = None
         self._replacerCache = None        
         self._instantiatedReplacerCache = {}
+        self._replacerRepositoryCache = {}
 
     def fromXML(self, *args):
         PluginTaskDescriptor.fromXML(self, *args)
@@ -749,18 +750,36 @@ class DeidTaskDescriptor(PluginTaskDescriptor):
     def replaceableAnnotations(self):
         return self.getAnnotationTypesByCategory("content")
 
+    # This one is cached by name, and it's only for the things which
+    # don't digest and replace (finding replaced elements, transforming).
+    # The replacer keeps its caches, corpus distributions and cache scopes
+    # from one batch to the next, so the nominate step asks for a new one
+    # each time (otherwise, in a long-lived process like MATWeb or
+    # MATEngineDaemon, the first request's settings and surrogates would
+    # be reused for every later request).
+    
     def instantiateReplacer(self, rName, **kw):
         
         if self._instantiatedReplacerCache.has_key(rName):
             return self._instantiatedReplacerCache[rName]
         else:
-            rPair = self.findReplacer(rName)
-            if rPair is not None:
-                r = rPair[0]
-                c = r(self.getReplacerRDirs(), self.categories, **kw)
+            c = self.newReplacer(rName, **kw)
+            if c is not None:
                 self._instantiatedReplacerCache[rName] = c
-                return c
+            return c
+
+    # The resources the replacers load are read-only, so all the
+    # replacers which use the same resource_file_repl share them.
+    
+    def newReplacer(self, rName, resource_file_repl = None, **kw):
+        rPair = self.findReplacer(rName)
+        if rPair is None:
             return None
+        c = rPair[0](self.getReplacerRDirs(), self.categories,
+                     resource_file_repl = resource_file_repl,
+                     repository = self._replacerRepositoryCache.get(resource_file_repl), **kw)
+        self._replacerRepositoryCache[resource_file_repl] = c.repository
+        return c
 
     # Here, I'm going to try to add a column which reflects the
     # document-level probabilities.
@@ -822,19 +841,29 @@ class NominateStep(PluginStep):
 
     # This drives the replacers.
 
-    def doBatch(self, iDataPairs, replacer = None, dont_nominate = None, flag_unparseable_seeds = None, **kw):
+    # This needs to be a batch step, so that we can get corpus-level
+    # weights to work. It's split into the streaming passes
+    # (see PluginStep), and doBatch() just runs them back to back.
+
+    batchLevel = True
 
-        # This needs to be a batch step, so that we can get corpus-level
-        # weights to work.
+    def doBatch(self, iDataPairs, **kw):
 
         # Don't bother catching the errors; we'll deal with them
         # in the engine.
 
+        state = self.startBatchStream(**kw)
+        self.digestBatch(state, iDataPairs, **kw)
+        self.endBatchDigestion(state, **kw)
+        return self.replaceBatch(state, iDataPairs, **kw)
+
+    def startBatchStream(self, replacer = None, dont_nominate = None, flag_unparseable_seeds = None, **kw):
+
         if replacer is None:
             # Checked in paramsSatisfactory().
             replacer = self.descriptor.allReplacers()[0]
 
-        r = self.descriptor.instantiateReplacer(replacer, **kw)
+        r = self.descriptor.newReplacer(replacer, **kw)
         if not r:
             raise Error.MATError("nominate", "couldn't find the replacer named " + replacer)
 
@@ -853,47 +882,59 @@ class NominateStep(PluginStep):
         # This should only happen with spanned annotations, but we
         # have to make absolutely sure. See below.
         
-        replaceableAnnots = set(self.descriptor.replaceableAnnotations()) - dontNominate        
-        
-        # Two phases: first we digest, then we replace.
-        # Note that what we need for the replacement is the
-        # effective label, as defined by the task.
-
-        nomMapping = {}
+        replaceableAnnots = set(self.descriptor.replaceableAnnotations()) - dontNominate
 
+        # Two phases: first we digest, then we replace. The digestions
+        # are saved in document order, one list per document, in
+        # the order of _nominationCandidates(); in the streaming case,
+        # the annotations we digested won't be the ones we replace.
         # Apparently, you may have the same file more than once. This
         # is a bug in the bug queue, and the only instance of doBatch in the
-        # system where that problem might arise is this one. So let's fix it.
-        
-        for f, annotSet in iDataPairs:
+        # system where that problem might arise is this one. Keeping
+        # the digestions in order takes care of it.
 
-            annotSet.metadata["replacer_used"] = replacer
-            
-            # First, generate all the nominations.
+        from collections import deque
+        return {"replacer": replacer, "r": r,
+                "flagUnparseableSeeds": flagUnparseableSeeds,
+                "replaceableAnnots": replaceableAnnots,
+                "digestions": deque()}
 
-            digestionDict = {}
-            annList = []
+    # Note that what we need for the replacement is the
+    # effective label, as defined by the task.
 
-            for eName in replaceableAnnots:
-                try:
-                    eType = annotSet.anameDict[eName]
-                except KeyError:
-                    # There may not be any.
-                    continue
-                # If it's spanless, skip it.
-                if not eType.hasSpan:
-                    continue
-                annList = annList + annotSet.atypeDict[eType]
+    def _nominationCandidates(self, state, annotSet):
+        annList = []
+        for eName in state["replaceableAnnots"]:
+            try:
+                eType = annotSet.anameDict[eName]
+            except KeyError:
+                # There may not be any.
+                continue
+            # If it's spanless, skip it.
+            if not eType.hasSpan:
+                continue
+            annList = annList + annotSet.atypeDict[eType]
 
-            # Sort them in order.
+        # Sort them in order.
 
-            annList.sort(key = lambda ann: ann.start)
+        annList.sort(key = lambda ann: ann.start)
+        return annList
 
-            # Digest.
+    def digestBatch(self, state, iDataPairs, **kw):
 
-            for annot in annList:
+        r = state["r"]
+        
+        for f, annotSet in iDataPairs:
+
+            annotSet.metadata["replacer_used"] = state["replacer"]
+            
+            # First, generate all the nominations.
+
+            digestionList = []
+
+            for annot in self._nominationCandidates(state, annotSet):
                 lab = self.descriptor.getEffectiveAnnotationLabel(annot)
-                digestionDict[annot] = (lab, r.Digest(lab, annotSet.signal[annot.start:annot.end]))
+                digestionList.append((lab, r.Digest(lab, annotSet.signal[annot.start:annot.end])))
 
             r.EndDocumentForDigestion()
 
@@ -901,16 +942,26 @@ class NominateStep(PluginStep):
                 # This is an integer.
                 annotSet.metadata["dateDelta"] = r.dateDelta
 
-            nomMapping[(f, annotSet)] = (annList, digestionDict)
-            
-        # Replace.
+            state["digestions"].append(digestionList)
+
+    def replaceBatch(self, state, iDataPairs, **kw):
+
+        r = state["r"]
+        replacer = state["replacer"]
+        flagUnparseableSeeds = state["flagUnparseableSeeds"]
 
         for f, annotSet in iDataPairs:
 
-            annList, digestionDict = nomMapping[(f, annotSet)]
+            digestionList = state["digestions"].popleft()
+            candidates = self._nominationCandidates(state, annotSet)
+
+            # The digestions are paired with the annotations by position,
+            # so if something changed the document in between, we're lost.
+            
+            if len(candidates) != len(digestionList):
+                raise Error.MATError("nominate", "document %s has %d annotations to replace, but %d were digested" % (f, len(candidates), len(digestionList)))
 
-            for annot in annList:
-                lab, digestions = digestionDict[annot]
+            for annot, (lab, digestions) in zip(candidates, digestionList):
                 repl = r.Replace(lab, digestions, filename = f)
                 annot[self.descriptor.REDACTION_ATTR] = repl
                 # ONLY if we're in clear -> clear. Otherwise, it doesn't matter
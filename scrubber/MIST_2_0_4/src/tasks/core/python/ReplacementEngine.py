@@ -1960,12 +1960,14 @@ class PIIReplacementEngine:
     # will all be (possibly clumsy) strings. I've added the kw because
     # children of the replacement engine might want to customize
     # specially. cache_scope, cache_case_insensitivity, resource_file_repl
-    # are all from that.
+    # are all from that. The repository isn't; it's for a caller which has
+    # already loaded the resources for this resource_dirs and
+    # resource_file_repl, and wants to share them (they're read-only).
 
     def __init__(self, resource_dirs, categories,
                  cache_scope = None, cache_case_insensitivity = None,
                  resource_file_repl = None, replacement_map_file = None,
-                 replacement_map = None, **cmdlineKw):
+                 replacement_map = None, repository = None, **cmdlineKw):
         self.categories = categories
         self.resourceDirs = resource_dirs
 
@@ -1988,23 +1990,27 @@ class PIIReplacementEngine:
 
         # resourceReplacementString is file=repl;file=repl
 
-        resourceReplacements = {}
-        if resource_file_repl is not None:
-            pairs = resource_file_repl.split(";")
-            for pair in pairs:
-                toks = pair.split("=", 1)
-                if len(toks) != 2:
-                    raise Error.MATError("nominate", "bad resource_file_repl pair '%s'" % pair)
-                resourceReplacements[toks[0]] = toks[1]
+        if repository is None:
+            resourceReplacements = {}
+            if resource_file_repl is not None:
+                pairs = resource_file_repl.split(";")
+                for pair in pairs:
+                    toks = pair.split("=", 1)
+                    if len(toks) != 2:
+                        raise Error.MATError("nominate", "bad resource_file_repl pair '%s'" % pair)
+                    resourceReplacements[toks[0]] = toks[1]
+            repository = Repository(resource_dirs, resourceReplacements)
         
-        self.repository = Repository(resource_dirs, resourceReplacements)
+        self.repository = repository
         self.digestionStrategy = self.createDigestionStrategy()
         self.renderingStrategy = self.createRenderingStrategy()
         # Use the date stuff.
         for p in resource_dirs:
             dateutilPath = os.path.join(p, "python-dateutil-1.3")
             if os.path.isdir(dateutilPath):
-                sys.path.insert(0, dateutilPath)
+                # Don't pile it up if we create lots of engines.
+                if dateutilPath not in sys.path:
+                    sys.path.insert(0, dateutilPath)
                 break
         self._replacers = {}
 